@@ -3,12 +3,21 @@ import json
 import asyncio  
 import os  
 import websockets  
-import base64  
+import hashlib  
 import threading  
+import time
 import requests
 from st_txt_copybutton import txt_copy
 import tempfile
 
+try:
+    import msgpack  # 結果をバイナリ形式で受信する（インストールされていない場合はJSON）
+except ImportError:
+    msgpack = None
+
+# 文字起こしサーバー（複数台の場合はゲートウェイ）のアドレス
+SERVER_URL = os.environ.get("TRANSCRIBE_SERVER_URL", "http://localhost:5001").rstrip("/")
+
 # WebSocket接続を管理するクラス
 class WebSocketManager:
     def __init__(self):
@@ -16,9 +25,16 @@ class WebSocketManager:
         self.lock = threading.Lock()
     
     async def connect(self):
-        uri = "ws://localhost:5001/ws"
+        uri = SERVER_URL.replace("http", "ws", 1) + "/ws"
         try:
             self.websocket = await websockets.connect(uri, ping_interval=20, ping_timeout=120)
+            # 結果の送信形式を指定する（セグメントは表示の更新間隔ごとにまとめて受け取る）
+            await self.websocket.send(json.dumps({
+                "type": "hello",
+                "encoding": "msgpack" if msgpack is not None else "json",
+                "batch_interval": RENDER_INTERVAL,
+            }))
+            json.loads(await asyncio.wait_for(self.websocket.recv(), timeout=60))
             return self.websocket
         except Exception as e:
             st.error(f"サーバー接続エラー: {e}")
@@ -34,11 +50,13 @@ class WebSocketManager:
             st.error(f"送信エラー: {e}")
             return False
     
-    async def close(self):
+    # 接続を閉じる（停止が要求されている場合のみサーバー側のジョブも停止する）
+    async def close(self, stop=False):
         if self.websocket:
             try:
-                await self.websocket.send(json.dumps({"type": "stop"}))
-                await asyncio.sleep(2)
+                if stop:
+                    await self.websocket.send(json.dumps({"type": "stop"}))
+                    await asyncio.sleep(2)
                 await self.websocket.close()
             except Exception as e:
                 pass
@@ -48,31 +66,135 @@ class WebSocketManager:
 # WebSocketマネージャーのインスタンスを作成
 ws_manager = WebSocketManager()
 
+# 接続が切れたときに再接続を試みる回数
+RECONNECT_ATTEMPTS = 3
+
+# 音声ファイルを送信するバイナリフレーム1つあたりのサイズ
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 受信途中から文字起こしできる形式（サーバーはアップロードの完了を待たずに結果を送り始める）
+PIPELINED_FORMATS = (".wav", ".flac")
+
+# 受信中の表示を更新する最小間隔（秒）。セグメントが大量に届いても描画は1秒あたり数回にまとめる
+RENDER_INTERVAL = 0.25
+
+# 画面に表示する優先度と、サーバーに送る tier（標準では混雑時のみ速いモデルに切り替わる）
+TIER_LABELS = {"標準": "balanced", "精度優先": "accurate", "速度優先": "fast"}
+# 画面に表示する音声の言語と、サーバーに送る language（言語を指定するとサーバーは言語判定を省略する）
+LANGUAGE_LABELS = {"日本語": "ja", "英語": "en", "自動判定": "auto"}
+# 受信中に表示する下書きの行数
+DRAFT_LINES = 5
+
+# 秒数を「○分○秒」形式に変換する関数
+def convert_seconds(seconds):
+    minutes = seconds // 60  # 分を計算（整数除算）
+    remaining_seconds = seconds % 60  # 残りの秒数
+    return f"{int(minutes)}分{int(remaining_seconds)}秒"
+
+# 受信したフレームをメッセージに戻す関数（テキストはJSON、バイナリはmsgpack）
+def decode_frame(frame):
+    if isinstance(frame, bytes):
+        return msgpack.unpackb(frame, raw=False)
+    return json.loads(frame)
+
 # 文字起こしリクエストをサーバーに送信する非同期関数
-async def send_transcribe_request(websocket, model, button_save_audio, audio_file_path):  
-    # 音声ファイルをバイナリで読み込み
-    with open(audio_file_path, "rb") as f:  
-        audio_file = f.read()  
+# 小さなJSONヘッダーの後に、音声ファイルを固定サイズのバイナリフレームに分割して送信する
+async def send_transcribe_request(websocket, model, button_save_audio, audio_file_path, parallel=False, tier="balanced", two_pass=False,
+                                  word_timestamps=False, language="ja"):  
+    # ファイル全体のSHA-256を計算（チャンク単位で読み込み、ファイル全体はメモリに載せない）
+    digest = hashlib.sha256()
+    with open(audio_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    file_size = os.path.getsize(audio_file_path)
 
-    # バイナリデータをBase64エンコード
-    audio_base64 = base64.b64encode(audio_file).decode('utf-8')  
+    # サーバーが同じ音声を保存済みか・どこまで受信済みかを問い合わせる
+    # （ゲートウェイ経由の場合は model を使って、モデルを読み込み済みのサーバーに振り分けられる）
+    if not await ws_manager.send(json.dumps({"type": "probe", "sha256": digest.hexdigest(), "model": model})):
+        return False
+    offset = 0
+    while True:
+        data = decode_frame(await asyncio.wait_for(websocket.recv(), timeout=60))
+        if data.get("type") == "probe_result":
+            offset = data["offset"] if data["offset"] <= file_size else 0
+            break
+        if "error" in data:
+            st.error(f"エラー: {data['error']}")
+            return False
 
-    # リクエストメッセージを作成
+    # 二段階モードの下書きは音声全体が届いてから作るため、受信しながらの文字起こしは使わない
+    pipelined = os.path.splitext(audio_file_path)[1].lower() in PIPELINED_FORMATS and not two_pass
+
+    # リクエストヘッダーを作成（受信済みの位置から再開する）
     message = json.dumps({
-        "type": "transcribe",
-        "audio": audio_base64,
+        "type": "upload",
         "model": model,
         "save_audio": button_save_audio,
-        "file_name": audio_file_path
+        "file_name": audio_file_path,
+        "size": file_size,
+        "offset": offset,
+        "sha256": digest.hexdigest(),
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "parallel": parallel,
+        "tier": tier,
+        "two_pass": two_pass,
+        "pipelined": pipelined,
+        "word_timestamps": word_timestamps,
+        "language": language
     })
+    if not await ws_manager.send(message):
+        return False
+
+    if pipelined:
+        # サーバーは受信しながら文字起こしを始めるので、音声の送信は結果の受信と並行して行う
+        st.session_state.upload_task = asyncio.create_task(send_audio(audio_file_path, offset, file_size, show_progress=False))
+        return True
+    return await send_audio(audio_file_path, offset, file_size)
 
-    return await ws_manager.send(message)
+# 音声データの未送信部分をチャンクごとに送信する非同期関数
+async def send_audio(audio_file_path, offset, file_size, show_progress=True):
+    sent = offset
+    with open(audio_file_path, "rb") as f:
+        f.seek(offset)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            if not await ws_manager.send(chunk):
+                return False
+            sent += len(chunk)
+            if show_progress:
+                st.session_state.progress_bar.progress(int(sent / file_size * 100), text="アップロード中です。")
+    if show_progress:
+        st.session_state.progress_bar.progress(0, text=st.session_state.progress_text)
+    return True
 
 # 文字起こし結果を受信して表示する非同期関数
 async def receive_transcription_results(websocket):
     # Streamlitのステータス表示を開始
     with st.status("**文字起こし実行中...**", state="running", expanded=True) as status:
         transcribe_result = st.empty()  # 文字起こし結果を表示するための空のコンテナ
+        pending = None  # まだ表示していない最新の (タイムライン, 進捗率)
+        last_render = 0.0
+        time_line = ""  # 最後に受信したセグメントのタイムライン
+        last_end = 0.0  # 最後に受信したセグメントの終了時刻（これより後の区間は下書きを表示する）
+        drafts = []  # 二段階モードで先に届く下書きの (開始秒, 終了秒, テキスト)
+        progress = 0
+
+        # 最後のセグメントと、まだセグメントが届いていない区間の下書きを表示用にまとめる
+        def timeline():
+            lines = [f"[{convert_seconds(start)} -> {convert_seconds(end)}] {text}" for start, end, text in drafts if start >= last_end]
+            if not lines:
+                return time_line
+            return time_line + "\n\n*下書き*  \n" + "  \n".join(lines[:DRAFT_LINES])
+
+        # 最新のセグメントと進捗率を表示する（間のセグメントの表示は省略する）
+        def render():
+            nonlocal pending, last_render
+            if pending is not None:
+                timeline, percent_complete = pending
+                transcribe_result.markdown(timeline)  # タイムラインを表示
+                st.session_state.progress_bar.progress(int(percent_complete), text=st.session_state.progress_text)
+                pending = None
+            last_render = time.monotonic()
+
         try:
             # WebSocketからメッセージを非同期で受信し続ける
             async for message in websocket:  
@@ -80,30 +202,88 @@ async def receive_transcription_results(websocket):
                 if st.session_state.stop_event.is_set():  
                     break  
 
-                # JSONメッセージをパース
-                data = json.loads(message)  
+                # メッセージをパース
+                data = decode_frame(message)  
                 if "error" in data:  
                     st.error(f"エラー: {data['error']}")  
+                elif data.get("type") == "job":  
+                    # ジョブIDを保存（切断・再実行時の再接続に使う）
+                    st.session_state.job_id = data["job_id"]  
+                elif data.get("type") == "model":  
+                    # サーバーが選んだモデルとデコード方針を表示
+                    policy = f"（{data['decode_policy']}）" if data.get("decode_policy") else ""
+                    st.caption(f"使用モデル: {data['model']}{policy}")  
+                elif data.get("type") == "drafts":  
+                    drafts.extend((draft["start"], draft["end"], draft["text"]) for draft in data["drafts"])
+                    pending = (timeline(), progress)
+                    if time.monotonic() - last_render >= RENDER_INTERVAL:
+                        render()
+                elif data.get("type") == "loading":  
+                    # サーバーが起動直後でモデルを読み込み中の場合
+                    transcribe_result.markdown(f"サーバーでモデルを読み込み中です（{data['progress']}%）")  
+                elif data.get("type") == "queued":  
+                    # 順番待ちの場合は待機順を表示
+                    transcribe_result.markdown(f"順番待ち中です（{data['position']}番目）")  
+                elif data.get("type") == "final":  
+                    # 全文はセグメントとして受信済みなので、件数とダイジェストで受信漏れがないか確認する
+                    render()
+                    if (data["data"]["segment_count"] != len(st.session_state.segments)
+                            or data["data"]["sha256"] != st.session_state.transcript_digest.hexdigest()):
+                        st.warning("一部の文字起こし結果を受信できていない可能性があります。")
+                    # サーバーが書き出した字幕・JSONファイルのダウンロードに使う
+                    st.session_state.export_job_id = st.session_state.job_id
+                    st.session_state.done_event.set()  
+                    st.session_state.job_id = None  
+                    break  
                 elif "done" in data and data["done"]:  
                     # 処理完了の通知を受けたら完了イベントをセット
                     st.session_state.done_event.set()  
+                    st.session_state.job_id = None  
                     break  
-                else:  
-                    # テキストデータがあれば表示
-                    if 'text' in data.get('data', {}):  
-                        text = data['data']['text']  
-                        timeline = data['data']['time_line']  
-                        transcribe_result.markdown(timeline)  # タイムラインを表示
-                        st.session_state.full_text_transcribe += text  # 全文を累積
-                        percent_complete = data['progress']  # 進捗率
-                        st.session_state.progress_bar.progress(int(percent_complete), text=st.session_state.progress_text)  
+                elif data.get("type") == "segments" and data["segments"]:  
+                    # まとめて届いたセグメントを追加し、最後のセグメントを表示
+                    for segment in data["segments"]:
+                        st.session_state.segments.append(segment["text"])  # セグメントのリストに追加（全文は表示時に連結する）
+                        st.session_state.transcript_digest.update(segment["text"].encode("utf-8"))
+                    # タイムライン形式のテキスト（開始時間→終了時間 + テキスト）と進捗率
+                    time_line = f"[{convert_seconds(segment['start'])} -> {convert_seconds(segment['end'])}] {segment['text']}"
+                    last_end = segment['end']
+                    progress = data['progress']
+                    pending = (timeline(), progress)
+                    if time.monotonic() - last_render >= RENDER_INTERVAL:
+                        render()
             transcribe_result.empty()  # 表示をクリア
             status.update(label="**文字起こし完了!**", state="complete", expanded=False)
+            return True
         except websockets.exceptions.ConnectionClosed:  
-            st.error("サーバーとの接続が切断されました")  
+            transcribe_result.empty()
+            status.update(label="**再接続中...**", state="error", expanded=False)
+            return False
+
+# ジョブに再接続し、受信済みのセグメントの続きから結果を受け取る
+async def attach_job(websocket):
+    return await ws_manager.send(json.dumps({
+        "type": "attach",
+        "job_id": st.session_state.job_id,
+        "from_segment": len(st.session_state.segments)
+    }))
+
+# 接続が切れた場合は実行中のジョブに再接続して受信を続ける
+async def receive_with_reconnect(websocket):
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        if await receive_transcription_results(websocket):
+            return
+        if not st.session_state.get("job_id") or attempt == RECONNECT_ATTEMPTS:
+            break
+        await asyncio.sleep(2)
+        websocket = await ws_manager.connect()
+        if websocket is None or not await attach_job(websocket):
+            break
+    st.error("サーバーとの接続が切断されました")
 
 # 文字起こし処理のメイン非同期関数
-async def transcribe(model, button_save_audio, audio_file_path):  
+async def transcribe(model, button_save_audio, audio_file_path, parallel=False, tier="balanced", two_pass=False, word_timestamps=False,
+                     language="ja"):  
     # 進捗バーを初期化
     st.session_state.progress_text = "処理中です。お待ちください。"  
     st.session_state.progress_bar = st.progress(0, text=st.session_state.progress_text)  
@@ -113,8 +293,9 @@ async def transcribe(model, button_save_audio, audio_file_path):
         websocket = await ws_manager.connect()  
         if websocket:  
             # 文字起こしリクエストを送信し、結果を受信
-            if await send_transcribe_request(websocket, model, button_save_audio, audio_file_path):  
-                await receive_transcription_results(websocket)  
+            if await send_transcribe_request(websocket, model, button_save_audio, audio_file_path, parallel, tier, two_pass, word_timestamps,
+                                             language):  
+                await receive_with_reconnect(websocket)  
             else:  
                 st.error("リクエスト送信に失敗しました")  
         else:  
@@ -122,8 +303,12 @@ async def transcribe(model, button_save_audio, audio_file_path):
     except Exception as e:  
         st.error(f"エラー: {e}")  
     finally:  
-        # 後処理
-        await ws_manager.close()  
+        # 結果の受信を終えた時点で送信中の音声が残っていれば送信をやめる（アップロードに失敗した場合など）
+        upload_task = st.session_state.pop("upload_task", None)
+        if upload_task is not None and not upload_task.done():
+            upload_task.cancel()
+        # 後処理（停止ボタンが押された場合のみサーバー側のジョブも停止する）
+        await ws_manager.close(stop=st.session_state.stop_event.is_set())  
         st.session_state.stop_event.clear()  
         st.session_state.done_event.clear()  
 
@@ -131,33 +316,76 @@ async def transcribe(model, button_save_audio, audio_file_path):
     if 'progress_bar' in st.session_state:
         st.session_state.progress_bar.empty()  
 
+# 前回のジョブに再接続して結果の続きを受信する非同期関数
+async def resume(): 
+    st.session_state.progress_text = "処理中です。お待ちください。"  
+    st.session_state.progress_bar = st.progress(0, text=st.session_state.progress_text)  
+    try:  
+        websocket = await ws_manager.connect()  
+        if websocket and await attach_job(websocket):  
+            await receive_with_reconnect(websocket)  
+        else:  
+            st.error("サーバーとの接続に失敗しました")  
+    finally:  
+        await ws_manager.close(stop=st.session_state.stop_event.is_set())  
+        st.session_state.stop_event.clear()  
+        st.session_state.done_event.clear()  
+    st.session_state.progress_bar.empty()  
+
 # 文字起こし処理を実行する関数
-def process_transcription(model, button_save_audio, audio_file_path):
-    asyncio.run(transcribe(model, button_save_audio, audio_file_path))
+def process_transcription(model, button_save_audio, audio_file_path, parallel=False, tier="balanced", two_pass=False, word_timestamps=False,
+                          language="ja"):
+    asyncio.run(transcribe(model, button_save_audio, audio_file_path, parallel, tier, two_pass, word_timestamps, language))
+
+# サーバーの状態を確認する関数
+# 戻り値: ("ready" / "loading" / "down", /readyz の内容)。/readyz のない古いサーバーは応答があれば ready とみなす
+def check_server():
+    try:
+        response = requests.get(SERVER_URL + "/readyz", timeout=5)
+    except requests.RequestException:
+        return "down", {}
+    try:
+        readiness = response.json()
+    except ValueError:
+        readiness = {}
+    return ("loading" if response.status_code == 503 else "ready"), readiness
+
+# 文字起こし結果をクリアする関数
+def reset_transcript():
+    st.session_state.segments = []  # 受信したセグメントのテキスト（受信順）
+    st.session_state.export_job_id = None  # 結果のファイルをダウンロードできるジョブのID
+    st.session_state.transcript_digest = hashlib.sha256()  # 受信したテキストを連結したもののSHA-256
 
 # セッション状態の初期化
-if 'full_text_transcribe' not in st.session_state:  
-    st.session_state.full_text_transcribe = ""  # 文字起こし結果の全文
+if 'segments' not in st.session_state:  
+    reset_transcript()
 if 'done_event' not in st.session_state:  
     st.session_state.done_event = asyncio.Event()  # 文字起こし完了イベント
 if 'stop_event' not in st.session_state:  
     st.session_state.stop_event = asyncio.Event()  # 文字起こし停止イベント
+if 'job_id' not in st.session_state:  
+    st.session_state.job_id = None  # 実行中のジョブID（再接続用）
 if 'server_status' not in st.session_state:  
-    st.session_state.server_status = False  # サーバー接続状態
+    st.session_state.server_status = None  # サーバー接続状態（None: 未確認）
+    st.session_state.server_loading = False  # サーバーがモデルを読み込み中か
 
 # アプリのタイトル
 st.title("音声文字起こし")
 st.write('**Whisperを利用して音声データを文字起こしすることが出来ます。**')
 
-# サーバー接続状態のチェック
-if st.session_state.server_status == "":
+# サーバー接続状態のチェック（準備完了を確認できるまでは画面の再実行ごとに確認する）
+if st.session_state.server_status is not True or st.session_state.server_loading:
     with st.spinner("サーバーのチェック中..."):  
-        try:
-            # サーバーが起動しているか確認
-            requests.get("http://localhost:5001/")
-            st.session_state.server_status = True
-        except requests.ConnectionError:
-            st.session_state.server_status = False
+        status, readiness = check_server()
+    st.session_state.server_status = status != "down"
+    st.session_state.server_loading = status == "loading"
+    if status == "loading":
+        # 読み込み中に開始した文字起こしはサーバー側で読み込みの完了を待ってから処理される
+        if readiness.get("status") == "failed":
+            st.warning("サーバーでモデルの読み込みに失敗しました。文字起こしの開始時に再度読み込みます。", icon=":material/warning:")
+        else:
+            st.info(f"サーバーでモデルを読み込み中です（{round(readiness.get('progress', 0) * 100)}%）。"
+                    "開始した文字起こしは読み込みが終わり次第処理されます。", icon=":material/hourglass_top:")
 
 # サーバーが起動していない場合はエラーを表示して終了
 if st.session_state.server_status == False:
@@ -169,7 +397,7 @@ if st.session_state.server_status == True:
     # モデル選択ラジオボタン
     model = st.radio("model", ["汎用モデル", "チューニングモデル"])
     # 音声ファイルアップローダー
-    uploaded_file = st.file_uploader("音声ファイルをアップロードしてください", type=["mp3", "wav", "m4a", "mp4"], key="audio_file_trancribe")
+    uploaded_file = st.file_uploader("音声ファイルをアップロードしてください", type=["mp3", "wav", "flac", "m4a", "mp4"], key="audio_file_trancribe")
 
     if uploaded_file is not None:
         # アップロードされたファイルを一時ファイルとして保存
@@ -185,6 +413,24 @@ if st.session_state.server_status == True:
             st.subheader("ご協力ありがとうございます")
             st.balloons()
         
+        # 長時間の音声を無音区間で分割して並列に文字起こしするオプション
+        parallel = st.toggle("長時間の音声を分割して並列処理する", key="parallel_transcribe",
+                             help="無音区間で音声を分割し、複数のモデルで同時に文字起こしします。")
+
+        # 速度と精度のどちらを優先するか
+        tier = TIER_LABELS[st.radio("優先度", list(TIER_LABELS), horizontal=True, key="tier",
+                                    help="標準ではサーバーが混雑しているときのみ速いモデルで文字起こしします。")]
+        # 音声の言語（指定した方が言語判定を省略できるぶん速い）
+        language = LANGUAGE_LABELS[st.radio("音声の言語", list(LANGUAGE_LABELS), horizontal=True, key="language",
+                                            help="自動判定では音声の先頭から言語を判定してから文字起こしします。")]
+        # 速いモデルの下書きを先に表示し、精度の高い結果が届いたら置き換えるオプション
+        two_pass = st.toggle("下書きを先に表示する", key="two_pass",
+                             help="速いモデルで作った下書きをすぐに表示し、順番が来たら精度の高い結果に置き換えます。")
+
+        # 書き出すJSONに単語ごとのタイムスタンプを含めるオプション
+        word_timestamps = st.toggle("単語ごとのタイムスタンプを含める", key="word_timestamps",
+                                    help="ダウンロードするJSONに単語ごとの開始・終了時刻を含めます。処理が少し遅くなります。")
+
         # 文字起こし開始・停止ボタン
         col1, col2 = st.columns(2)  
         with col1:  
@@ -196,27 +442,43 @@ if st.session_state.server_status == True:
         if trans_start:  
             st.session_state.stop_event.clear()  
             st.session_state.done_event.clear()  
-            st.session_state.full_text_transcribe = ""  
-            process_transcription(model, button_save_audio, audio_file_path)  
+            reset_transcript()  
+            process_transcription(model, button_save_audio, audio_file_path, parallel, tier, two_pass, word_timestamps, language)  
+
+        # 前回のジョブが終わっていない場合（画面の再実行・切断など）は続きから受信できる
+        elif st.session_state.job_id and st.button("前回の文字起こしの続きを受信する"):  
+            asyncio.run(resume())  
 
         # 文字起こし停止ボタンが押された場合
         if trans_stop:  
             st.session_state.stop_event.set()  
+            # サーバー側で実行中のジョブも停止する
+            if st.session_state.job_id:  
+                try:
+                    requests.delete(f"{SERVER_URL}/jobs/{st.session_state.job_id}")
+                except requests.ConnectionError:
+                    pass
+                st.session_state.job_id = None  
             st.rerun()  # Streamlitを再実行して状態を更新
             
-    # 文字起こし結果がある場合に表示
-    if st.session_state.full_text_transcribe:
+    # 文字起こし結果がある場合に表示（全文は再実行ごとに1回だけ連結する）
+    full_text_transcribe = "".join(st.session_state.segments)
+    if full_text_transcribe:
         st.divider()
         col1, col2 = st.columns(2)
         with col1:
             # コピーボタン
-            copy_button = txt_copy(label="文字起こし結果をコピーする", text_to_copy=st.session_state.full_text_transcribe.replace("\\n", "\n"), key="text_clipboard")
+            copy_button = txt_copy(label="文字起こし結果をコピーする", text_to_copy=full_text_transcribe.replace("\\n", "\n"), key="text_clipboard")
             if copy_button:
                 st.toast("コピーしました！")
         with col2:
             # ダウンロードボタン
             audio_file_name = os.path.basename(audio_file_path).split(".")[0]
-            st.download_button(label="文字起こし結果をダウンロードする", data=st.session_state.full_text_transcribe, file_name=f"{audio_file_name}.txt", mime="text/plain")
+            st.download_button(label="文字起こし結果をダウンロードする", data=full_text_transcribe, file_name=f"{audio_file_name}.txt", mime="text/plain")
+        # サーバーが書き出した字幕・JSONファイル（結果全体をクライアントで組み立て直さずにダウンロードする）
+        if st.session_state.export_job_id:
+            for column, (label, fmt) in zip(st.columns(3), [("SRT", "srt"), ("WebVTT", "vtt"), ("JSON", "json")]):
+                column.link_button(f"{label}をダウンロードする", f"{SERVER_URL}/jobs/{st.session_state.export_job_id}/transcript.{fmt}")
         # 文字起こし結果の表示
         st.write("\n**文字起こし結果**")
-        st.write(st.session_state.full_text_transcribe)  
\ No newline at end of file
+        st.write(full_text_transcribe)  
\ No newline at end of file
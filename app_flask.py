@@ -1,6 +1,7 @@
 import streamlit as st
 import requests
 import time
+import json
 
 # 秒を「〇分〇秒」の形式に変換する関数
 def convert_seconds(seconds):
@@ -46,17 +47,42 @@ if audio_file:
         start_time = time.time()  # 処理開始時間を記録
         with st.spinner("**文字起こしを実行中...**"):
             try:
-                # サーバーにデータを送信して文字起こし実行をリクエスト
+                # サーバーにデータを送信して文字起こし実行をリクエスト（結果はセグメントごとに逐次受信）
                 response = requests.post(
                     server_url+"transcribe_server",
                     files={"audio": audio_file.getvalue()},  # 音声ファイルデータ
-                    data={"model": model,"save_audio":button_save_audio,"file_name":audio_file.name},  # 追加データ
+                    data={"model": model,"save_audio":button_save_audio,"file_name":audio_file.name,"stream":"ndjson"},  # 追加データ
+                    stream=True,
                 )
 
                 if response.status_code == 200:  # 成功の場合
+                    progress_bar = st.progress(0, text="文字起こし中です。")
+                    result_area = st.empty()  # 途中経過を表示する領域
+                    data = {"language": "", "language_probability": 0, "time_line": "", "full_text": ""}
+                    time_lines = []  # タイムスタンプ付きテキスト（行のリスト）
+                    texts = []  # 全文テキスト（行のリスト）
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        message = json.loads(line)
+                        if message.get("type") == "info":
+                            data["language"] = message["language"]
+                            data["language_probability"] = message["language_probability"]
+                        elif message.get("type") == "segment":
+                            time_lines.append(message["data"]["time_line"] + "  \n")
+                            texts.append(message["data"]["text"] + "\n")
+                            progress_bar.progress(min(message["progress"], 100), text="文字起こし中です。")
+                            result_area.markdown("".join(time_lines))
+                        elif message.get("type") == "error":
+                            st.error(f"エラー: {message['error']}")
+                            st.stop()
+                    progress_bar.empty()
+                    result_area.empty()
+                    data["time_line"] = "".join(time_lines)
+                    data["full_text"] = "".join(texts)
                     end_time = time.time()  # 処理終了時間を記録
                     st.session_state.execution_time = end_time - start_time  # 実行時間を計算
-                    st.session_state.transcribe_data = response.json()  # 結果データを保存
+                    st.session_state.transcribe_data = data  # 結果データを保存
                 else:
                     st.write("Error: ", response.text)  # エラーメッセージを表示
             except requests.ConnectionError:
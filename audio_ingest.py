@@ -0,0 +1,128 @@
+import os
+import gc
+import logging
+import threading
+import numpy as np
+import av
+from spool import SPOOL_DIR
+
+SAMPLING_RATE = 16000
+# デコード済みPCMを保存するディレクトリ
+PCM_DIR = os.path.join(SPOOL_DIR, "pcm")
+# デコード済みPCMを保存して再利用するか
+PCM_CACHE_ENABLED = os.environ.get("TRANSCRIBE_PCM_CACHE", "1") == "1"
+# 保存するPCMの合計サイズの上限（超えたら最終利用時刻の古いものから削除）
+PCM_MAX_BYTES = int(os.environ.get("TRANSCRIBE_PCM_MAX_BYTES", str(20 * 1024 ** 3)))
+# リサンプラーにまとめて渡すサンプル数
+_GROUP_SAMPLES = 500000
+
+# 同じ音声を同時にデコードしないためのロック（ハッシュごとに作ると増え続けるため、ハッシュで振り分けた固定数のロックを使う）
+_locks = [threading.Lock() for _ in range(64)]
+
+# s16のフレームを -1〜1 の float32 配列に変換する
+def _to_float32(frame):
+    return frame.to_ndarray().reshape(-1).astype(np.float32) / 32768.0
+
+# 音声コンテナから音声トラックのみを取り出し、16kHzモノラルのfloat32に変換しながら順に返す
+# 映像パケットはデコードせずに読み飛ばすため、mp4でも映像はメモリに載らない
+def stream_pcm(audio_file):
+    # faster_whisper.audio.decode_audio と同じ変換結果になるよう s16 でリサンプルしてから float32 に直す
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=SAMPLING_RATE)
+    fifo = av.audio.fifo.AudioFifo()
+    with av.open(audio_file, mode="r", metadata_errors="ignore") as container:
+        stream = container.streams.audio[0]
+        for packet in container.demux(stream):
+            try:
+                frames = packet.decode()
+            except av.error.InvalidDataError:
+                continue
+            for frame in frames:
+                frame.pts = None  # タイムスタンプの検証を行わない
+                fifo.write(frame)
+                if fifo.samples >= _GROUP_SAMPLES:
+                    for resampled in resampler.resample(fifo.read()):
+                        yield _to_float32(resampled)
+        if fifo.samples > 0:
+            for resampled in resampler.resample(fifo.read()):
+                yield _to_float32(resampled)
+        # リサンプラーに残ったサンプルを出力
+        for resampled in resampler.resample(None):
+            yield _to_float32(resampled)
+    # リサンプラー関連のオブジェクトを解放（faster_whisper.audio.decode_audio と同じ対処）
+    del resampler
+    gc.collect()
+
+# 音声の長さ（秒）をデコードせずにコンテナの情報から返す関数（分からない場合は None）
+def audio_duration(audio_file):
+    if isinstance(audio_file, np.ndarray):
+        return len(audio_file) / SAMPLING_RATE
+    try:
+        with av.open(audio_file, mode="r", metadata_errors="ignore") as container:
+            if container.duration is None:
+                return None
+            return container.duration / av.time_base
+    except Exception:
+        return None
+
+# デコードが中断されたことを表す例外
+class DecodeCancelled(Exception):
+    pass
+
+# 音声ファイルを16kHzモノラルのfloat32 PCMファイルにデコードする関数（メモリ使用量はチャンク数個分）
+# cancelled（threading.Event）がセットされると書きかけのファイルを削除して DecodeCancelled を送出する
+def decode_to_pcm(audio_file, pcm_path, cancelled=None):
+    partial_path = pcm_path + ".part"
+    samples = 0
+    try:
+        with open(partial_path, 'wb') as f:
+            for chunk in stream_pcm(audio_file):
+                if cancelled is not None and cancelled.is_set():
+                    raise DecodeCancelled()
+                f.write(chunk.tobytes())
+                samples += len(chunk)
+    except BaseException:
+        os.remove(partial_path)
+        raise
+    os.replace(partial_path, pcm_path)
+    logging.info(f"Decoded {samples / SAMPLING_RATE:.1f}s of audio to PCM")
+    return pcm_path
+
+# PCMファイルをメモリマップで開く（複数のジョブ・チャンクワーカーで共有できる）
+def load_pcm(pcm_path):
+    if os.path.getsize(pcm_path) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(pcm_path, dtype=np.float32, mode='r')
+
+# 音声のハッシュに対応するデコード済みPCMを返す関数（未デコードならデコードして保存する）
+def ensure_pcm(audio_hash, audio_file, cancelled=None):
+    os.makedirs(PCM_DIR, exist_ok=True)
+    pcm_path = os.path.join(PCM_DIR, audio_hash + ".f32")
+    # 同じ音声を同時にデコードしないようにする
+    with _locks[hash(audio_hash) % len(_locks)]:
+        if os.path.exists(pcm_path):
+            os.utime(pcm_path)
+        else:
+            decode_to_pcm(audio_file, pcm_path, cancelled)
+            evict_pcm(keep=pcm_path)
+    return load_pcm(pcm_path)
+
+# 合計サイズが上限を超えた分のPCMを最終利用時刻の古い順に削除する
+def evict_pcm(keep=None):
+    files = []
+    for name in os.listdir(PCM_DIR):
+        path = os.path.join(PCM_DIR, name)
+        if not name.endswith(".f32") or path == keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(files):
+        if total <= PCM_MAX_BYTES:
+            break
+        # メモリマップ中のファイルを削除しても、開いているジョブはそのまま読み続けられる
+        os.remove(path)
+        total -= size
+        logging.info(f"Evicted decoded PCM {os.path.basename(path)[:12]}")
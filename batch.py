@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import deque
+from model_pool import model_pool, DEFAULT_MODEL
+from scheduler import default_worker_count
+from spool import file_sha256
+from audio_ingest import audio_duration
+from transcribe_fastapi import transcribe, DECODE_OPTIONS, WORD_OPTIONS
+from export import TranscriptExport, EXPORT_FORMATS
+from metrics import JobTimer
+
+# 文字起こしの対象にする拡張子（ディレクトリを指定した場合）
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".m4a", ".mp4", ".ogg", ".opus", ".webm", ".aac")
+# 処理済みのファイルを記録するファイル（出力先ディレクトリに置く）
+STATE_FILE = "batch_state.jsonl"
+
+# ディレクトリ内の音声ファイル、またはマニフェスト（1行に1ファイルのパス。# で始まる行は無視）に書かれたファイルを返す関数
+# マニフェスト内の相対パスはマニフェストのあるディレクトリからのパスとして扱う
+# 戻り値: [(音声ファイルのパス, 出力ファイル名（拡張子なし・入力のディレクトリ構成を保つ）), ...]
+def collect_files(source):
+    if os.path.isdir(source):
+        files = []
+        for root, _, names in os.walk(source):
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    files.append(os.path.join(root, name))
+        base = source
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+        files = [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+    return [(path, os.path.splitext(os.path.relpath(path, base))[0]) for path in sorted(files)]
+
+# 処理状況の記録（1ファイルの処理が終わるたびに1行追記するので、途中で止まっても完了分は失われない）
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # {音声ファイルのパス: 最後の記録}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 書き込み途中で止まった行
+                    self.entries[entry["path"]] = entry
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() > 0:
+            self._file.write("\n")  # 書き込み途中で止まった行に追記しないように改行する
+
+    # 前回の実行で、同じ内容のファイルを最後まで処理済みかどうか
+    def is_done(self, path, stat):
+        entry = self.entries.get(path)
+        return (entry is not None and entry["status"] == "done"
+                and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime)
+
+    def record(self, entry):
+        self.entries[entry["path"]] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+# 1ファイルを文字起こしし、結果を字幕・JSONファイルに書き出す非同期関数（サーバーと同じ transcribe を使う）
+async def transcribe_file(path, name, args, model_key, options):
+    export = TranscriptExport(name, args.formats, args.output)
+    counts = {"segments": 0}
+    error = None
+
+    async def send(message):
+        nonlocal error
+        if message.get("type") == "segment":
+            counts["segments"] += 1
+        elif message.get("type") == "error":
+            error = message.get("message")
+        export.write(message)
+        return True
+
+    timer = JobTimer()
+    # 同じ音声・同じ設定の結果は結果キャッシュから書き出す
+    audio_hash = (await asyncio.to_thread(file_sha256, path)).hexdigest()
+    try:
+        await transcribe(path, send, lambda: False, audio_hash, timer=timer, model_key=model_key, options=options)
+    finally:
+        export.close("error")  # 完了の通知を書き出していれば何もしない
+    if error is not None:
+        raise RuntimeError(error)
+    return counts["segments"], timer.fields.get("cache_hit", False)
+
+# 音声ファイルを長い順に、ワーカー数分のモデルで並行して文字起こしする非同期関数
+async def run_batch(args):
+    files = collect_files(args.source)
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(args.output, STATE_FILE))
+
+    # 処理済みのファイルを除き、長いものから順に並べる（最後に長いファイルが1つだけ残ってワーカーが遊ぶのを防ぐ）
+    pending = []
+    skipped = 0
+    for path, name in files:
+        stat = os.stat(path)
+        if checkpoint.is_done(path, stat):
+            skipped += 1
+            continue
+        duration = await asyncio.to_thread(audio_duration, path)
+        pending.append((duration, stat, path, name))
+    pending.sort(key=lambda item: (item[0] or 0.0, item[1].st_size), reverse=True)
+    logging.info(f"{len(files)} files, {skipped} already done, {len(pending)} to transcribe with {args.workers} workers")
+
+    model_key = (args.model, args.device, args.compute_type)
+    options = WORD_OPTIONS if args.word_timestamps else DECODE_OPTIONS
+    # ワーカー数分のモデルを先に読み込み、最後まで使い回す
+    if pending:
+        loaded = [await asyncio.to_thread(model_pool.acquire, *model_key) for _ in range(min(args.workers, len(pending)))]
+        for key, model in loaded:
+            model_pool.release(key, model)
+
+    queue = deque(pending)
+    totals = {"transcribed": 0, "errors": 0, "audio_seconds": 0.0, "cache_hits": 0, "segments": 0}
+    error_samples = []
+
+    async def worker():
+        while queue:
+            duration, stat, path, name = queue.popleft()
+            started = time.monotonic()
+            entry = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "audio_seconds": duration}
+            try:
+                segments, cache_hit = await transcribe_file(path, name, args, model_key, options)
+            except Exception as e:
+                logging.error(f"Failed to transcribe {path}: {e}")
+                totals["errors"] += 1
+                error_samples.append(f"{path}: {e}")
+                checkpoint.record({**entry, "status": "error", "error": str(e), "seconds": round(time.monotonic() - started, 3)})
+                continue
+            seconds = time.monotonic() - started
+            totals["transcribed"] += 1
+            totals["audio_seconds"] += duration or 0.0
+            totals["cache_hits"] += int(cache_hit)
+            totals["segments"] += segments
+            checkpoint.record({**entry, "status": "done", "segments": segments, "seconds": round(seconds, 3)})
+            done = totals["transcribed"] + totals["errors"]
+            logging.info(f"[{done}/{len(pending)}] {name}: {duration or 0:.0f}s of audio in {seconds:.1f}s"
+                         + (f" (x{duration / seconds:.1f})" if duration and seconds > 0 else ""))
+
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.workers)))
+    finally:
+        checkpoint.close()
+    wall = time.monotonic() - start
+
+    return {
+        "files": len(files),
+        "skipped": skipped,
+        **totals,
+        "audio_seconds": round(totals["audio_seconds"], 3),
+        "error_samples": error_samples[:5],
+        "wall_seconds": round(wall, 3),
+        # 全体の実時間比（音声の合計秒数 / 経過時間）
+        "realtime_factor": round(totals["audio_seconds"] / wall, 3) if wall > 0 else None,
+        "workers": args.workers,
+        "model": "/".join(model_key),
+        "word_timestamps": args.word_timestamps,
+    }
+
+# ディレクトリ・マニフェスト内の音声をまとめて文字起こしするコマンド
+# 例: python batch.py recordings/ --output transcripts/ --workers 2
+#     python batch.py recordings/ --output transcripts/ --model fake （偽モデルで動作を確認する）
+# 途中で止まった場合は同じコマンドをもう一度実行すると、処理済みのファイルを飛ばして続きから処理する
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Transcribe every audio file in a directory or manifest")
+    parser.add_argument("source", help="directory to walk, or a manifest file with one audio path per line")
+    parser.add_argument("--output", required=True, help="directory for the transcripts and the checkpoint")
+    parser.add_argument("--workers", type=int, default=default_worker_count(), help="files transcribed at the same time (one model each)")
+    parser.add_argument("--model", default=DEFAULT_MODEL[0], help="faster-whisper model name or path, or 'fake' (no inference)")
+    parser.add_argument("--device", default=DEFAULT_MODEL[1])
+    parser.add_argument("--compute-type", default=DEFAULT_MODEL[2])
+    parser.add_argument("--formats", default=",".join(EXPORT_FORMATS), help="comma-separated output formats (srt, vtt, json)")
+    parser.add_argument("--word-timestamps", action="store_true", help="include word timings in the JSON output")
+    parser.add_argument("--segment-latency", type=float, default=0.05, help="seconds the fake model spends per segment")
+    parser.add_argument("--report", help="also write the JSON summary to this file")
+    args = parser.parse_args()
+    args.formats = tuple(fmt for fmt in args.formats.split(",") if fmt)
+    args.workers = max(1, args.workers)
+
+    # ワーカーごとに1つのモデルを常駐させる（CPUではコアをワーカー数で分ける）
+    model_pool.pool_size = args.workers
+    if args.model == "fake":
+        from benchmark import FakeWhisperModel
+        FakeWhisperModel.segment_latency = args.segment_latency
+        model_pool.factory = FakeWhisperModel
+
+    report = asyncio.run(run_batch(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
@@ -0,0 +1,179 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from types import SimpleNamespace
+import av
+import numpy as np
+from model_pool import model_pool
+from parallel import shift_segment
+
+SAMPLING_RATE = 16000
+# マイクロバッチ処理を有効にするか
+BATCHING_ENABLED = os.environ.get("TRANSCRIBE_BATCHING", "0") == "1"
+# 1バッチにまとめる音声区間（最大30秒）の数
+MAX_BATCH_SIZE = int(os.environ.get("TRANSCRIBE_BATCH_SIZE", "16"))
+# 最初の区間が届いてからバッチを締め切るまでの待ち時間（秒）
+MAX_WAIT = float(os.environ.get("TRANSCRIBE_BATCH_WAIT_MS", "50")) / 1000
+# バッチ処理の対象にする音声の長さの上限（秒）。これより長い音声は通常の逐次処理を行う
+MAX_AUDIO_SECONDS = float(os.environ.get("TRANSCRIBE_BATCH_MAX_AUDIO_SECONDS", "120"))
+# バッチ処理に使えないデコード設定（バッチ処理では常に無効）
+_UNSUPPORTED_OPTIONS = ("vad_filter", "prompt_reset_on_temperature", "condition_on_previous_text")
+
+# 複数のジョブから届いた音声区間をまとめて1回の推論で処理するバッチャー
+# 各ジョブの音声はVADで30秒以内の発話区間に分けられ、区間単位でバッチに詰められる
+class MicroBatcher:
+    def __init__(self, options, model_key=(), max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT):
+        # バッチ推論に渡すデコード設定
+        self.options = {key: value for key, value in options.items() if key not in _UNSUPPORTED_OPTIONS}
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.model_key = model_key
+        self._cond = threading.Condition()
+        self._pending = []  # [(ジョブ, 区間番号, 音声, 到着時刻)]
+        self._thread = None
+        self.counters = {"jobs": 0, "batches": 0, "windows": 0, "max_batch_size": 0}
+        self.batch_sizes = Counter()  # {バッチサイズ: 回数}
+
+    # 音声ファイルを文字起こしする（model.transcribe と同じく (セグメント, 情報) を返す）
+    # cancelled（threading.Event）がセットされると、まだバッチに入っていない区間を取り下げて空の結果を返す
+    def transcribe(self, audio_file, options, cancelled=None):
+        from faster_whisper.audio import decode_audio
+        from faster_whisper.vad import VadOptions, get_speech_timestamps
+        # デコード済みPCMが渡された場合はそのまま使う
+        audio = audio_file if isinstance(audio_file, np.ndarray) else decode_audio(audio_file, sampling_rate=SAMPLING_RATE)
+        duration = len(audio) / SAMPLING_RATE
+
+        # 1区間が30秒を超えないように発話区間を検出
+        speech = get_speech_timestamps(audio, VadOptions(max_speech_duration_s=30, min_silence_duration_ms=160))
+        job = SimpleNamespace(
+            remaining=len(speech),
+            offsets=[ts["start"] / SAMPLING_RATE for ts in speech],
+            segments=[],
+            error=None,
+            done=threading.Event(),
+        )
+        if not speech:
+            job.done.set()
+        else:
+            with self._cond:
+                self.counters["jobs"] += 1
+                now = time.monotonic()
+                for index, ts in enumerate(speech):
+                    self._pending.append((job, index, audio[ts["start"]:ts["end"]], now))
+                self._ensure_thread()
+                self._cond.notify_all()
+
+        while not job.done.wait(0.1):
+            if cancelled is not None and cancelled.is_set():
+                with self._cond:
+                    self._pending = [entry for entry in self._pending if entry[0] is not job]
+                return iter([]), SimpleNamespace(duration=duration, language=options.get("language"), language_probability=1.0)
+        if job.error is not None:
+            raise job.error
+        segments = sorted(job.segments, key=lambda segment: segment.start)
+        info = SimpleNamespace(duration=duration, language=options.get("language"), language_probability=1.0)
+        return iter(segments), info
+
+    def stats(self):
+        with self._cond:
+            batches = self.counters["batches"]
+            return {
+                **self.counters,
+                "pending": len(self._pending),
+                "average_batch_size": self.counters["windows"] / batches if batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            }
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+            self._thread.start()
+
+    # バッチを組み立てて推論を繰り返すループ
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                # 最初の区間の到着から max_wait 経つか、バッチが埋まるまで待つ
+                deadline = self._pending[0][3] + self.max_wait
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+            self._run_batch(batch)
+
+    # 区間をつなげた音声を、区間ごとのクリップとしてバッチ推論する
+    def _run_batch(self, batch):
+        from faster_whisper import BatchedInferencePipeline
+        audio = np.concatenate([window for _, _, window, _ in batch])
+        starts = []
+        clips = []
+        position = 0
+        for _, _, window, _ in batch:
+            starts.append(position / SAMPLING_RATE)
+            clips.append({"start": position / SAMPLING_RATE, "end": (position + len(window)) / SAMPLING_RATE})
+            position += len(window)
+
+        with self._cond:
+            self.counters["batches"] += 1
+            self.counters["windows"] += len(batch)
+            self.counters["max_batch_size"] = max(self.counters["max_batch_size"], len(batch))
+            self.batch_sizes[len(batch)] += 1
+
+        try:
+            with model_pool.model(*self.model_key) as model:
+                pipeline = BatchedInferencePipeline(model)
+                segments, _ = pipeline.transcribe(audio, clip_timestamps=clips, batch_size=len(batch), **self.options)
+                segments = list(segments)
+        except Exception as e:
+            logging.error(f"Batched inference failed: {e}")
+            for job, _, _, _ in batch:
+                job.error = e
+            segments = []
+
+        # セグメントを開始時刻から元のジョブに振り分け、ジョブ内の時刻に直す
+        for segment in segments:
+            index = max(0, bisect.bisect_right(starts, segment.start) - 1)
+            job, window_index, _, _ = batch[index]
+            shift = job.offsets[window_index] - starts[index]
+            job.segments.append(shift_segment(segment, shift))
+
+        for job, _, _, _ in batch:
+            job.remaining -= 1
+            if job.remaining == 0:
+                job.done.set()
+
+# 音声がバッチ処理の対象になる長さかどうかを、デコードせずにコンテナの情報から判定する関数
+def is_batchable(audio_file):
+    if isinstance(audio_file, np.ndarray):
+        return len(audio_file) / SAMPLING_RATE <= MAX_AUDIO_SECONDS
+    try:
+        with av.open(audio_file) as container:
+            if container.duration is None:
+                return False
+            return container.duration / av.time_base <= MAX_AUDIO_SECONDS
+    except Exception:
+        return False
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+# デコード設定ごとのバッチャーを返す（設定が異なるジョブは同じバッチに入れない）
+def get_batcher(options, model_key=()):
+    key = (repr(sorted(options.items())), model_key)
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = MicroBatcher(options, model_key)
+        return _batchers[key]
+
+# すべてのバッチャーの統計情報
+def batching_stats():
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    return {"enabled": BATCHING_ENABLED, "batchers": [batcher.stats() for batcher in batchers]}
@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import time
+import wave
+import socket
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+import numpy as np
+
+SAMPLING_RATE = 16000
+# 偽モデルが1セグメントとして返す音声の長さ（秒）
+FAKE_SEGMENT_SECONDS = 5.0
+
+# WhisperModel の代わりに使う偽モデル（GPUなしでサーバーの処理性能を測るため）
+# 音声の長さに応じたセグメントを、1つあたり segment_latency 秒かけて返す
+class FakeWhisperModel:
+    segment_latency = 0.05
+    load_seconds = 0.0
+
+    def __init__(self, name=None, device=None, compute_type=None, **kwargs):
+        time.sleep(self.load_seconds)
+
+    def transcribe(self, audio, **options):
+        duration = _audio_duration(audio)
+        count = max(1, int(np.ceil(duration / FAKE_SEGMENT_SECONDS)))
+
+        def segments():
+            for index in range(count):
+                time.sleep(self.segment_latency)
+                start = index * FAKE_SEGMENT_SECONDS
+                end = min(duration, start + FAKE_SEGMENT_SECONDS)
+                yield SimpleNamespace(id=index, start=start, end=end, text=f"セグメント{index}", words=None)
+
+        info = SimpleNamespace(language=options.get("language") or "ja", language_probability=1.0, duration=duration)
+        return segments(), info
+
+# 音声の長さ（秒）を返す関数（パス・デコード済み配列のどちらにも対応）
+def _audio_duration(audio):
+    if isinstance(audio, np.ndarray):
+        return len(audio) / SAMPLING_RATE
+    import av
+    with av.open(audio) as container:
+        return container.duration / av.time_base if container.duration else 0.0
+
+# ベンチマーク用の合成音声（1秒の発音と0.5秒の無音の繰り返し）をWAVで作成する関数
+# seed を変えると内容が変わるため、結果キャッシュにヒットしない
+def write_synthetic_audio(path, seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLING_RATE)) / SAMPLING_RATE
+    tone = 0.3 * np.sin(2 * np.pi * rng.uniform(150, 400) * t) * ((t % 1.5) < 1.0)
+    audio = tone + rng.normal(0, 0.005, len(t))
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLING_RATE)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
+    return path
+
+# ベンチマーク対象のサーバーをこのプロセス内で起動する（serve サブコマンド）
+def serve(args):
+    import model_pool
+    if args.model == "fake":
+        FakeWhisperModel.segment_latency = args.segment_latency
+        FakeWhisperModel.load_seconds = args.load_seconds
+        model_pool.model_pool.factory = FakeWhisperModel
+    else:
+        # 実モデル（CPU上のtinyなど）をデフォルトモデルの代わりに読み込む
+        model_pool.model_pool.factory = lambda *key: model_pool.load_whisper_model(args.model, "cpu", "int8")
+
+    if args.server == "fastapi":
+        import uvicorn
+        from server_fastapi import app
+        uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", ws_max_size=5 * 1024 ** 3)
+    else:
+        from server_flask import app
+        app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+# サーバーのポートが接続を受け付けるまで待つ関数
+def wait_for_port(port, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Server did not start within {timeout}s")
+
+# FastAPIサーバーがモデルの読み込みを終えるまで待つ関数（/readyz が 200 を返すまで）
+def wait_for_ready(port, process, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=5):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    raise TimeoutError(f"Server was not ready within {timeout}s")
+
+# FastAPIサーバーに WebSocket で1件の文字起こしを依頼し、計測値を返す関数
+# encoding が legacy 以外なら hello で送信形式を指定する（セグメントはまとめて届く）
+# pipelined=True ならアップロードの完了を待たずに文字起こしを始めてもらう
+# upload_rate（バイト/秒）を指定すると、その速度に合わせて音声を送る（遅い回線の再現）
+async def request_fastapi(port, audio_path, encoding="json", batch_interval=0.1, pipelined=False, upload_rate=0.0):
+    import websockets
+    with open(audio_path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    chunk_size = 1024 * 1024
+    arrivals = []
+    frames = 0
+    start = time.monotonic()
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws", max_size=None) as websocket:
+        if encoding != "legacy":
+            await websocket.send(json.dumps({"type": "hello", "encoding": encoding, "batch_interval": batch_interval}))
+            await websocket.recv()
+        await websocket.send(json.dumps({
+            "type": "upload", "model": "汎用モデル", "save_audio": False, "file_name": os.path.basename(audio_path),
+            "size": len(data), "offset": 0, "sha256": digest, "chunk_size": chunk_size, "pipelined": pipelined,
+        }))
+
+        # 結果は送信中にも届くので、送信は別タスクで行う
+        async def send_chunks():
+            for position in range(0, len(data), chunk_size):
+                await websocket.send(data[position:position + chunk_size])
+                if upload_rate > 0:
+                    await asyncio.sleep(chunk_size / upload_rate)
+
+        sender = asyncio.create_task(send_chunks())
+        async for message in websocket:
+            if isinstance(message, bytes):
+                import msgpack
+                message = msgpack.unpackb(message, raw=False)
+            else:
+                message = json.loads(message)
+            if message.get("type") == "segment":
+                arrivals.append(time.monotonic() - start)
+                frames += 1
+            elif message.get("type") == "segments":
+                arrivals.extend([time.monotonic() - start] * len(message["segments"]))
+                frames += 1
+            if "error" in message:
+                sender.cancel()
+                raise RuntimeError(message["error"])
+            if message.get("done"):
+                break
+        await sender
+    return arrivals, time.monotonic() - start, frames
+
+# Flaskサーバーに HTTP POST で1件の文字起こしを依頼し、計測値を返す関数
+def request_flask(port, audio_path):
+    import requests
+    start = time.monotonic()
+    arrivals = []
+    with open(audio_path, "rb") as f:
+        response = requests.post(
+            f"http://127.0.0.1:{port}/transcribe_server",
+            files={"audio": f},
+            data={"model": "汎用モデル", "save_audio": "False", "file_name": os.path.basename(audio_path), "stream": "ndjson"},
+            stream=True,
+        )
+    response.raise_for_status()
+    if "ndjson" in response.headers.get("Content-Type", ""):
+        # セグメントを逐次返す形式の場合は1行ごとに到着時刻を記録する
+        for line in response.iter_lines():
+            if line and json.loads(line).get("type") == "segment":
+                arrivals.append(time.monotonic() - start)
+        frames = len(arrivals)
+    else:
+        # 一括で返す形式の場合はすべてのセグメントが応答と同時に届く
+        body = response.json()
+        arrivals = [time.monotonic() - start] * max(1, body.get("time_line", "").count("\n"))
+        frames = 1
+    return arrivals, time.monotonic() - start, frames
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in (50, 90, 95, 99)} | {"max": round(float(values.max()), 4)}
+
+# クライアントを並列に動かして計測し、結果をまとめる関数
+async def run_load(args, port, audio_files):
+    results = []
+    errors = []
+
+    async def client(client_index):
+        for request_index in range(args.requests):
+            seconds, path = audio_files[(client_index + request_index) % len(audio_files)]
+            if not args.repeat_audio:
+                # リクエストごとに別の音声を使い、結果キャッシュを効かせない
+                path = write_synthetic_audio(path.replace(".wav", f"-{client_index}-{request_index}.wav"), seconds,
+                                             seed=client_index * 1000 + request_index + 1)
+            try:
+                if args.server == "fastapi":
+                    arrivals, total, frames = await request_fastapi(port, path, args.encoding, args.batch_interval,
+                                                                    args.pipelined, args.upload_rate)
+                else:
+                    arrivals, total, frames = await asyncio.to_thread(request_flask, port, path)
+                results.append({"audio_seconds": seconds, "arrivals": arrivals, "total": total, "frames": frames})
+            except Exception as e:
+                errors.append(str(e))
+
+    start = time.monotonic()
+    await asyncio.gather(*(client(index) for index in range(args.clients)))
+    wall = time.monotonic() - start
+
+    first = [r["arrivals"][0] for r in results if r["arrivals"]]
+    # セグメント間の到着間隔（ストリーミング時の1セグメントあたりの待ち時間）
+    gaps = [b - a for r in results for a, b in zip(r["arrivals"], r["arrivals"][1:])]
+    audio_seconds = sum(r["audio_seconds"] for r in results)
+    return {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "wall_seconds": round(wall, 3),
+        "time_to_first_segment": _percentiles(first),
+        "segment_latency": _percentiles(gaps),
+        "request_seconds": _percentiles([r["total"] for r in results]),
+        "throughput": {
+            "requests_per_second": round(len(results) / wall, 3) if wall else 0.0,
+            "audio_seconds_per_second": round(audio_seconds / wall, 3) if wall else 0.0,
+            "segments_per_second": round(sum(len(r["arrivals"]) for r in results) / wall, 3) if wall else 0.0,
+        },
+        # 1フレームあたりのセグメント数（まとめて送る効果）
+        "segments_per_frame": round(sum(len(r["arrivals"]) for r in results) / max(1, sum(r["frames"] for r in results)), 3),
+    }
+
+# サーバーを子プロセスで起動し、負荷をかけて結果をJSONで出力する（run サブコマンド）
+def run(args):
+    import resource
+    workdir = tempfile.mkdtemp(prefix="transcribe_bench_")
+    durations = [float(value) for value in args.durations.split(",")]
+    audio_files = [(seconds, write_synthetic_audio(os.path.join(workdir, f"audio-{int(seconds)}s.wav"), seconds))
+                   for seconds in durations]
+
+    # キャッシュや保存先はベンチマーク専用のディレクトリに分ける
+    env = {
+        **os.environ,
+        "TRANSCRIBE_SPOOL_DIR": os.path.join(workdir, "spool"),
+        "TRANSCRIBE_CACHE_PATH": os.path.join(workdir, "cache.sqlite3"),
+    }
+    command = [sys.executable, os.path.abspath(__file__), "serve", "--server", args.server, "--port", str(args.port),
+               "--model", args.model, "--segment-latency", str(args.segment_latency), "--load-seconds", str(args.load_seconds)]
+    process = subprocess.Popen(command, env=env, cwd=workdir if args.server == "flask" else None,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        started = time.monotonic()
+        wait_for_port(args.port, process)
+        startup = time.monotonic() - started
+        # FastAPIサーバーは接続を受け付けてからモデルを読み込むので、読み込みが終わるまで待って計測を始める
+        ready = None
+        if args.server == "fastapi":
+            wait_for_ready(args.port, process)
+            ready = time.monotonic() - started
+        load = asyncio.run(run_load(args, args.port, audio_files))
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    # 終了した子プロセス（サーバー）の最大常駐メモリ
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak_rss_bytes = peak_rss if platform.system() == "Darwin" else peak_rss * 1024
+    report = {
+        "server": args.server,
+        "model": args.model,
+        "fake_segment_latency": args.segment_latency if args.model == "fake" else None,
+        "encoding": args.encoding if args.server == "fastapi" else None,
+        "batch_interval": args.batch_interval if args.server == "fastapi" and args.encoding != "legacy" else None,
+        "pipelined": args.pipelined if args.server == "fastapi" else None,
+        "upload_rate": args.upload_rate or None,
+        "clients": args.clients,
+        "requests_per_client": args.requests,
+        "durations": durations,
+        "startup_seconds": round(startup, 3),
+        "ready_seconds": round(ready, 3) if ready is not None else None,
+        **load,
+        "server_peak_rss_bytes": peak_rss_bytes,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+# CPU推論の設定（計算精度・インスタンス数・スレッド数）ごとに実時間比を計測する（rtf サブコマンド）
+# インスタンス数分の文字起こしを同時に実行し、1本あたりと全体の実時間比（音声の秒数 / 処理時間）を出力する
+def rtf(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from faster_whisper import WhisperModel
+    from audio_ingest import stream_pcm
+    from model_pool import cpu_core_count
+    from transcribe_fastapi import DECODE_OPTIONS
+
+    audio_path = args.audio or write_synthetic_audio(os.path.join(tempfile.mkdtemp(prefix="transcribe_rtf_"), "audio.wav"), args.duration)
+    audio = np.concatenate(list(stream_pcm(audio_path)))
+    duration = len(audio) / SAMPLING_RATE
+    # 無音区間の検出で処理量が変わらないよう、音声全体をデコードする
+    options = {**DECODE_OPTIONS, "vad_filter": False}
+    cores = cpu_core_count()
+
+    def run_once(model, samples):
+        segments, _ = model.transcribe(samples, **options)
+        return sum(1 for _ in segments)
+
+    configurations = []
+    for compute_type in args.compute_types.split(","):
+        for instances in [int(value) for value in args.instances.split(",")]:
+            for threads in [int(value) for value in args.threads.split(",")]:
+                # 0 の場合はサーバーと同じく、コアをインスタンス数で分ける
+                cpu_threads = threads or max(1, cores // instances)
+                models = [WhisperModel(args.model, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+                          for _ in range(instances)]
+                with ThreadPoolExecutor(max_workers=instances) as executor:
+                    # 初回の推論はメモリの確保などで遅いので計測から除く
+                    list(executor.map(lambda model: run_once(model, audio[:5 * SAMPLING_RATE]), models))
+                    start = time.monotonic()
+                    list(executor.map(lambda model: run_once(model, audio), models))
+                    wall = time.monotonic() - start
+                del models
+                configuration = {
+                    "compute_type": compute_type,
+                    "instances": instances,
+                    "cpu_threads": cpu_threads,
+                    "oversubscribed": cpu_threads * instances > cores,
+                    "wall_seconds": round(wall, 3),
+                    "realtime_factor": round(duration / wall, 3),
+                    "aggregate_realtime_factor": round(instances * duration / wall, 3),
+                }
+                configurations.append(configuration)
+                print(json.dumps(configuration), file=sys.stderr)
+
+    report = {
+        "model": args.model,
+        "audio_seconds": round(duration, 3),
+        "cpu_cores": cores,
+        "configurations": configurations,
+        # 全体の実時間比が最も高い設定
+        "best": max(configurations, key=lambda c: c["aggregate_realtime_factor"]) if configurations else None,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the transcription servers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "serve"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--server", choices=["fastapi", "flask"], default="fastapi")
+        sub.add_argument("--port", type=int, default=5901)
+        sub.add_argument("--model", default="fake", help="'fake' or a faster-whisper model name run on CPU (e.g. tiny)")
+        sub.add_argument("--segment-latency", type=float, default=0.05, help="seconds the fake model spends per segment")
+        sub.add_argument("--load-seconds", type=float, default=0.0, help="seconds the fake model takes to load")
+    run_parser = subparsers.choices["run"]
+    run_parser.add_argument("--clients", type=int, default=4)
+    run_parser.add_argument("--requests", type=int, default=2, help="requests per client")
+    run_parser.add_argument("--durations", default="10,60,300", help="comma-separated synthetic audio lengths in seconds")
+    run_parser.add_argument("--repeat-audio", action="store_true", help="reuse the same audio so the result cache is hit")
+    run_parser.add_argument("--encoding", choices=["legacy", "json", "msgpack"], default="json",
+                            help="result framing requested by the FastAPI clients ('legacy' sends no hello)")
+    run_parser.add_argument("--batch-interval", type=float, default=0.1, help="seconds the server may batch segments for")
+    run_parser.add_argument("--pipelined", action="store_true", help="let the server transcribe while the audio is uploading")
+    run_parser.add_argument("--upload-rate", type=float, default=0.0, help="upload speed in bytes per second (0 = unlimited)")
+    run_parser.add_argument("--output", help="also write the JSON report to this file")
+    run_parser.add_argument("--verbose", action="store_true", help="show server logs")
+    rtf_parser = subparsers.add_parser("rtf", help="measure CPU real-time factor per compute type, instance count and thread count")
+    rtf_parser.add_argument("--model", default="small", help="faster-whisper model name or path")
+    rtf_parser.add_argument("--audio", help="audio file to transcribe (default: synthetic audio)")
+    rtf_parser.add_argument("--duration", type=float, default=60, help="length of the synthetic audio in seconds")
+    rtf_parser.add_argument("--compute-types", default="int8,int8_float32", help="comma-separated CTranslate2 compute types")
+    rtf_parser.add_argument("--instances", default="1,2", help="comma-separated numbers of concurrent model instances")
+    rtf_parser.add_argument("--threads", default="0", help="comma-separated cpu_threads per instance (0 = cores / instances)")
+    rtf_parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "rtf":
+        rtf(args)
+    else:
+        run(args)
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# テストで読み込むモジュールより先に設定する（スプール・キャッシュ・書き出しはテスト用の一時ディレクトリに置く）
+_tmp = tempfile.mkdtemp(prefix="transcribe_test_")
+os.environ["TRANSCRIBE_BATCHING"] = "0"
+os.environ["TRANSCRIBE_PRELOAD"] = "0"
+os.environ["TRANSCRIBE_SPOOL_DIR"] = os.path.join(_tmp, "spool")
+os.environ["TRANSCRIBE_CACHE_PATH"] = os.path.join(_tmp, "cache.sqlite3")
+os.environ["TRANSCRIBE_EXPORT_DIR"] = os.path.join(_tmp, "exports")
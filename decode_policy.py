@@ -0,0 +1,58 @@
+import os
+from metrics import metrics
+
+# デコード方針の選び方（adaptive: 混雑状況と品質の指定で選ぶ、fixed: 常に standard）
+DECODE_POLICY_MODE = os.environ.get("TRANSCRIBE_DECODE_POLICY", "adaptive")
+# 1ワーカーあたりの待機中のジョブ数がこれ以上なら混雑とみなし、ビーム幅を狭める
+BUSY_QUEUE_DEPTH = float(os.environ.get("TRANSCRIBE_BUSY_QUEUE_DEPTH", "1"))
+# 1ワーカーあたりの待機中のジョブ数がこれ以上ならピークとみなし、ビームサーチをやめる（貪欲デコード）
+PEAK_QUEUE_DEPTH = float(os.environ.get("TRANSCRIBE_PEAK_QUEUE_DEPTH", "3"))
+# クライアントが言語を指定しなかった場合の言語（auto なら言語を自動判定する）
+DEFAULT_LANGUAGE = os.environ.get("TRANSCRIBE_LANGUAGE", "ja")
+# クライアントが指定できる品質（fast: 速度優先、balanced: 混雑時のみ落とす、accurate: 精度優先）
+QUALITY_HINTS = ("fast", "balanced", "accurate")
+
+# デコード方針ごとに基本の設定を上書きする値
+# standard は基本の設定そのまま（ビーム幅5、faster-whisper 既定の温度フォールバック・VAD）
+POLICIES = {
+    # 小さい声も発話として残し、無音で切る間隔を長くする
+    "accurate": {"vad_parameters": {"threshold": 0.35, "min_silence_duration_ms": 2000}},
+    "standard": {},
+    # ビーム幅を狭め、温度フォールバックの段数を減らす
+    "reduced": {"beam_size": 2, "best_of": 2, "temperature": [0.0, 0.4, 0.8]},
+    # ビームサーチと温度フォールバックを行わず、無音をより多く取り除く
+    "greedy": {"beam_size": 1, "best_of": 1, "temperature": 0.0,
+               "vad_parameters": {"threshold": 0.6, "min_silence_duration_ms": 500}},
+}
+
+# 品質の指定と待機中のジョブ数から、デコード方針とその理由を返す関数
+# 品質ごとに 空き・混雑・ピーク のときの方針を決めている（accurate でもピーク時はビーム幅を狭める）
+def choose_policy(quality, queued, max_workers, mode=DECODE_POLICY_MODE):
+    if mode != "adaptive":
+        return "standard", "fixed"
+    if quality == "fast":
+        return "greedy", "fast hint"
+    load = queued / max(1, max_workers)
+    if load >= PEAK_QUEUE_DEPTH:
+        return ("reduced" if quality == "accurate" else "greedy"), "peak load"
+    if load >= BUSY_QUEUE_DEPTH:
+        return ("standard" if quality == "accurate" else "reduced"), "busy"
+    return ("accurate" if quality == "accurate" else "standard"), "idle"
+
+# 基本の設定にデコード方針と言語を反映した設定を返す関数
+# 言語を指定した場合は言語判定を行わない（auto・未指定で DEFAULT_LANGUAGE が auto の場合のみ判定する）
+def decode_options(base, policy, language=None):
+    language = language or DEFAULT_LANGUAGE
+    return {**base, **POLICIES[policy], "language": None if language == "auto" else language}
+
+# ジョブのデコード設定を決める関数（選んだ方針はメトリクスとジョブの計測記録に残す）
+# 戻り値: (デコード方針, 理由, 設定)
+def plan_decode(base, quality, language, queued, max_workers, timer=None):
+    if quality not in QUALITY_HINTS:
+        quality = "balanced"
+    policy, reason = choose_policy(quality, queued, max_workers)
+    options = decode_options(base, policy, language)
+    metrics.inc("transcribe_decode_policy_total", policy=policy)
+    if timer is not None:
+        timer.record(decode_policy=policy, quality=quality, beam_size=options.get("beam_size"), language=options["language"])
+    return policy, reason, options
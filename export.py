@@ -0,0 +1,113 @@
+import os
+import re
+import json
+import time
+import logging
+from spool import SPOOL_DIR
+
+# 書き出した文字起こし結果（字幕・JSON）を保存するディレクトリ
+EXPORT_DIR = os.environ.get("TRANSCRIBE_EXPORT_DIR", os.path.join(SPOOL_DIR, "exports"))
+# ジョブごとに書き出す形式
+EXPORT_FORMATS = tuple(fmt for fmt in os.environ.get("TRANSCRIBE_EXPORT_FORMATS", "srt,vtt,json").split(",") if fmt)
+# 書き出したファイルを保持する秒数
+EXPORT_TTL = float(os.environ.get("TRANSCRIBE_EXPORT_TTL", str(24 * 60 * 60)))
+# 形式ごとの Content-Type
+MEDIA_TYPES = {
+    "srt": "application/x-subrip; charset=utf-8",
+    "vtt": "text/vtt; charset=utf-8",
+    "json": "application/json",
+}
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# 秒数を字幕の時刻（時:分:秒 + ミリ秒）に変換する関数（SRTは区切りが ","、WebVTTは "."）
+def format_timestamp(seconds, separator=","):
+    milliseconds = int(round(max(seconds, 0.0) * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+# ジョブの書き出しファイルのパスを返す関数（形式・ジョブIDが不正なら None）
+def export_path(job_id, fmt, directory=EXPORT_DIR):
+    if fmt not in MEDIA_TYPES or not _JOB_ID_RE.match(job_id):
+        return None
+    return os.path.join(directory, f"{job_id}.{fmt}")
+
+# 1ジョブ分の結果を、セグメントが届くたびにファイルへ追記するクラス
+# ファイルは directory 内の「name.形式」（name にはサブディレクトリを含めてもよい。サーバーではジョブID）
+# 書き込み中は .part に書き、完了の通知で本来の名前に変える（ダウンロードできるのは最後まで書き終えたファイルのみ）
+# 結果全体をメモリに保持しないので、長時間の音声でも使用量はセグメント1つ分で済む
+class TranscriptExport:
+    def __init__(self, name, formats=EXPORT_FORMATS, directory=EXPORT_DIR):
+        self.paths = {fmt: os.path.join(directory, f"{name}.{fmt}") for fmt in formats if fmt in MEDIA_TYPES}
+        for path in self.paths.values():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._files = {fmt: open(path + ".part", "w", encoding="utf-8") for fmt, path in self.paths.items()}
+        self.segment_count = 0
+        self.info = {}
+        if "vtt" in self._files:
+            self._files["vtt"].write("WEBVTT\n\n")
+        if "json" in self._files:
+            self._files["json"].write('{"segments": [')
+
+    # ジョブのメッセージを受け取り、情報とセグメントを書き出す（それ以外のメッセージは無視する）
+    def write(self, message):
+        if not self._files:
+            return
+        kind = message.get("type")
+        if kind == "info":
+            self.info = {"language": message["language"], "language_probability": message["language_probability"]}
+        elif kind == "segment":
+            self._write_segment(message)
+        if message.get("done"):
+            # 完了・中止・エラーの通知を送った時点で書き終える（クライアントがすぐにダウンロードできるように）
+            self.close("done" if kind == "final" else "stopped" if kind == "stopped" else "error")
+
+    def _write_segment(self, message):
+        self.segment_count += 1
+        start, end, text = message["start"], message["end"], message["text"].strip()
+        files = self._files
+        if "srt" in files:
+            files["srt"].write(f"{self.segment_count}\n{format_timestamp(start, ',')} --> {format_timestamp(end, ',')}\n{text}\n\n")
+        if "vtt" in files:
+            files["vtt"].write(f"{format_timestamp(start, '.')} --> {format_timestamp(end, '.')}\n{text}\n\n")
+        if "json" in files:
+            segment = {"index": message.get("index", self.segment_count - 1), "start": start, "end": end, "text": message["text"]}
+            if message.get("words"):
+                segment["words"] = [{"start": word[0], "end": word[1], "word": word[2]} for word in message["words"]]
+            files["json"].write(("," if self.segment_count > 1 else "") + "\n" + json.dumps(segment, ensure_ascii=False))
+
+    # 書き出しを終える（status はジョブの終了状態。2回目以降の呼び出しは何もしない）
+    # 最後まで文字起こしできた（done）場合のみ本来の名前に変え、中止・エラーの場合は書きかけのファイルを削除する
+    def close(self, status):
+        if not self._files:
+            return
+        if status == "done" and "json" in self._files:
+            tail = {**self.info, "segment_count": self.segment_count, "status": status}
+            self._files["json"].write("\n], " + json.dumps(tail, ensure_ascii=False)[1:] + "\n")
+        for fmt, f in self._files.items():
+            f.close()
+            if status == "done":
+                os.replace(self.paths[fmt] + ".part", self.paths[fmt])
+            else:
+                try:
+                    os.remove(self.paths[fmt] + ".part")
+                except FileNotFoundError:
+                    pass
+        self._files = {}
+        if status == "done":
+            logging.info(f"Exported {self.segment_count} segments as {', '.join(self.paths)}")
+
+# 保持期間を過ぎた書き出しファイル（異常終了で残った .part を含む）を削除する関数
+def purge_exports(directory=EXPORT_DIR, ttl=EXPORT_TTL):
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
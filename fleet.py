@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+# ワーカーが状態を送る間隔（秒）
+HEARTBEAT_INTERVAL = float(os.environ.get("TRANSCRIBE_HEARTBEAT_INTERVAL", "2"))
+# この秒数のあいだ状態が届かないワーカーには振り分けない
+HEARTBEAT_TIMEOUT = float(os.environ.get("TRANSCRIBE_HEARTBEAT_TIMEOUT", "10"))
+# ワーカーが状態を送るコーディネーターのURL（未設定なら単独のサーバーとして動く）
+COORDINATOR_URL = os.environ.get("TRANSCRIBE_COORDINATOR_URL", "")
+# コーディネーターに知らせる自分の WebSocket のURL
+WORKER_URL = os.environ.get("TRANSCRIBE_WORKER_URL", f"ws://{socket.gethostname()}:5001/ws")
+# コーディネーターとワーカーで共有するトークン（ワーカーは状態に付けて送り、コーディネーターは一致しない状態を受け付けない）
+COORDINATOR_TOKEN = os.environ.get("TRANSCRIBE_COORDINATOR_TOKEN", "")
+
+# ワーカーが送る状態（振り分けに使う項目は必須。その他の項目は /workers での表示用にそのまま残す）
+class WorkerStatus(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    url: str
+    running: int = Field(ge=0)
+    queued: int = Field(ge=0)
+    max_workers: int = Field(ge=1)
+    warm_models: list[str]
+    ready: bool = True
+    encodings: list[str] = ["json"]
+
+    # ゲートウェイが接続できる WebSocket のURLか
+    @field_validator("url")
+    @classmethod
+    def check_url(cls, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("ws", "wss") or not parts.netloc:
+            raise ValueError("url must be a ws:// or wss:// URL")
+        return url
+
+# コーディネーター側で、ワーカーの状態（負荷・読み込み済みのモデル）を管理するクラス
+class WorkerRegistry:
+    def __init__(self, timeout=HEARTBEAT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._workers = {}  # {url: {'status': 最後に届いた状態, 'last_seen': 時刻, 'assigned': 状態が届いてから振り分けたジョブ数}}
+        self.counters = {"routed": 0, "warm_hits": 0, "no_worker": 0}
+
+    # ワーカーからの状態を記録する（WorkerStatus に合わない状態は pydantic.ValidationError を送出して記録しない）
+    def heartbeat(self, status):
+        status = WorkerStatus.model_validate(status).model_dump()
+        with self._lock:
+            if status["url"] not in self._workers:
+                logging.info(f"Worker {status['url']} joined")
+            # 状態には振り分け済みのジョブも含まれているので、振り分け数はリセットする
+            self._workers[status["url"]] = {"status": status, "last_seen": time.monotonic(), "assigned": 0}
+
+    # ワーカーの負荷（実行中・待機中・振り分け済みのジョブ数を実行枠の数で割ったもの）
+    @staticmethod
+    def _load(worker):
+        status = worker["status"]
+        return (status["running"] + status["queued"] + worker["assigned"]) / max(1, status["max_workers"])
+
+    def _healthy(self):
+        now = time.monotonic()
+        return {url: worker for url, worker in self._workers.items() if now - worker["last_seen"] <= self.timeout}
+
+    # モデル model を使うジョブの振り分け先を選ぶ（なければ None）
+    # 準備が終わっていて空きのあるワーカーのうち、モデルを読み込み済みのものを優先して、負荷が最も低いものを選ぶ
+    # 起動直後でモデルを読み込み中のワーカーには、他に振り分け先がない場合のみ振り分ける
+    def choose(self, model):
+        with self._lock:
+            workers = self._healthy()
+            if not workers:
+                self.counters["no_worker"] += 1
+                return None
+            url = min(workers, key=lambda url: (
+                not workers[url]["status"].get("ready", True),
+                self._load(workers[url]) >= 1,
+                model not in workers[url]["status"]["warm_models"],
+                self._load(workers[url]),
+            ))
+            worker = workers[url]
+            worker["assigned"] += 1
+            self.counters["routed"] += 1
+            if model in worker["status"]["warm_models"]:
+                self.counters["warm_hits"] += 1
+            return url
+
+    # 準備が終わっている稼働中のワーカー数
+    def ready_count(self):
+        with self._lock:
+            return sum(worker["status"].get("ready", True) for worker in self._healthy().values())
+
+    # 稼働中のすべてのワーカーが対応しているエンコード方式
+    def encodings(self):
+        with self._lock:
+            supported = None
+            for worker in self._healthy().values():
+                encodings = set(worker["status"].get("encodings", ["json"]))
+                supported = encodings if supported is None else supported & encodings
+            return sorted(supported or {"json"}, key=lambda encoding: encoding != "json")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                **self.counters,
+                "workers": [
+                    {**worker["status"], "assigned": worker["assigned"], "load": round(self._load(worker), 3),
+                     "seconds_since_heartbeat": round(now - worker["last_seen"], 1),
+                     "healthy": now - worker["last_seen"] <= self.timeout}
+                    for worker in self._workers.values()
+                ],
+            }
+
+# ワーカー側で、status() が返す状態をコーディネーターに定期的に送る非同期関数
+async def send_heartbeats(status, coordinator_url=COORDINATOR_URL, interval=HEARTBEAT_INTERVAL, token=COORDINATOR_TOKEN):
+    url = coordinator_url.rstrip("/") + "/workers/heartbeat"
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    connected = None
+    while True:
+        try:
+            body = json.dumps(status()).encode("utf-8")
+            request = urllib.request.Request(url, data=body, headers=headers)
+            await asyncio.to_thread(lambda: urllib.request.urlopen(request, timeout=5).close())
+            if connected is not True:
+                logging.info(f"Registered with coordinator {coordinator_url}")
+            connected = True
+        except Exception as e:
+            # コーディネーターが起動していない間も送り続ける（ログは状態が変わったときのみ）
+            if connected is not False:
+                logging.warning(f"Heartbeat to {coordinator_url} failed: {e}")
+            connected = False
+        await asyncio.sleep(interval)
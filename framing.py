@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import asyncio
+from transcribe_fastapi import convert_seconds
+from metrics import metrics
+
+try:
+    import msgpack  # バイナリ形式での送信（任意の依存パッケージ）
+except ImportError:
+    msgpack = None
+
+# セグメントを1フレームにまとめる間隔の既定値（秒）。hello で指定がない場合に使う
+BATCH_INTERVAL = float(os.environ.get("TRANSCRIBE_FRAME_BATCH_INTERVAL", "0.1"))
+# クライアントが指定できる間隔の上限（これ以上待つと逐次表示の意味がなくなる）
+MAX_BATCH_INTERVAL = 1.0
+# サーバーが対応しているエンコード方式
+ENCODINGS = ("json", "msgpack") if msgpack is not None else ("json",)
+# まとめて送るメッセージの種類と、まとめたフレームの種類
+BATCHED_TYPES = {"segment": "segments", "draft": "drafts"}
+
+# クライアントの hello（またはライブの start）メッセージから送信形式を決める関数
+# 対応していないエンコード方式が指定された場合は json にする
+def negotiate(request):
+    encoding = request.get("encoding", "json")
+    if encoding not in ENCODINGS:
+        encoding = "json"
+    try:
+        batch_interval = float(request.get("batch_interval", BATCH_INTERVAL))
+    except (TypeError, ValueError):
+        batch_interval = BATCH_INTERVAL
+    return encoding, min(max(batch_interval, 0.0), MAX_BATCH_INTERVAL)
+
+# セグメント・下書きのメッセージを従来の形式（整形済みの time_line とテキストを data に入れる）に変換する関数
+def legacy_message(message):
+    if message.get("type") not in BATCHED_TYPES:
+        return message
+    legacy = {key: value for key, value in message.items() if key != "text"}
+    legacy["data"] = {
+        "time_line": f"[{convert_seconds(message['start'])} -> {convert_seconds(message['end'])}] {message['text']}",
+        "text": message["text"],
+    }
+    return legacy
+
+# 1つの接続への送信を担当するクラス
+# encoding を指定しない場合は従来どおりメッセージごとにJSONで送る
+# 指定した場合、セグメントは {"type": "segments", "segments": [...]}、下書きは {"type": "drafts", "drafts": [...]} にまとめて送る
+# batch_interval 秒以内に続けて届いたセグメントは次のフレームにまとめ、その他のメッセージは溜まっているセグメントの後にすぐ送る
+class Framer:
+    def __init__(self, write, encoding=None, batch_interval=0.0):
+        self.write = write  # async write(フレーム) -> 送信できたかどうか（フレームは str または bytes）
+        self.encoding = encoding
+        self.batch_interval = batch_interval
+        self._pending = []  # まだ送信していないセグメント
+        self._last_flush = 0.0
+        self._flush_task = None
+        self._lock = asyncio.Lock()  # フレームの送信順を保つ
+        self._connected = True
+
+    # メッセージを送信する（送信できなかった場合は False を返す）
+    async def send(self, message):
+        if not self._connected:
+            return False
+        if self.encoding is not None and message.get("type") in BATCHED_TYPES:
+            self._pending.append(message)
+            if self._flush_task is None:
+                delay = self._last_flush + self.batch_interval - time.monotonic()
+                if delay <= 0:
+                    # 直前のフレームから間隔が空いていればすぐに送る（遅延を増やさない）
+                    return await self.flush()
+                self._flush_task = asyncio.create_task(self._flush_later(delay))
+            return True
+        async with self._lock:
+            return await self._flush_pending() and await self._write(message)
+
+    # 溜まっているセグメントを送信する
+    async def flush(self):
+        async with self._lock:
+            return await self._flush_pending()
+
+    # 予約している送信を取り消す（接続の終了時に呼ぶ）
+    def close(self):
+        self._connected = False
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def _flush_pending(self):
+        if not self._pending:
+            return self._connected
+        pending, self._pending = self._pending, []
+        self._last_flush = time.monotonic()
+        # 同じ種類が続く部分ごとに1フレームにまとめる（送信順は変えない）
+        start = 0
+        while start < len(pending):
+            kind = pending[start]["type"]
+            end = start
+            while end < len(pending) and pending[end]["type"] == kind:
+                end += 1
+            batch = pending[start:end]
+            start = end
+            if not await self._write({
+                "type": BATCHED_TYPES[kind],
+                BATCHED_TYPES[kind]: [{key: value for key, value in m.items() if key not in ("type", "progress", "done")} for m in batch],
+                "progress": batch[-1].get("progress", 0),
+                "done": False,
+            }):
+                return False
+        return True
+
+    async def _write(self, message):
+        if self.encoding is None:
+            frame = json.dumps(legacy_message(message), ensure_ascii=False)
+        elif self.encoding == "msgpack":
+            frame = msgpack.packb(message, use_bin_type=True)
+        else:
+            frame = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+        self._connected = await self.write(frame)
+        metrics.inc("transcribe_frames_sent_total", encoding=self.encoding or "legacy")
+        return self._connected
@@ -0,0 +1,307 @@
+import os
+import sys
+import hmac
+import json
+import asyncio
+import logging
+import argparse
+import secrets
+import tempfile
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+import websockets
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header
+from fastapi.responses import RedirectResponse, JSONResponse
+from starlette.websockets import WebSocketState
+from fleet import WorkerRegistry, WorkerStatus, COORDINATOR_TOKEN
+
+# ロギングの設定（INFOレベルに設定）
+logging.basicConfig(level=logging.INFO)
+# 複数の文字起こしサーバー（ワーカー）の前段に置くコーディネーター
+# クライアントとは server_fastapi と同じプロトコルで通信し、ジョブを振り分けたワーカーとの間でメッセージを中継する
+app = FastAPI()
+
+# ワーカーの状態
+registry = WorkerRegistry()
+# ジョブIDと、そのジョブを実行しているワーカーのURL（再接続・HTTPでの問い合わせの転送先）
+job_owners = OrderedDict()
+# 保持するジョブIDの上限（古いものから忘れる）
+MAX_JOB_OWNERS = 10000
+# model を指定しないメッセージ（probe など）で使うモデル種別
+DEFAULT_MODEL_LABEL = "汎用モデル"
+# ゲートウェイの待ち受けポート（server_flask の 5000・server_fastapi の 5001 と重ならないようにする）
+GATEWAY_PORT = 5080
+# ワーカーの登録に必要なトークン（未設定ならどのワーカーも登録しない。--spawn の場合は起動時に作る）
+heartbeat_token = COORDINATOR_TOKEN
+
+# ワーカーから状態（負荷・読み込み済みのモデル）を受け取るエンドポイント
+# トークンが一致しない場合は 401、状態の形式が誤っている場合は 422 を返す
+@app.post("/workers/heartbeat")
+async def worker_heartbeat(status: WorkerStatus, authorization: str = Header("")):
+    if not heartbeat_token:
+        raise HTTPException(status_code=403, detail="Set TRANSCRIBE_COORDINATOR_TOKEN on the gateway to accept workers")
+    if not hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {heartbeat_token}".encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid coordinator token")
+    registry.heartbeat(status.model_dump())
+    return {"ok": True}
+
+# ゲートウェイ自体が応答できるかを返すエンドポイント
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# ジョブを処理できる状態か（準備の終わったワーカーが1台以上あるか）を返すエンドポイント（なければ 503）
+@app.get("/readyz")
+async def readyz():
+    ready = registry.ready_count()
+    return JSONResponse({"ready": ready > 0, "ready_workers": ready, "workers": registry.stats()["workers"]},
+                        status_code=200 if ready else 503)
+
+# ワーカーの一覧と振り分けの統計情報を返すエンドポイント
+@app.get("/workers")
+async def worker_stats():
+    return registry.stats()
+
+# ジョブの状態を、ジョブを実行しているワーカーに問い合わせるエンドポイント
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, from_segment: int = 0):
+    return await forward_job_request("GET", job_id, f"?from_segment={from_segment}")
+
+# ジョブの結果のファイルは、ジョブを実行したワーカーからダウンロードしてもらう（Range による再開もワーカーが扱う）
+@app.get("/jobs/{job_id}/transcript.{fmt}")
+async def download_transcript(job_id: str, fmt: str):
+    worker_url = job_owners.get(job_id)
+    if worker_url is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return RedirectResponse(f"{http_url(worker_url)}/jobs/{job_id}/transcript.{fmt}", status_code=307)
+
+# ジョブを実行しているワーカーにジョブの停止を依頼するエンドポイント
+@app.delete("/jobs/{job_id}")
+async def stop_job(job_id: str):
+    return await forward_job_request("DELETE", job_id)
+
+# ワーカーの WebSocket のURLから HTTP のURLを作る関数（ws://host:5001/ws -> http://host:5001）
+def http_url(worker_url):
+    parts = urllib.parse.urlsplit(worker_url)
+    scheme = "https" if parts.scheme == "wss" else "http"
+    path = parts.path[:-len("/ws")] if parts.path.endswith("/ws") else parts.path
+    return urllib.parse.urlunsplit((scheme, parts.netloc, path.rstrip("/"), "", ""))
+
+# ジョブへのHTTPリクエストをワーカーに転送する関数
+async def forward_job_request(method, job_id, query=""):
+    worker_url = job_owners.get(job_id)
+    if worker_url is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    request = urllib.request.Request(f"{http_url(worker_url)}/jobs/{job_id}{query}", method=method)
+
+    def send():
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.load(response)
+
+    try:
+        return await asyncio.to_thread(send)
+    except urllib.error.HTTPError as e:
+        raise HTTPException(status_code=e.code, detail=e.reason)
+    except OSError as e:
+        raise HTTPException(status_code=502, detail=f"Worker unavailable: {e}")
+
+# ジョブを実行しているワーカーを記録する関数
+def remember_job(job_id, worker_url):
+    job_owners[job_id] = worker_url
+    job_owners.move_to_end(job_id)
+    while len(job_owners) > MAX_JOB_OWNERS:
+        job_owners.popitem(last=False)
+
+# 接続中の場合のみクライアントにJSONを送信する関数
+async def send_json_if_connected(websocket: WebSocket, message: dict):
+    try:
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_json(message)
+            return True
+    except (WebSocketDisconnect, RuntimeError):
+        logging.info(f"Client disconnected while sending message")
+    return False
+
+# クライアント1接続分の中継を行うクラス
+# 最初に probe / upload / transcribe を受け取った時点でワーカーを選び、以降はその接続をワーカーに中継する
+# attach はジョブを実行しているワーカーに中継する
+class ClientProxy:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.hello = None  # ワーカーに接続したときに送り直す hello
+        self.upstream = None  # ワーカーとの WebSocket 接続
+        self.upstream_url = None
+        self.relay = None  # ワーカーからのメッセージをクライアントに中継するタスク
+
+    async def run(self):
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                # アップロードのバイナリフレームは接続先のワーカーにそのまま送る
+                if self.upstream is not None:
+                    await self.upstream.send(message["bytes"])
+                continue
+            text = message["text"]
+            data = json.loads(text)
+            kind = data.get("type")
+            if kind == "hello" and self.upstream is None:
+                # ワーカーを選ぶ前なので、すべてのワーカーが対応している形式でゲートウェイが応答する
+                await self.handle_hello(data)
+                continue
+            if kind == "attach":
+                worker_url = job_owners.get(data.get("job_id"))
+                if worker_url is None:
+                    await send_json_if_connected(self.websocket, {"type": "error", "error": "Job not found", "done": True})
+                    continue
+                if worker_url != self.upstream_url and not await self.connect(worker_url):
+                    continue
+            elif self.upstream is None:
+                if kind == "stop":
+                    return  # 実行中のジョブはない
+                worker_url = registry.choose(data.get("model", DEFAULT_MODEL_LABEL))
+                if worker_url is None:
+                    await send_json_if_connected(self.websocket, {"type": "error", "error": "No transcription worker is available", "done": True})
+                    continue
+                if not await self.connect(worker_url):
+                    continue
+            await self.upstream.send(text)
+            if kind == "stop":
+                # ワーカーからの停止確認を中継し終わるまで待つ
+                await asyncio.wait([self.relay], timeout=15)
+                return
+
+    async def handle_hello(self, data):
+        encodings = registry.encodings()
+        encoding = data.get("encoding", "json")
+        if encoding not in encodings:
+            encoding = "json"
+        self.hello = {**data, "encoding": encoding}
+        reply = {"type": "hello", "encoding": encoding, "encodings": encodings, "done": False}
+        if "batch_interval" in data:
+            reply["batch_interval"] = data["batch_interval"]
+        await send_json_if_connected(self.websocket, reply)
+
+    # ワーカーに接続する（別のワーカーに接続中なら切り替える）
+    async def connect(self, worker_url):
+        await self.close()
+        try:
+            self.upstream = await websockets.connect(worker_url, max_size=None, ping_interval=20, ping_timeout=120)
+            if self.hello is not None:
+                await self.upstream.send(json.dumps(self.hello))
+                await self.upstream.recv()  # hello への応答はゲートウェイが返し済み
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            logging.error(f"Failed to connect to worker {worker_url}: {e}")
+            self.upstream = None
+            await send_json_if_connected(self.websocket, {"type": "error", "error": "Transcription worker is unavailable", "done": True})
+            return False
+        self.upstream_url = worker_url
+        self.relay = asyncio.create_task(self.relay_to_client(self.upstream, worker_url))
+        logging.info(f"Client routed to worker {worker_url}")
+        return True
+
+    # ワーカーからのフレームをクライアントに中継する（ジョブIDは再接続用に記録する）
+    async def relay_to_client(self, upstream, worker_url):
+        try:
+            async for frame in upstream:
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                    continue
+                if '"job_id"' in frame:
+                    data = json.loads(frame)
+                    if data.get("type") == "job":
+                        remember_job(data["job_id"], worker_url)
+                await self.websocket.send_text(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except (WebSocketDisconnect, RuntimeError):
+            return
+        if self.upstream is upstream:
+            # ワーカーが切断した場合はクライアントも同じコードで切断する（異常終了なら再接続（attach）してもらう）
+            logging.info(f"Worker {worker_url} closed the connection")
+            try:
+                await self.websocket.close(code=upstream.close_code or 1011)
+            except RuntimeError:
+                pass
+
+    async def close(self):
+        upstream, relay = self.upstream, self.relay
+        self.upstream = self.upstream_url = self.relay = None
+        if relay is not None:
+            relay.cancel()
+        if upstream is not None:
+            await upstream.close()
+
+# クライアント用のWebSocketエンドポイント（server_fastapi の /ws と同じプロトコル）
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    proxy = ClientProxy(websocket)
+    try:
+        await proxy.run()
+    except WebSocketDisconnect:
+        logging.info('Client disconnected')
+    except Exception as e:
+        logging.error(f"Proxy error: {e}", exc_info=True)
+    finally:
+        # ワーカーとの接続を閉じる（ジョブの扱いはワーカー側の切断時の処理に従う）
+        await proxy.close()
+
+# 1台のマシン上でワーカーを起動する関数（動作確認用。ワーカーごとに音声の保存先を分ける）
+def spawn_workers(count, base_port, coordinator_port, model):
+    workdir = tempfile.mkdtemp(prefix="transcribe_fleet_")
+    processes = []
+    for index in range(count):
+        port = base_port + index
+        directory = os.path.join(workdir, f"worker-{index}")
+        os.makedirs(directory)
+        env = {
+            **os.environ,
+            "TRANSCRIBE_COORDINATOR_URL": f"http://127.0.0.1:{coordinator_port}",
+            "TRANSCRIBE_WORKER_URL": f"ws://127.0.0.1:{port}/ws",
+            "TRANSCRIBE_SPOOL_DIR": os.path.join(directory, "spool"),
+            "TRANSCRIBE_CACHE_PATH": os.path.join(directory, "cache.sqlite3"),
+        }
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.py"), "serve",
+                   "--server", "fastapi", "--port", str(port), "--model", model]
+        processes.append(subprocess.Popen(command, env=env))
+        logging.info(f"Started worker {index} on port {port}")
+    return processes
+
+# サーバー起動のためのエントリーポイント
+# 例: python gateway.py --spawn 3 --model fake （偽モデルのワーカーを3つ起動して動作を確認する）
+if __name__ == '__main__':
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Coordinator that routes transcription jobs to worker servers")
+    parser.add_argument("--port", type=int, default=GATEWAY_PORT)
+    parser.add_argument("--spawn", type=int, default=0, help="start this many local workers (for testing)")
+    parser.add_argument("--worker-port", type=int, default=5101, help="port of the first spawned worker")
+    parser.add_argument("--model", default="fake", help="model of spawned workers: 'fake' or a faster-whisper model name run on CPU")
+    args = parser.parse_args()
+    if args.spawn and not heartbeat_token:
+        # 起動するワーカーにだけ知らせるトークンを作る
+        heartbeat_token = secrets.token_urlsafe(32)
+        os.environ["TRANSCRIBE_COORDINATOR_TOKEN"] = heartbeat_token
+    elif not heartbeat_token:
+        logging.warning("TRANSCRIBE_COORDINATOR_TOKEN is not set: no worker can register")
+    workers = spawn_workers(args.spawn, args.worker_port, args.port, args.model)
+    try:
+        uvicorn.run(
+            app,
+            host="0.0.0.0",  # すべてのネットワークインターフェースでリッスン
+            port=args.port,
+            ws_max_size=5 * 1024 * 1024 * 1024,  # WebSocketメッセージの最大サイズ（5GB、従来のBase64一括送信用）
+            timeout_keep_alive=500,  # キープアライブタイムアウト
+        )
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
@@ -0,0 +1,183 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from metrics import metrics
+
+# 終了したジョブの結果を保持する秒数
+JOB_TTL = float(os.environ.get("TRANSCRIBE_JOB_TTL", "3600"))
+# 受信しているクライアントがいなくなってから、再接続がなければジョブを中止するまでの秒数（0以下なら中止しない）
+ABANDON_TIMEOUT = float(os.environ.get("TRANSCRIBE_ABANDON_TIMEOUT", "120"))
+
+# 接続とは独立して実行される文字起こしジョブ
+# 送信されたメッセージはバッファに残り、再接続したクライアントに途中から再送できる
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = "queued"  # queued / running / done / stopped / error
+        self.stop = False  # 停止要求フラグ
+        self.cancel_reason = None  # stop / disconnect / abandoned
+        self.messages = []  # 再送用に保持するメッセージ
+        self.segment_count = 0
+        self.position = None  # 待機中の順番（再送はせず最新値のみ保持）
+        self.created = time.time()
+        self.finished = None
+        self.error = None  # 送信したエラーの内容（エラーを送ったジョブは error で終了する）
+        self.task = None
+        self.timer = None  # 処理段階ごとの所要時間（metrics.JobTimer）
+        self.export = None  # 結果を書き出すファイル（export.TranscriptExport）
+        self._subscribers = set()  # 接続中のクライアントごとの asyncio.Queue
+        self.detached = time.monotonic()  # 受信者がいなくなった時刻（受信者がいる間は None）
+
+    @property
+    def is_finished(self):
+        return self.finished is not None
+
+    # ジョブを中止する（待機中・デコード中のどちらでもタスクごと取り消す）
+    # デコード用スレッドは現在の窓のデコードを終えた時点で止まり、モデルをプールに返却する
+    def cancel(self, reason="stop"):
+        if self.is_finished or self.stop:
+            return False
+        self.stop = True
+        self.cancel_reason = reason
+        metrics.inc("transcribe_cancelled_jobs_total", reason=reason)
+        logging.info(f"Cancelling job {self.id} ({reason})")
+        if self.task is not None:
+            self.task.cancel()
+        return True
+
+    # HTTPでの問い合わせなど、ジョブの結果を待っているクライアントがいることを記録する
+    def touch(self):
+        if self.detached is not None:
+            self.detached = time.monotonic()
+
+    # ジョブからのメッセージを保存し、接続中のクライアントに配信する
+    async def emit(self, message):
+        if message.get("type") == "queued":
+            # 待機順は一時的な情報なのでバッファに残さない
+            self.position = message.get("position")
+        else:
+            if message.get("type") == "segment":
+                # セグメントに通し番号を付ける（再接続時の再開位置に使う）
+                message = {**message, "index": self.segment_count}
+                self.segment_count += 1
+            elif message.get("type") == "info":
+                self.status = "running"
+            if message.get("type") == "error" or message.get("error") is not None:
+                self.error = message.get("error") or message.get("message") or "error"
+            self.messages.append(message)
+            if self.export is not None:
+                self.export.write(message)
+        for queue in self._subscribers:
+            queue.put_nowait(message)
+        return True
+
+    # from_segment 番目以降のセグメントを受け取る（info などセグメント以外のメッセージは常に含む）
+    async def stream(self, from_segment=0):
+        queue = asyncio.Queue()
+        # バッファの取得と購読の登録を同じタイミングで行い、取りこぼしを防ぐ
+        backlog = [m for m in self.messages if m.get("type") != "segment" or m["index"] >= from_segment]
+        finished = self.is_finished
+        if not finished:
+            self._subscribers.add(queue)
+            self.detached = None
+        try:
+            for message in backlog:
+                yield message
+            while not finished:
+                message = await queue.get()
+                if message is None:
+                    break
+                yield message
+        finally:
+            self._subscribers.discard(queue)
+            if not self._subscribers and self.detached is None:
+                self.detached = time.monotonic()
+
+    # ジョブの状態（メッセージを除く）
+    def summary(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "segment_count": self.segment_count,
+            "position": self.position,
+            "created": self.created,
+            "finished": self.finished,
+            "cancel_reason": self.cancel_reason,
+            "error": self.error,
+            "timings": self.timer.summary() if self.timer else None,
+        }
+
+    def _finish(self, status):
+        self.status = status
+        self.finished = time.time()
+        if self.timer is not None:
+            self.timer.finish(status)
+        if self.export is not None:
+            self.export.close(status)
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+# ジョブを作成・検索するマネージャー
+class JobManager:
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._reaper = None
+
+    # run(job) を接続とは独立したタスクとして開始する
+    def create(self, run):
+        self._purge()
+        job = Job(uuid.uuid4().hex)
+        self._jobs[job.id] = job
+
+        async def runner():
+            try:
+                await run(job)
+                # キューが満杯・読み込みの待ち時間切れ・デコードの失敗などでエラーを送った場合
+                job._finish("error" if job.error is not None else "stopped" if job.stop else "done")
+            except asyncio.CancelledError:
+                # cancel() による中止（デコード用スレッドの終了とモデルの返却は transcribe 側で待っている）
+                await job.emit({"type": "stopped", "done": True})
+                job._finish("stopped")
+                if not job.stop:
+                    raise
+            except Exception as e:
+                logging.error(f"Job {job.id} failed: {e}", exc_info=True)
+                await job.emit({"type": "error", "error": str(e), "done": True})
+                job._finish("error")
+
+        job.task = asyncio.get_running_loop().create_task(runner())
+        if self._reaper is None and ABANDON_TIMEOUT > 0:
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_abandoned())
+        logging.info(f"Job {job.id} created")
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        statuses = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"jobs": len(self._jobs), "statuses": statuses}
+
+    # 受信者がいないまま一定時間経ったジョブを中止する（閉じられたタブのジョブでGPUを使い続けないため）
+    async def _reap_abandoned(self):
+        while True:
+            await asyncio.sleep(min(5.0, ABANDON_TIMEOUT))
+            now = time.monotonic()
+            for job in list(self._jobs.values()):
+                if not job.is_finished and job.detached is not None and now - job.detached > ABANDON_TIMEOUT:
+                    job.cancel("abandoned")
+
+    # 保持期間を過ぎた終了済みジョブを削除する
+    def _purge(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.is_finished and now - job.finished > self.ttl:
+                del self._jobs[job_id]
+
+# プロセス全体で共有するジョブマネージャー
+job_manager = JobManager()
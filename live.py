@@ -0,0 +1,281 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+import numpy as np
+from model_pool import model_pool
+from transcribe_fastapi import convert_seconds, final_message, DECODE_OPTIONS
+
+SAMPLING_RATE = 16000
+# 前回のデコードからこの秒数以上の音声が届いたら再デコードする
+MIN_CHUNK_SECONDS = float(os.environ.get("TRANSCRIBE_LIVE_MIN_CHUNK_SECONDS", "1.0"))
+# 確定済みの音声をバッファから切り捨て始める長さ（秒）
+BUFFER_TRIM_SECONDS = float(os.environ.get("TRANSCRIBE_LIVE_BUFFER_SECONDS", "15"))
+# バッファの最大長（Whisperの入力長30秒を超えないように、超えたら未確定分も確定させる）
+MAX_BUFFER_SECONDS = 28.0
+# 初期プロンプトに含める確定済みテキストの文字数
+PROMPT_CHARS = 200
+# 同時に行うライブ文字起こしのデコードの上限（ライブはジョブの実行枠を使わないため、スレッドとモデルを待つ数をここで抑える）
+MAX_LIVE_DECODES = max(1, int(os.environ.get("TRANSCRIBE_MAX_LIVE_DECODES", "2")))
+_live_slots = asyncio.Semaphore(MAX_LIVE_DECODES)
+
+# ライブ文字起こしの設定（タイムスタンプは単語単位で取得し、VADは自前で行う）
+LIVE_OPTIONS = {
+    "language": DECODE_OPTIONS["language"],
+    "beam_size": DECODE_OPTIONS["beam_size"],
+    "word_timestamps": True,
+    "condition_on_previous_text": False,
+    "vad_filter": False,
+}
+
+# 単語の比較用に空白と句読点を取り除く
+def _normalize(word):
+    return re.sub(r"[\s、。,.!?！？]", "", word)
+
+# クライアントから届いたPCM（s16le モノラル）を16kHzのfloat32に変換する関数
+def pcm_from_bytes(data, sample_rate=SAMPLING_RATE):
+    audio = np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32) / 32768.0
+    if sample_rate != SAMPLING_RATE and len(audio) > 0:
+        # 線形補間で16kHzに変換（音声認識には十分な精度）
+        length = int(round(len(audio) * SAMPLING_RATE / sample_rate))
+        audio = np.interp(np.linspace(0, len(audio) - 1, length), np.arange(len(audio)), audio).astype(np.float32)
+    return audio
+
+# スライディングウィンドウで音声を繰り返しデコードし、連続する2回の結果で一致した部分だけを確定するクラス
+# 確定した音声はバッファから切り捨てるため、確定済みのテキストが再デコードされることはない
+class LiveTranscriber:
+    def __init__(self, model_key=(), options=LIVE_OPTIONS):
+        self.model_key = model_key
+        self.options = options
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_offset = 0.0  # バッファ先頭の、ストリーム開始からの秒数
+        self.received = 0  # 受信したサンプル数
+        self.decoded = 0  # 前回のデコード時点での受信サンプル数
+        self.committed_end = 0.0  # 確定済みの最後の単語の終了時刻
+        self.committed_text = ""
+        self.hypothesis = []  # 前回のデコード結果のうち未確定の単語 [(開始, 終了, 単語)]
+        self.counters = {"passes": 0, "skipped": 0, "decode_seconds": 0.0}
+
+    @property
+    def pending_seconds(self):
+        return (self.received - self.decoded) / SAMPLING_RATE
+
+    @property
+    def stream_seconds(self):
+        return self.received / SAMPLING_RATE
+
+    # 受信した音声（16kHzモノラルのfloat32）をバッファに追加する
+    def insert_audio(self, audio):
+        self.buffer = np.concatenate([self.buffer, audio])
+        self.received += len(audio)
+
+    # バッファを再デコードし、(新たに確定したセグメントのリスト, 未確定のテキスト) を返す
+    def process(self):
+        from faster_whisper.vad import VadOptions, get_speech_timestamps
+        self.decoded = self.received
+        # 発話が含まれていなければデコードを省略し、未確定分を確定させて無音を捨てる
+        if not get_speech_timestamps(self.buffer, VadOptions(min_silence_duration_ms=300)):
+            self.counters["skipped"] += 1
+            committed = self._commit(self.hypothesis)
+            self.hypothesis = []
+            self._trim(self.buffer_offset + max(0.0, len(self.buffer) / SAMPLING_RATE - 0.5))
+            return committed, ""
+
+        words = self._decode()
+        # 2回連続で同じ結果になった先頭部分を確定する
+        agreed = 0
+        while (agreed < min(len(words), len(self.hypothesis))
+               and _normalize(words[agreed][2]) == _normalize(self.hypothesis[agreed][2])):
+            agreed += 1
+        committed = self._commit(words[:agreed])
+        self.hypothesis = words[agreed:]
+
+        if len(self.buffer) / SAMPLING_RATE > MAX_BUFFER_SECONDS:
+            # バッファが長くなりすぎた場合は未確定分も確定させる
+            committed += self._commit(self.hypothesis)
+            self.hypothesis = []
+            # 単語が得られず何も確定できなかった場合も、最大長を超えた古い音声は捨てる
+            self._trim(max(self.committed_end, self.buffer_offset + len(self.buffer) / SAMPLING_RATE - MAX_BUFFER_SECONDS))
+        elif len(self.buffer) / SAMPLING_RATE > BUFFER_TRIM_SECONDS:
+            self._trim(self.committed_end)
+        return committed, "".join(word for _, _, word in self.hypothesis)
+
+    # ストリーム終了時に残りの音声をデコードし、すべて確定させる
+    def finish(self):
+        from faster_whisper.vad import VadOptions, get_speech_timestamps
+        committed = []
+        if self.received > self.decoded or self.hypothesis:
+            if len(self.buffer) and get_speech_timestamps(self.buffer, VadOptions()):
+                self.hypothesis = self._decode()
+            committed = self._commit(self.hypothesis)
+            self.hypothesis = []
+        self.decoded = self.received
+        return committed
+
+    # バッファをデコードし、確定済みの時刻より後の単語を返す
+    def _decode(self):
+        start = time.monotonic()
+        prompt = self.committed_text[-PROMPT_CHARS:] or None
+        with model_pool.model(*self.model_key) as model:
+            segments, _ = model.transcribe(self.buffer, initial_prompt=prompt, **self.options)
+            words = [
+                (self.buffer_offset + word.start, self.buffer_offset + word.end, word.word)
+                for segment in segments
+                for word in (segment.words or [])
+            ]
+        self.counters["passes"] += 1
+        self.counters["decode_seconds"] += time.monotonic() - start
+        # 確定済みの区間と重なる単語は除く
+        return [word for word in words if word[0] >= self.committed_end - 0.1 and _normalize(word[2])]
+
+    # 単語列を1つのセグメントとして確定する
+    def _commit(self, words):
+        if not words:
+            return []
+        text = "".join(word for _, _, word in words).strip()
+        self.committed_end = words[-1][1]
+        self.committed_text += text
+        return [{"start": words[0][0], "end": words[-1][1], "text": text}]
+
+    # 指定時刻より前の音声をバッファから切り捨てる
+    def _trim(self, until):
+        cut = int((until - self.buffer_offset) * SAMPLING_RATE)
+        if cut <= 0:
+            return
+        self.buffer = self.buffer[cut:]
+        self.buffer_offset += cut / SAMPLING_RATE
+
+# ライブセッション全体の統計情報
+_stats_lock = threading.Lock()
+_stats = {"sessions": 0, "active": 0, "passes": 0, "skipped": 0, "decode_seconds": 0.0, "segments": 0, "latency_total": 0.0}
+
+def live_stats():
+    with _stats_lock:
+        segments = _stats["segments"]
+        return {
+            **{key: value for key, value in _stats.items() if key != "latency_total"},
+            # 確定時点で受信済みの音声の長さと、確定したセグメントの終了時刻の差の平均
+            "average_commit_lag": _stats["latency_total"] / segments if segments else 0.0,
+        }
+
+# 音声キューから受け取った音声を文字起こしし、結果を send(message) で送信する非同期関数
+# キューには16kHzモノラルのfloat32配列を入れ、ストリームの終わりに None を入れる
+async def live_transcribe(audio_queue, send, model_key=()):
+    transcriber = LiveTranscriber(model_key)
+    digest = hashlib.sha256()  # 確定したテキストを連結したもののSHA-256
+    count = 0
+    with _stats_lock:
+        _stats["sessions"] += 1
+        _stats["active"] += 1
+
+    async def send_committed(committed):
+        nonlocal count
+        for segment in committed:
+            digest.update(segment["text"].encode("utf-8"))
+            count += 1
+            with _stats_lock:
+                _stats["segments"] += 1
+                _stats["latency_total"] += max(0.0, transcriber.stream_seconds - segment["end"])
+            if not await send({"type": "segment", "start": segment["start"], "end": segment["end"], "text": segment["text"],
+                               "final": True, "done": False}):
+                return False
+        return True
+
+    try:
+        ended = False
+        while not ended:
+            # デコード中に届いた音声はまとめてバッファに追加する
+            item = await audio_queue.get()
+            while True:
+                if item is None:
+                    ended = True
+                    break
+                transcriber.insert_audio(item)
+                if audio_queue.empty():
+                    break
+                item = audio_queue.get_nowait()
+            if ended or transcriber.pending_seconds < MIN_CHUNK_SECONDS:
+                continue
+
+            before = dict(transcriber.counters)
+            # 空きを待つ間に届いた音声は、次のデコードでまとめて扱う
+            async with _live_slots:
+                committed, partial = await asyncio.to_thread(transcriber.process)
+            with _stats_lock:
+                for key in ("passes", "skipped", "decode_seconds"):
+                    _stats[key] += transcriber.counters[key] - before[key]
+            if not await send_committed(committed):
+                return
+            if not await send({"type": "partial", "text": partial, "done": False}):
+                return
+
+        # 残りの音声を確定して終了
+        before = dict(transcriber.counters)
+        async with _live_slots:
+            committed = await asyncio.to_thread(transcriber.finish)
+        with _stats_lock:
+            _stats["passes"] += transcriber.counters["passes"] - before["passes"]
+            _stats["decode_seconds"] += transcriber.counters["decode_seconds"] - before["decode_seconds"]
+        if not await send_committed(committed):
+            return
+        await send(final_message(count, digest))
+    finally:
+        with _stats_lock:
+            _stats["active"] -= 1
+
+# 音声ファイルを実時間で流し込み、ライブ文字起こしの確定遅延を計測する（オフライン検証用）
+# 例: python live.py sample.wav --model tiny --device cpu --compute-type int8
+async def replay(audio_file, frame_seconds=0.1, speed=1.0, model_key=()):
+    from audio_ingest import stream_pcm
+    audio = np.concatenate(list(stream_pcm(audio_file)) or [np.zeros(0, dtype=np.float32)])
+    queue = asyncio.Queue()
+    started = time.monotonic()
+    lags = []
+    texts = []
+
+    async def feed():
+        frame = int(frame_seconds * SAMPLING_RATE)
+        for position in range(0, len(audio), frame):
+            queue.put_nowait(audio[position:position + frame])
+            if speed > 0:
+                # 実時間（speed倍速）で次のフレームを送る
+                await asyncio.sleep(max(0.0, started + (position + frame) / SAMPLING_RATE / speed - time.monotonic()))
+            else:
+                await asyncio.sleep(0)
+        queue.put_nowait(None)
+
+    async def send(message):
+        now = time.monotonic() - started
+        if message["type"] == "segment":
+            # 発話の終わりが届いてから確定するまでの実時間
+            lag = now - message["end"] / (speed if speed > 0 else float("inf"))
+            lags.append(lag)
+            texts.append(message["text"])
+            print(f"{now:7.2f}s  lag {lag:5.2f}s  [{convert_seconds(message['start'])} -> {convert_seconds(message['end'])}] {message['text']}")
+        elif message["type"] == "final":
+            print(f"\n{''.join(texts)}")
+        return True
+
+    await asyncio.gather(feed(), live_transcribe(queue, send, model_key))
+    if lags:
+        print(f"\nsegments: {len(lags)}  average lag: {sum(lags) / len(lags):.2f}s  max lag: {max(lags):.2f}s")
+    print(live_stats())
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Replay an audio file through the live transcription pipeline")
+    parser.add_argument("audio_file")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--compute-type", default=None)
+    parser.add_argument("--frame-seconds", type=float, default=0.1)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed (0 = as fast as possible)")
+    args = parser.parse_args()
+    if not os.path.exists(args.audio_file):
+        sys.exit(f"{args.audio_file} not found")
+    asyncio.run(replay(args.audio_file, args.frame_seconds, args.speed, (args.model, args.device, args.compute_type)))
@@ -0,0 +1,188 @@
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# 処理段階ごとの所要時間のヒストグラムの区切り（秒）
+STAGE_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# 実時間比（音声の秒数 / 処理にかかった秒数）のヒストグラムの区切り
+REALTIME_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+# /metrics とは別に保持する直近のジョブの計測記録の件数
+RECENT_TIMINGS = 200
+
+# ジョブ単位の計測記録を1行のJSONで出力するロガー（集計ツールに取り込みやすくするため）
+timing_logger = logging.getLogger("transcribe.timing")
+
+# Prometheus のテキスト形式で出力できるカウンター・ヒストグラム・ゲージの集まり
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}  # {名前: (種類, 説明)}
+        self._counters = {}  # {(名前, ラベル): 値}
+        self._histograms = {}  # {(名前, ラベル): [区切りごとの件数, 合計, 件数]}
+        self._buckets = {}  # {名前: 区切り}
+        self._gauges = {}  # {名前: 値を返す関数}
+
+    def counter(self, name, help_text):
+        self._help[name] = ("counter", help_text)
+
+    def histogram(self, name, help_text, buckets=STAGE_BUCKETS):
+        self._help[name] = ("histogram", help_text)
+        self._buckets[name] = buckets
+
+    # 値を返す関数を登録する（数値、または {ラベルの辞書をタプル化したもの: 値} を返す）
+    def gauge(self, name, help_text, fn):
+        self._help[name] = ("gauge", help_text)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    # テキスト形式で出力する
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: [list(entry[0]), entry[1], entry[2]] for key, entry in self._histograms.items()}
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            elif kind == "histogram":
+                for (metric, labels), (counts, total, count) in histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(self._buckets[name], counts):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception as e:
+                    logging.error(f"Failed to read gauge {name}: {e}")
+                    continue
+                if isinstance(value, dict):
+                    for labels, item in value.items():
+                        lines.append(f"{name}{_labels(labels)} {_number(item)}")
+                else:
+                    lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+# プロセス全体で共有するメトリクス
+metrics = Metrics()
+metrics.histogram("transcribe_stage_seconds", "Time spent in each stage of a transcription job")
+metrics.histogram("transcribe_realtime_factor", "Audio seconds transcribed per wall-clock second", REALTIME_BUCKETS)
+metrics.counter("transcribe_jobs_total", "Finished transcription jobs by status")
+metrics.counter("transcribe_audio_seconds_total", "Seconds of audio transcribed")
+metrics.counter("transcribe_processing_seconds_total", "Wall-clock seconds spent decoding audio")
+metrics.counter("transcribe_cancelled_jobs_total", "Jobs cancelled before completion by reason")
+metrics.counter("transcribe_cancelled_audio_seconds_total", "Seconds of audio left undecoded because the job was cancelled")
+metrics.counter("transcribe_saved_compute_seconds_total", "Estimated decode seconds saved by cancelling jobs")
+metrics.counter("transcribe_frames_sent_total", "Result frames sent to WebSocket clients by encoding")
+metrics.counter("transcribe_decode_policy_total", "Jobs by the decode policy chosen for them")
+
+# 直近のジョブの計測記録
+recent_timings = deque(maxlen=RECENT_TIMINGS)
+
+# 1件のジョブの処理段階ごとの所要時間を記録するクラス（デコード用スレッドからも使える）
+class JobTimer:
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.started = time.time()
+        self.stages = {}  # {段階: 合計秒数}
+        self.fields = {}  # 音声の長さなどの付加情報
+        self._lock = threading.Lock()
+        self._finished = False
+
+    # with文で囲んだ処理の所要時間を段階 name として記録する
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        metrics.observe("transcribe_stage_seconds", seconds, stage=name)
+
+    def record(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    # デコードした音声の長さと所要時間から実時間比を記録する
+    def record_decode(self, audio_seconds, wall_seconds):
+        self.record(audio_seconds=round(audio_seconds, 3))
+        metrics.inc("transcribe_audio_seconds_total", audio_seconds)
+        metrics.inc("transcribe_processing_seconds_total", wall_seconds)
+        if wall_seconds > 0 and audio_seconds > 0:
+            self.record(realtime_factor=round(audio_seconds / wall_seconds, 3))
+            # デコード方針が決まっているジョブは方針ごとに集計する
+            policy = self.fields.get("decode_policy")
+            metrics.observe("transcribe_realtime_factor", audio_seconds / wall_seconds, **({"policy": policy} if policy else {}))
+
+    # 中断したジョブについて、デコードせずに済んだ音声の長さと推定処理時間を記録する
+    # 推定処理時間は中断までの処理速度で残りの音声を処理した場合の時間
+    def record_cancel(self, remaining_seconds, processed_seconds, wall_seconds):
+        remaining_seconds = max(0.0, remaining_seconds)
+        saved = remaining_seconds * wall_seconds / processed_seconds if processed_seconds > 0 else 0.0
+        self.record(cancelled_audio_seconds=round(remaining_seconds, 3), saved_compute_seconds=round(saved, 3))
+        metrics.inc("transcribe_cancelled_audio_seconds_total", remaining_seconds)
+        metrics.inc("transcribe_saved_compute_seconds_total", saved)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "started": self.started,
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                **self.fields,
+            }
+
+    # ジョブの終了時に計測記録を確定し、1行のJSONとして出力する
+    def finish(self, status):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            self.fields["status"] = status
+            self.fields["total_seconds"] = round(time.time() - self.started, 4)
+        metrics.inc("transcribe_jobs_total", status=status)
+        record = self.summary()
+        recent_timings.append(record)
+        timing_logger.info(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,117 @@
+import os
+import json
+import logging
+from model_pool import DEFAULT_MODEL
+from decode_policy import DEFAULT_LANGUAGE
+
+# モデル一覧の設定ファイル（JSON）。未設定の場合は DEFAULT_CATALOG を使う
+CATALOG_PATH = os.environ.get("TRANSCRIBE_MODEL_CATALOG", "")
+# チューニングモデル（CTranslate2形式に変換済みのディレクトリ）。未設定なら large-v3 を使う
+TUNED_MODEL = os.environ.get("TRANSCRIBE_TUNED_MODEL", "")
+# balanced のジョブで、結果が揃うまでの見込み時間がこれを超えたら速いモデルに切り替える（秒）
+LATENCY_BUDGET = float(os.environ.get("TRANSCRIBE_LATENCY_BUDGET", "300"))
+# クライアントが tier を指定しなかった場合の tier
+DEFAULT_TIER = os.environ.get("TRANSCRIBE_DEFAULT_TIER", "balanced")
+# 指定できる tier（fast: 速度優先、balanced: 混雑時のみ速いモデル、accurate: 常に指定のモデル）
+TIERS = ("fast", "balanced", "accurate")
+
+# 既定のモデル一覧（大きいモデルはデフォルトモデルと同じデバイス・計算精度で動かす）
+# speed は1秒の処理で文字起こしできる音声の秒数の目安（見込み時間の計算に使う）
+_on_gpu = DEFAULT_MODEL[1] == "cuda"
+DEFAULT_CATALOG = {
+    "models": {
+        "large-v3": {"name": DEFAULT_MODEL[0], "device": DEFAULT_MODEL[1], "compute_type": DEFAULT_MODEL[2],
+                     "speed": 25 if _on_gpu else 1.5},
+        "tuned-large-v3": {"name": TUNED_MODEL or DEFAULT_MODEL[0], "device": DEFAULT_MODEL[1], "compute_type": DEFAULT_MODEL[2],
+                           "speed": 25 if _on_gpu else 1.5},
+        "large-v3-turbo": {"name": "large-v3-turbo", "device": DEFAULT_MODEL[1], "compute_type": DEFAULT_MODEL[2],
+                           "speed": 60 if _on_gpu else 3},
+        "small-cpu-int8": {"name": "small", "device": "cpu", "compute_type": "int8", "speed": 8},
+    },
+    # クライアントが指定するモデル種別ごとに、精度重視で使うモデル
+    "labels": {"汎用モデル": "large-v3", "チューニングモデル": "tuned-large-v3"},
+    # 速度優先・混雑時に使うモデル（優先順）
+    "fast": ["large-v3-turbo", "small-cpu-int8"],
+    # 二段階モードで先に下書きを作るモデル（GPUの実行枠を使わないようにCPUのモデルにしている）
+    "draft": "small-cpu-int8",
+}
+
+# モデルが文字起こしできる言語を返す関数（None ならすべての言語）
+# モデル一覧の languages で指定でき、未指定なら英語専用のモデル（*.en・distil-*）かどうかを名前から判断する
+def model_languages(model):
+    if model.get("languages"):
+        return tuple(model["languages"])
+    name = os.path.basename(str(model["name"]).rstrip("/"))
+    if name.endswith(".en") or name.startswith("distil-"):
+        return ("en",)
+    return None
+
+# モデル一覧と、ジョブごとに使うモデルを選ぶ規則
+# language はジョブが言語を指定しなかった場合の言語。精度重視のモデルはこの言語に対応していなければならず、
+# 対応していない速いモデル・下書きのモデルは使わない
+class ModelCatalog:
+    def __init__(self, config, language=DEFAULT_LANGUAGE):
+        self.models = config["models"]
+        self.labels = config["labels"]
+        self.language = language
+        for label, name in self.labels.items():
+            if name not in self.models:
+                raise ValueError(f"Model '{name}' for '{label}' is not in the catalog")
+            if not self.supports(name, language):
+                raise ValueError(f"Model '{name}' for '{label}' does not support language '{language}'")
+        self.fast = [name for name in config.get("fast", []) if name in self.models and self._check_language(name)]
+        draft = config.get("draft")
+        self.draft = draft if draft in self.models and self._check_language(draft) else None
+
+    # モデルが language を文字起こしできるか（auto の場合は多言語のモデルのみ）
+    def supports(self, name, language=None):
+        languages = model_languages(self.models[name])
+        return languages is None or (language or self.language) in languages
+
+    def _check_language(self, name):
+        if self.supports(name):
+            return True
+        logging.warning(f"Model '{name}' does not support language '{self.language}' and is not used")
+        return False
+
+    # モデル一覧のモデルを ModelPool のキー（名前, デバイス, 計算精度）に変換する
+    def key(self, name):
+        model = self.models[name]
+        return (model["name"], model["device"], model["compute_type"])
+
+    # CPUで動くモデルのキー（同じモデルを指す名前は1つと数える）
+    def cpu_keys(self):
+        return {self.key(name) for name, model in self.models.items() if model["device"] == "cpu"}
+
+    # 結果が揃うまでの見込み時間（待機中のジョブも同じ長さと見なす）
+    def estimate(self, name, duration, queued, max_workers):
+        return (queued / max(1, max_workers) + 1) * duration / self.models[name]["speed"]
+
+    # モデル種別 label・tier・音声の長さ・待機中のジョブ数から、使うモデルとその理由を返す
+    # 速いモデルはジョブの言語 language に対応しているものだけを使う
+    def choose(self, label, tier, duration, queued, max_workers, language=None):
+        accurate = self.labels[label]
+        fast = [name for name in self.fast if self.supports(name, language)]
+        if tier == "accurate" or not fast:
+            return accurate, "requested"
+        if tier == "fast":
+            return fast[0], "fast tier"
+        if duration is None or self.estimate(accurate, duration, queued, max_workers) <= LATENCY_BUDGET:
+            return accurate, "within budget"
+        # 見込み時間が予算に収まる最初のモデル（なければ最も速いモデル）
+        for name in fast:
+            if self.estimate(name, duration, queued, max_workers) <= LATENCY_BUDGET:
+                return name, "over budget"
+        return max(fast, key=lambda name: self.models[name]["speed"]), "over budget"
+
+# 設定ファイルがあれば読み込み、なければ既定のモデル一覧を使う関数
+def load_catalog(path=CATALOG_PATH):
+    if not path:
+        return ModelCatalog(DEFAULT_CATALOG)
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    logging.info(f"Loaded model catalog from {path}")
+    return ModelCatalog(config)
+
+# プロセス全体で共有するモデル一覧
+model_catalog = load_catalog()
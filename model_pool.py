@@ -0,0 +1,184 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 推論に使うデバイス（auto ならGPUがあれば cuda、なければ cpu）
+DEVICE = os.environ.get("TRANSCRIBE_DEVICE", "auto")
+# 計算精度（未設定なら cuda は float16、cpu は int8。CPUでは int8_float32 なども指定できる）
+COMPUTE_TYPE = os.environ.get("TRANSCRIBE_COMPUTE_TYPE", "")
+# CPUで推論する場合の1インスタンスあたりのスレッド数（0ならCPUコアを同時に動くインスタンス数で分ける）
+CPU_THREADS = int(os.environ.get("TRANSCRIBE_CPU_THREADS", "0"))
+# 1インスタンスで並行して実行できる推論の数（CTranslate2 の num_workers）
+NUM_WORKERS = max(1, int(os.environ.get("TRANSCRIBE_NUM_WORKERS", "1")))
+
+# 使用できるGPUの数を返す関数
+def cuda_device_count():
+    try:
+        import ctranslate2
+        return ctranslate2.get_cuda_device_count()
+    except Exception:
+        return 0
+
+# このプロセスが使えるCPUコア数を返す関数（taskset などで制限されている場合はその数）
+def cpu_core_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+_device = DEVICE if DEVICE != "auto" else ("cuda" if cuda_device_count() > 0 else "cpu")
+
+# デフォルトのモデル設定（モデル名, デバイス, 計算精度）
+DEFAULT_MODEL = (
+    os.environ.get("TRANSCRIBE_MODEL", "large-v3"),
+    _device,
+    COMPUTE_TYPE or ("float16" if _device == "cuda" else "int8"),
+)
+
+# 同一モデルを同時に貸し出せるインスタンス数
+POOL_SIZE = int(os.environ.get("TRANSCRIBE_POOL_SIZE", "1"))
+# メモリ上に保持するモデル種別数の上限（超えたらLRUで破棄）
+MAX_MODELS = int(os.environ.get("TRANSCRIBE_MAX_MODELS", "2"))
+# 未使用のまま保持する秒数（0以下なら無期限）
+IDLE_TTL = float(os.environ.get("TRANSCRIBE_MODEL_IDLE_TTL", "0"))
+
+# CPUで推論する場合の1インスタンスあたりのスレッド数を返す関数
+# 同時に動くインスタンス（CPUのモデル種別数 × プールの同時実行数 × num_workers）でコアを分け、スレッド数の合計がコア数を超えないようにする
+# CPUのモデル種別数はメモリに保持できる種別数（max_models）までで数える
+def cpu_threads_per_instance(pool_size=None):
+    if CPU_THREADS > 0:
+        return CPU_THREADS
+    pool_size = pool_size or model_pool.pool_size
+    variants = max(1, min(model_pool.cpu_variants, model_pool.max_models))
+    return max(1, cpu_core_count() // (variants * pool_size * NUM_WORKERS))
+
+# モデルを実際に読み込む関数（faster_whisper は読み込みに時間がかかるので、最初のモデルの読み込み時にimportする）
+def load_whisper_model(name, device, compute_type):
+    from faster_whisper import WhisperModel
+    if device == "cpu":
+        return WhisperModel(name, device=device, compute_type=compute_type,
+                            cpu_threads=cpu_threads_per_instance(), num_workers=NUM_WORKERS)
+    return WhisperModel(name, device=device, compute_type=compute_type, num_workers=NUM_WORKERS)
+
+# WhisperModelをプロセス内で共有するプール
+class ModelPool:
+    def __init__(self, pool_size=POOL_SIZE, max_models=MAX_MODELS, idle_ttl=IDLE_TTL, factory=load_whisper_model):
+        self.pool_size = max(1, pool_size)
+        self.max_models = max(1, max_models)
+        self.idle_ttl = idle_ttl
+        self.factory = factory  # モデル生成関数（テストやベンチマークで差し替え可能）
+        self.cpu_variants = 1  # 同時に使われうるCPUのモデル種別数（サーバーがモデル一覧から設定する）
+        self._cond = threading.Condition()
+        # {key: {'idle': [model, ...], 'busy': int, 'last_used': float}}（先頭ほど古い）
+        self._entries = OrderedDict()
+        self.counters = {"loads": 0, "hits": 0, "misses": 0, "waits": 0, "evictions": 0}
+
+    # モデルを1つ借りる（使い終わったら release で返却する）
+    def acquire(self, name=None, device=None, compute_type=None):
+        key = (name or DEFAULT_MODEL[0], device or DEFAULT_MODEL[1], compute_type or DEFAULT_MODEL[2])
+        with self._cond:
+            while True:
+                self._evict_expired()
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = {"idle": [], "busy": 0, "last_used": time.monotonic()}
+                    self._entries[key] = entry
+                self._entries.move_to_end(key)
+                if entry["idle"]:
+                    # 読み込み済みのインスタンスを再利用
+                    self.counters["hits"] += 1
+                    entry["busy"] += 1
+                    return key, entry["idle"].pop()
+                if entry["busy"] < self.pool_size:
+                    # 空き枠があるので新規に読み込む（読み込み自体はロック外で行う）
+                    self.counters["misses"] += 1
+                    entry["busy"] += 1
+                    break
+                # すべて貸し出し中なら返却を待つ
+                self.counters["waits"] += 1
+                self._cond.wait()
+
+        try:
+            start = time.monotonic()
+            model = self.factory(*key)
+            logging.info(f"Loaded model {key} in {time.monotonic() - start:.1f}s")
+        except Exception:
+            with self._cond:
+                entry["busy"] -= 1
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self.counters["loads"] += 1
+            self._evict_lru()
+        return key, model
+
+    # 借りたモデルをプールに返却する
+    def release(self, key, model):
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                # 既に破棄されたモデル種別なら保持しない
+                return
+            entry["busy"] -= 1
+            entry["idle"].append(model)
+            entry["last_used"] = time.monotonic()
+            self._evict_lru()
+            self._cond.notify_all()
+
+    # with文で使うためのヘルパー
+    @contextmanager
+    def model(self, name=None, device=None, compute_type=None):
+        key, model = self.acquire(name, device, compute_type)
+        try:
+            yield model
+        finally:
+            self.release(key, model)
+
+    # サーバー起動時などに事前にモデルを読み込む
+    def preload(self, name=None, device=None, compute_type=None):
+        key, model = self.acquire(name, device, compute_type)
+        self.release(key, model)
+
+    # 統計情報を返す
+    def stats(self):
+        with self._cond:
+            return {
+                **self.counters,
+                "pool_size": self.pool_size,
+                "cpu_threads": cpu_threads_per_instance(self.pool_size),
+                "num_workers": NUM_WORKERS,
+                "models": [
+                    {"name": key[0], "device": key[1], "compute_type": key[2],
+                     "idle": len(entry["idle"]), "busy": entry["busy"]}
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+    # 上限を超えた分のモデルを古い順に破棄する（貸し出し中のものは対象外）
+    def _evict_lru(self):
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_models:
+                break
+            if self._entries[key]["busy"] == 0:
+                self._drop(key)
+
+    # 一定時間使われていないモデルを破棄する
+    def _evict_expired(self):
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry["busy"] == 0 and entry["idle"] and now - entry["last_used"] > self.idle_ttl:
+                self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.counters["evictions"] += len(entry["idle"])
+        logging.info(f"Evicted model {key}")
+
+# プロセス全体で共有するプール
+model_pool = ModelPool()
@@ -0,0 +1,206 @@
+import os
+import time
+import logging
+import argparse
+import threading
+from types import SimpleNamespace
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from model_pool import model_pool
+
+SAMPLING_RATE = 16000
+# 1チャンクあたりの目安の長さ（秒）
+CHUNK_SECONDS = float(os.environ.get("TRANSCRIBE_PARALLEL_CHUNK_SECONDS", "300"))
+# 並列に文字起こしするチャンク数（省略時はモデルプールのインスタンス数。サーバーでは worker_share の取り分まで）
+PARALLEL_WORKERS = int(os.environ.get("TRANSCRIBE_PARALLEL_WORKERS", "0"))
+
+# 無音区間で音声を区切り、各チャンクの [開始サンプル, 終了サンプル) を返す関数
+# チャンクは音声全体を隙間なく覆うので、開始位置をそのままタイムスタンプのオフセットに使える
+def plan_chunks(audio, chunk_seconds=CHUNK_SECONDS, sampling_rate=SAMPLING_RATE):
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+    speech = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=500), sampling_rate=sampling_rate)
+    limit = int(chunk_seconds * sampling_rate)
+    chunks = []
+    chunk_start = 0
+    for previous, current in zip(speech, speech[1:]):
+        if current["end"] - chunk_start > limit:
+            # 発話と発話の間の無音の中央で区切る
+            cut = (previous["end"] + current["start"]) // 2
+            if cut > chunk_start:
+                chunks.append((chunk_start, cut))
+                chunk_start = cut
+    chunks.append((chunk_start, len(audio)))
+    return chunks
+
+# セグメントの時刻（単語ごとの時刻があればそれも）を offset 秒ずらしたものを返す関数
+# チャンク・区間ごとに文字起こしした結果を音声全体の時刻に直すために使う
+def shift_segment(segment, offset):
+    words = getattr(segment, "words", None)
+    if words:
+        words = [SimpleNamespace(start=word.start + offset, end=word.end + offset, word=word.word) for word in words]
+    return SimpleNamespace(start=segment.start + offset, end=segment.end + offset, text=segment.text, words=words)
+
+# 実行枠を1つ使うジョブが並列に文字起こしできるチャンク数を返す関数
+# モデルプールのインスタンスを実行枠の数で等分した取り分で、他のジョブが使うモデルまでは借りない
+# TRANSCRIBE_PARALLEL_WORKERS を指定した場合はそれも上限にする
+def worker_share(slots):
+    share = max(1, model_pool.pool_size // max(1, slots))
+    return min(share, PARALLEL_WORKERS) if PARALLEL_WORKERS else share
+
+# 長い音声をチャンクに分けて並列に文字起こしする関数
+# model.transcribe と同じく (セグメントのイテレータ, 情報) を返し、セグメントは時刻順に流れる
+# 先頭チャンクは呼び出し元のスレッドで文字起こしし、残りのチャンクはセグメントを読み始めてから別スレッドで始める
+# 同時に借りるモデルは先頭チャンクの分も含めて workers 個まで
+# cancelled（threading.Event）がセットされると、実行中のチャンクは次のセグメントで、未着手のチャンクは開始前に止まる
+def transcribe_parallel(audio_file, options, workers=None, model_key=(), chunk_seconds=CHUNK_SECONDS, cancelled=None):
+    from faster_whisper.audio import decode_audio
+    workers = workers or PARALLEL_WORKERS or model_pool.pool_size
+    # デコード済みPCMが渡された場合はそのまま使う
+    audio = audio_file if isinstance(audio_file, np.ndarray) else decode_audio(audio_file, sampling_rate=SAMPLING_RATE)
+    chunks = plan_chunks(audio, chunk_seconds)
+    logging.info(f"Split audio into {len(chunks)} chunks for {workers} workers")
+
+    cond = threading.Condition()
+    stop = threading.Event()
+    slots = threading.BoundedSemaphore(workers)  # このジョブが同時に借りるモデルの数
+
+    def stopped():
+        return stop.is_set() or (cancelled is not None and cancelled.is_set())
+    # 先頭以外の各チャンクの結果 {'segments': [...], 'done': bool, 'error': 例外}
+    results = [{"segments": [], "done": False, "error": None} for _ in chunks[1:]]
+
+    def run_chunk(index):
+        start, end = chunks[index]
+        offset = start / SAMPLING_RATE
+        result = results[index - 1]
+        acquired = False
+        try:
+            # 空きを待つ間に中断された場合は推論しない
+            while not (acquired := slots.acquire(timeout=0.2)):
+                if stopped():
+                    return
+            if stopped():
+                return
+            with model_pool.model(*model_key) as model:
+                if stopped():
+                    return
+                segments, _ = model.transcribe(audio[start:end], **options)
+                for segment in segments:
+                    # チャンク内の時刻を音声全体の時刻に直す
+                    shifted = shift_segment(segment, offset)
+                    with cond:
+                        result["segments"].append(shifted)
+                        cond.notify_all()
+                    if stopped():
+                        return
+        except Exception as e:
+            result["error"] = e
+        finally:
+            if acquired:
+                slots.release()
+            with cond:
+                result["done"] = True
+                cond.notify_all()
+
+    # 先頭チャンクの文字起こしを始め、言語などの情報を得る（セグメントは遅延評価のまま）
+    slots.acquire()
+    try:
+        key, model = model_pool.acquire(*model_key)
+        try:
+            first_segments, first_info = model.transcribe(audio[chunks[0][0]:chunks[0][1]], **options)
+        except BaseException:
+            model_pool.release(key, model)
+            raise
+    except BaseException:
+        slots.release()
+        raise
+    info = SimpleNamespace(
+        duration=len(audio) / SAMPLING_RATE,
+        language=first_info.language,
+        language_probability=first_info.language_probability,
+    )
+
+    # 先頭から順に、確定した部分のセグメントを流すジェネレータ
+    def ordered_segments():
+        borrowed = (key, model)
+        executor = None
+        try:
+            # 呼び出し元で1度進めておき、セグメントを読む前に閉じられても finally で先頭チャンクのモデルを返す
+            yield None
+            # 残りのチャンクは、セグメントが読まれ始めてから並列に文字起こしする
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parallel-chunk")
+            for index in range(1, len(chunks)):
+                executor.submit(run_chunk, index)
+            for segment in first_segments:
+                yield shift_segment(segment, chunks[0][0] / SAMPLING_RATE)
+                if stopped():
+                    return
+            model_pool.release(*borrowed)
+            borrowed = None
+            slots.release()
+
+            for result in results:
+                emitted = 0
+                while True:
+                    with cond:
+                        # 外部から中断された場合に気付けるよう、一定間隔で待機を抜ける
+                        while not cond.wait_for(lambda: len(result["segments"]) > emitted or result["done"], timeout=0.2):
+                            if stopped():
+                                return
+                        pending = result["segments"][emitted:]
+                        finished = result["done"]
+                    for segment in pending:
+                        yield segment
+                    emitted += len(pending)
+                    if finished:
+                        break
+                if result["error"] is not None:
+                    raise result["error"]
+        finally:
+            # 途中で閉じられた場合も残りのチャンクを止め、モデルがプールに返却されるまで待つ
+            stop.set()
+            if borrowed is not None:
+                model_pool.release(*borrowed)
+                slots.release()
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    segments = ordered_segments()
+    next(segments)
+    return segments, info
+
+# 逐次処理と並列処理の所要時間を比較するベンチマーク
+# 例: python parallel.py sample.wav --model tiny --device cpu --compute-type int8 --workers 4
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare sequential and chunked parallel transcription")
+    parser.add_argument("audio")
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    model_pool.pool_size = args.workers
+    key = (args.model, args.device, args.compute_type)
+    options = {"language": "ja", "beam_size": 5, "vad_filter": True, "without_timestamps": True}
+
+    # 計測前にワーカー数分のモデルを読み込んでおく
+    loaded = [model_pool.acquire(*key) for _ in range(args.workers)]
+    for model_key, model in loaded:
+        model_pool.release(model_key, model)
+
+    start = time.monotonic()
+    with model_pool.model(*key) as model:
+        segments, info = model.transcribe(args.audio, **options)
+        sequential = list(segments)
+    sequential_time = time.monotonic() - start
+
+    start = time.monotonic()
+    segments, info = transcribe_parallel(args.audio, options, args.workers, key, args.chunk_seconds)
+    parallel = list(segments)
+    parallel_time = time.monotonic() - start
+
+    print(f"audio: {info.duration:.1f}s")
+    print(f"sequential: {sequential_time:.2f}s ({len(sequential)} segments, RTF {sequential_time / info.duration:.3f})")
+    print(f"parallel:   {parallel_time:.2f}s ({len(parallel)} segments, RTF {parallel_time / info.duration:.3f})")
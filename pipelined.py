@@ -0,0 +1,218 @@
+import os
+import logging
+import threading
+from contextlib import ExitStack
+from types import SimpleNamespace
+import numpy as np
+from audio_ingest import SAMPLING_RATE, DecodeCancelled, stream_pcm
+from parallel import plan_chunks, shift_segment
+from model_pool import model_pool
+
+# アップロード中に文字起こしを始めるか（クライアントが pipelined を指定した場合のみ）
+PIPELINE_ENABLED = os.environ.get("TRANSCRIBE_PIPELINED_UPLOAD", "1") == "1"
+# 受信済みの音声を区切って文字起こしする1チャンクの目安の長さ（秒）
+# 短いほど最初のセグメントが早く届くが、区切りが増える
+PIPELINE_CHUNK_SECONDS = float(os.environ.get("TRANSCRIBE_PIPELINE_CHUNK_SECONDS", "60"))
+# 形式の判定と長さの計算に使う先頭のバイト数（WAVの fmt チャンク・FLACの STREAMINFO を含む長さ）
+_HEADER_SIZE = 32
+
+# 音声の先頭部分から、受信途中でもデコードできる形式かどうかと長さ（秒、分からなければ None）を返す関数
+# WAV・FLACはヘッダーの後に音声が先頭から順に並ぶため、受信済みの部分だけでデコードできる
+def _parse_header(head, size):
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        byte_rate = int.from_bytes(head[28:32], "little")
+        return True, (size - 44) / byte_rate if byte_rate else None
+    if head[:4] == b"fLaC":
+        # STREAMINFO のサンプリングレート（20ビット）と総サンプル数（36ビット）
+        bits = int.from_bytes(head[18:26], "big")
+        sample_rate, total = bits >> 44, bits & ((1 << 36) - 1)
+        return True, total / sample_rate if sample_rate and total else None
+    return False, None
+
+# 受信中の音声ファイル（アップロードの進捗を受け取り、読み込み側は届いた分だけ読めるようにする）
+class GrowingUpload:
+    def __init__(self, partial_path, blob_path, size):
+        self.partial_path = partial_path
+        self.blob_path = blob_path  # 受信完了後に移動される先
+        self.size = size
+        self.received = 0
+        self.complete = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    # 受信済みバイト数を更新する（アップロード側から呼ぶ）
+    def extend(self, received):
+        with self._cond:
+            self.received = received
+            self._cond.notify_all()
+
+    # 受信が完了し、チェックサムの検証と本保存が終わったことを通知する
+    def finish(self):
+        with self._cond:
+            self.received = self.size
+            self.complete = True
+            self._cond.notify_all()
+
+    # 受信に失敗したことを通知する（読み込み側は error を送出する）
+    def fail(self, error):
+        with self._cond:
+            if not self.complete:
+                self.error = error
+            self._cond.notify_all()
+
+    # position より先のバイトが届くか、受信が終わるまで待つ（cancelled がセットされたら DecodeCancelled）
+    def wait(self, position, cancelled=None):
+        with self._cond:
+            while not self._cond.wait_for(lambda: self.received > position or self.complete or self.error, timeout=0.2):
+                if cancelled is not None and cancelled.is_set():
+                    raise DecodeCancelled()
+            if self.error is not None:
+                raise self.error
+            return self.received, self.complete
+
+    # 読み込み用のファイルオブジェクトを開く
+    def open(self, cancelled=None):
+        return UploadReader(self, cancelled)
+
+    # 先頭部分から形式と長さを調べる（先頭が届くまで待つ）
+    def probe(self, cancelled=None):
+        reader = self.open(cancelled)
+        try:
+            head = b""
+            while len(head) < _HEADER_SIZE:
+                chunk = reader.read(_HEADER_SIZE - len(head))
+                if not chunk:
+                    break
+                head += chunk
+        finally:
+            reader.close()
+        return _parse_header(head, self.size)
+
+# 受信中の音声を先頭から順に読むファイルオブジェクト
+# まだ届いていない位置を読もうとすると届くまで待つ
+# seek を持たないため、PyAV はファイルの末尾（受信前の部分）を読みに行かずに先頭から順にデコードする
+class UploadReader:
+    def __init__(self, upload, cancelled=None):
+        self.upload = upload
+        self.cancelled = cancelled
+        self.position = 0
+        self._file = None
+
+    def read(self, size=-1):
+        received, complete = self.upload.wait(self.position, self.cancelled)
+        if self.position >= received:
+            return b""  # 受信完了かつ末尾まで読んだ
+        if self._file is None:
+            self._file = self._open_file()
+        self._file.seek(self.position)
+        limit = received - self.position
+        data = self._file.read(limit if size is None or size < 0 else min(size, limit))
+        self.position += len(data)
+        return data
+
+    # 受信途中のファイルを開く（受信完了後に本保存先へ移動済みならそちらを開く）
+    def _open_file(self):
+        try:
+            return open(self.upload.partial_path, "rb")
+        except FileNotFoundError:
+            self.upload.wait(self.upload.size, self.cancelled)
+            return open(self.upload.blob_path, "rb")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# 受信済みのPCMを、発話の切れ目で区切ったチャンクとして (開始サンプル, PCM) の順に返すジェネレータ
+# 目安の長さを超えたチャンクは、その後の発話が始まった時点で直前の無音の中央で区切る
+# 無音が見つからないまま目安の2倍に達した場合は目安の長さで区切る
+def _speech_chunks(pcm_chunks, chunk_seconds):
+    limit = int(chunk_seconds * SAMPLING_RATE)
+    buffer = np.zeros(0, dtype=np.float32)
+    start = 0
+    for pcm in pcm_chunks:
+        buffer = np.concatenate([buffer, pcm])
+        while len(buffer) > limit:
+            chunks = plan_chunks(buffer, chunk_seconds)
+            if len(chunks) > 1:
+                cut = chunks[0][1]
+            elif len(buffer) >= 2 * limit:
+                cut = limit
+            else:
+                break
+            yield start, buffer[:cut]
+            buffer = buffer[cut:]
+            start += cut
+    yield start, buffer
+
+# アップロード中の音声を、受信済みの部分から順にチャンクに区切って文字起こしする関数
+# model.transcribe と同じく (セグメントのイテレータ, 情報) を返す
+# モデルはチャンクごとに借り、次のチャンクの音声が届くのを待つ間はプールに返す
+# admit(cancelled) を渡すと、チャンクごとにその with 文の中でモデルを使う（サーバーの実行枠。確保できなければ False を返すこと）
+# 受信の遅いアップロードが、音声を待つ間も実行枠を占有しないようにするため
+# 受信に失敗した場合はセグメントの途中で受信時の例外を送出する
+def transcribe_pipelined(upload, options, model_key=(), chunk_seconds=PIPELINE_CHUNK_SECONDS, cancelled=None, admit=None):
+    _, duration = upload.probe(cancelled)
+    reader = upload.open(cancelled)
+    chunks = _speech_chunks(stream_pcm(reader), chunk_seconds)
+
+    def stopped():
+        return cancelled is not None and cancelled.is_set()
+
+    # チャンクの文字起こしに使う実行枠を確保する（取り消された場合は DecodeCancelled）
+    def enter_slot(stack):
+        if admit is not None and not stack.enter_context(admit(cancelled)):
+            raise DecodeCancelled()
+
+    # チャンク内の時刻を音声全体の時刻に直す
+    def shifted(segments, start):
+        for segment in segments:
+            yield shift_segment(segment, start / SAMPLING_RATE)
+
+    # 先頭チャンクの文字起こしを始め、言語などの情報を得る（セグメントは遅延評価のまま）
+    first_slot = ExitStack()
+    try:
+        first_start, audio = next(chunks)
+        enter_slot(first_slot)
+        key, model = model_pool.acquire(*model_key)
+        try:
+            first_segments, first_info = model.transcribe(audio, **options)
+        except BaseException:
+            model_pool.release(key, model)
+            raise
+    except BaseException:
+        first_slot.close()
+        chunks.close()
+        reader.close()
+        raise
+    logging.info(f"Started pipelined transcription ({duration or 0:.1f}s expected)")
+    info = SimpleNamespace(
+        duration=duration or 0.0,
+        language=first_info.language,
+        language_probability=first_info.language_probability,
+    )
+
+    def ordered_segments():
+        borrowed = (key, model)
+        try:
+            yield from shifted(first_segments, first_start)
+            model_pool.release(*borrowed)
+            borrowed = None
+            first_slot.close()
+            # 次のチャンクの音声が届くのを待つ間はモデル・実行枠を借りない
+            for start, audio in chunks:
+                if stopped():
+                    return
+                with ExitStack() as slot:
+                    enter_slot(slot)
+                    with model_pool.model(*model_key) as chunk_model:
+                        segments, _ = chunk_model.transcribe(audio, **options)
+                        yield from shifted(segments, start)
+        finally:
+            if borrowed is not None:
+                model_pool.release(*borrowed)
+            first_slot.close()
+            chunks.close()
+            reader.close()
+
+    return ordered_segments(), info
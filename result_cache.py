@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+
+# キャッシュを保存するSQLiteファイル
+CACHE_PATH = os.environ.get("TRANSCRIBE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "transcribe_cache.sqlite3"))
+# キャッシュの有効期間（秒）
+CACHE_TTL = float(os.environ.get("TRANSCRIBE_CACHE_TTL", str(30 * 24 * 60 * 60)))
+# 保持する結果数の上限（超えたら最終利用時刻の古いものから削除）
+CACHE_MAX_ENTRIES = int(os.environ.get("TRANSCRIBE_CACHE_MAX_ENTRIES", "10000"))
+
+# 音声のハッシュ・モデル・デコード設定から文字起こし結果を引くキャッシュ
+class ResultCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, info TEXT NOT NULL, segments TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.commit()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    # キャッシュのキーを作成する（設定の順序に依存しないようにソートしてハッシュ化）
+    @staticmethod
+    def make_key(audio_hash, model_name, options):
+        payload = json.dumps({"audio": audio_hash, "model": model_name, "options": options}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # 結果を取得する（見つからない・期限切れの場合はNone）
+    # 戻り値: {"info": {...}, "segments": [[start, end, text], ...]}（単語ごとの時刻がある場合は [start, end, text, words]）
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT info, segments, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                self.counters["misses"] += 1
+                return None
+            self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.counters["hits"] += 1
+        return {"info": json.loads(row[0]), "segments": json.loads(row[1])}
+
+    # 結果が保存されているかどうか（ヒット率の集計には含めない）
+    def contains(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT created FROM results WHERE key = ?", (key,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    # 結果を保存する
+    def put(self, key, info, segments):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, info, segments, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(info, ensure_ascii=False), json.dumps(segments, ensure_ascii=False, separators=(",", ":")), now, now),
+            )
+            self.counters["stores"] += 1
+            self._evict(now)
+            self._db.commit()
+
+    # 期限切れと上限超過分の結果を削除する
+    def _evict(self, now):
+        removed = self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,)).rowcount
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            removed += self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+        if removed:
+            self.counters["evictions"] += removed
+            logging.info(f"Evicted {removed} cached transcription results")
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {**self.counters, "entries": entries, "hit_rate": self.counters["hits"] / lookups if lookups else 0.0}
+
+# プロセス全体で共有するキャッシュ
+result_cache = ResultCache()
@@ -0,0 +1,179 @@
+import os
+import asyncio
+import logging
+import itertools
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from model_pool import DEFAULT_MODEL, cuda_device_count, cpu_core_count
+
+# 待機できるジョブ数の上限（超えた分は受け付けずに拒否する）
+MAX_QUEUE = int(os.environ.get("TRANSCRIBE_MAX_QUEUE", "16"))
+
+# クライアントが指定できる優先度の範囲（0 が最優先。範囲外の値は範囲内に丸める）
+# 既定の 0 より優先させることはできないので、指定できるのは自分のジョブを後回しにすることだけ
+MAX_PRIORITY = 9
+
+# 受付上限を超えたときに送出する例外
+class QueueFullError(Exception):
+    pass
+
+# 利用可能なデバイス数からワーカー数を決める関数
+def default_worker_count():
+    if os.environ.get("TRANSCRIBE_WORKERS"):
+        return max(1, int(os.environ["TRANSCRIBE_WORKERS"]))
+    if DEFAULT_MODEL[1] == "cuda":
+        return max(1, cuda_device_count())  # GPU1枚につき1ジョブ
+    return max(1, cpu_core_count() // 4)  # CPUの場合は4コアにつき1ジョブ
+
+# 同時実行数を制限し、優先度とクライアント間の公平性で実行順を決めるスケジューラ
+class JobScheduler:
+    def __init__(self, max_workers=None, max_queue=MAX_QUEUE):
+        self.max_workers = max_workers or default_worker_count()
+        self.max_queue = max_queue
+        self._running = Counter()  # {client_id: 実行中のジョブ数}
+        self._served = Counter()  # {client_id: これまでに実行したジョブ数}
+        self._waiting = []  # [{'client_id', 'priority', 'seq', 'future', 'on_position'}]
+        self._seq = itertools.count()
+        self.counters = {"submitted": 0, "rejected": 0, "completed": 0}
+
+    # 実行中のジョブ数
+    @property
+    def running(self):
+        return sum(self._running.values())
+
+    # 待機中のジョブ数
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    # 待機列が上限に達していれば受け付けずに QueueFullError を送出する
+    def check_capacity(self):
+        if len(self._waiting) >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise QueueFullError("Server is busy. Please try again later.")
+
+    # 実行枠を確保する（空きがなければ順番が来るまで待機する）
+    # admitted=True は受け付け済みのジョブが続きの処理のために枠を取り直す場合（上限で拒否せず、受付数にも数えない）
+    async def acquire(self, client_id, priority=0, on_position=None, admitted=False):
+        if not admitted:
+            self.counters["submitted"] += 1
+        if self.running < self.max_workers and not self._waiting:
+            self._running[client_id] += 1
+            self._served[client_id] += 1
+            return
+        if not admitted:
+            self.check_capacity()
+
+        entry = {
+            "client_id": client_id,
+            "priority": priority,
+            "seq": next(self._seq),
+            "future": asyncio.get_running_loop().create_future(),
+            "on_position": on_position,
+        }
+        self._waiting.append(entry)
+        logging.info(f"Job queued for client {client_id} ({len(self._waiting)} waiting)")
+        try:
+            await self._notify_positions()
+            await entry["future"]
+        except BaseException:
+            # キャンセル・順番の通知の失敗のどちらでも、待機列に残さない
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+                if self._waiting:
+                    asyncio.get_running_loop().create_task(self._notify_positions())
+            elif entry["future"].done() and not entry["future"].cancelled():
+                # 枠が割り当てられた直後にキャンセルされた場合は枠を返す
+                self.release(client_id)
+            raise
+
+    # 実行枠を返却し、次のジョブに割り当てる（admitted は acquire と同じ）
+    def release(self, client_id, admitted=False):
+        self._running[client_id] -= 1
+        if self._running[client_id] <= 0:
+            del self._running[client_id]
+        if not admitted:
+            self.counters["completed"] += 1
+        self._dispatch()
+
+    # with文で実行枠を確保・返却するヘルパー
+    @asynccontextmanager
+    async def slot(self, client_id, priority=0, on_position=None):
+        await self.acquire(client_id, priority, on_position)
+        try:
+            yield
+        finally:
+            self.release(client_id)
+
+    # 処理の区切りごとに thread_slot で枠を取り直すジョブの、受付（上限を超えたら拒否）と完了を数える with 文用のヘルパー
+    @contextmanager
+    def admission(self):
+        self.counters["submitted"] += 1
+        self.check_capacity()
+        try:
+            yield
+        finally:
+            self.counters["completed"] += 1
+
+    # 別スレッドから実行枠を確保・返却する with 文用のヘルパー（loop はスケジューラを動かしているイベントループ）
+    # 受け付け済みのジョブが処理の区切りごとに枠を取り直すために使う（枠を確保できたかどうかを返す）
+    # 確保できるまでスレッドを止め、待つ間に cancelled がセットされたら枠を確保せずに False を返す
+    @contextmanager
+    def thread_slot(self, loop, client_id, priority=0, on_position=None, cancelled=None):
+        async def acquire():
+            task = asyncio.ensure_future(self.acquire(client_id, priority, on_position, admitted=True))
+            while not task.done():
+                await asyncio.wait({task}, timeout=0.2)
+                if not task.done() and cancelled is not None and cancelled.is_set():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    return False
+            task.result()
+            if cancelled is not None and cancelled.is_set():
+                self.release(client_id, admitted=True)
+                return False
+            return True
+
+        # 待機の取り消しはイベントループ側で行うので、確保した枠を取りこぼさない
+        granted = asyncio.run_coroutine_threadsafe(acquire(), loop).result()
+        try:
+            yield granted
+        finally:
+            if granted:
+                loop.call_soon_threadsafe(self.release, client_id, True)
+
+    def stats(self):
+        return {**self.counters, "running": self.running, "queued": self.queued, "max_workers": self.max_workers}
+
+    # 優先度（小さいほど優先）→ 実行中・待機中ジョブが少ないクライアント
+    # → これまでの実行数が少ないクライアント → 到着順 で並べる
+    # （同じクライアントの2件目以降は他のクライアントの後ろに回るラウンドロビンになる）
+    def _ordered(self):
+        rank = {}
+        per_client = Counter()
+        for entry in sorted(self._waiting, key=lambda e: e["seq"]):
+            rank[entry["seq"]] = self._running[entry["client_id"]] + per_client[entry["client_id"]]
+            per_client[entry["client_id"]] += 1
+        return sorted(self._waiting, key=lambda e: (e["priority"], rank[e["seq"]], self._served[e["client_id"]], e["seq"]))
+
+    def _dispatch(self):
+        while self._waiting and self.running < self.max_workers:
+            entry = self._ordered()[0]
+            self._waiting.remove(entry)
+            if entry["future"].done():
+                # 同じ周回で取り消されたジョブには割り当てない（acquire 側は待機列から外れたので何もしない）
+                continue
+            self._running[entry["client_id"]] += 1
+            self._served[entry["client_id"]] += 1
+            entry["future"].set_result(None)
+        if self._waiting:
+            asyncio.get_running_loop().create_task(self._notify_positions())
+
+    # 待機中のクライアントに現在の順番を知らせる
+    async def _notify_positions(self):
+        for position, entry in enumerate(self._ordered(), start=1):
+            if entry["on_position"] is not None:
+                try:
+                    await entry["on_position"](position)
+                except Exception as e:
+                    logging.info(f"Failed to notify queue position: {e}")
@@ -1,11 +1,34 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import PlainTextResponse, FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import logging
-from transcribe_fastapi import transcribe
+from transcribe_fastapi import transcribe, transcribe_draft, make_cache_key, DECODE_OPTIONS, WORD_OPTIONS, DRAFT_MAX_QUEUED
+from model_pool import model_pool
+from model_catalog import model_catalog, DEFAULT_TIER, TIERS
+from scheduler import JobScheduler, QueueFullError, MAX_PRIORITY
 import asyncio
 import base64
-import tempfile
+import json
+import time
+import threading
+import shutil
+from contextlib import contextmanager
+from upload import receive_chunked_upload, UploadError
+from spool import blob_store
+from result_cache import result_cache
+from batching import batching_stats
+from jobs import job_manager
+from audio_ingest import PCM_CACHE_ENABLED, ensure_pcm, audio_duration
+from live import live_transcribe, live_stats, pcm_from_bytes
+from metrics import metrics, recent_timings, JobTimer
+from framing import Framer, negotiate, ENCODINGS
+from fleet import COORDINATOR_URL, WORKER_URL, send_heartbeats
+from pipelined import PIPELINE_ENABLED, GrowingUpload
+from parallel import worker_share
+from export import TranscriptExport, export_path, purge_exports, MEDIA_TYPES
+from decode_policy import plan_decode
+from warmup import warmup, memory_usage
 from starlette.websockets import WebSocketState
 
 # ロギングの設定（INFOレベルに設定）
@@ -22,30 +45,193 @@ app.add_middleware(
     allow_headers=["*"],  # すべてのHTTPヘッダーを許可
 )
 
+# 同時に実行する文字起こしジョブ数を制限するスケジューラ
+scheduler = JobScheduler()
+# ワーカー数分のモデルを同時に貸し出せるようにする
+model_pool.pool_size = max(model_pool.pool_size, scheduler.max_workers)
+# モデル一覧のCPUモデル（下書き・高速モデルを含む）が同時に動いてもコアを取り合わないようにする
+model_pool.cpu_variants = len(model_catalog.cpu_keys())
+
 # セッション情報を管理する辞書
-sessions = {}  # {session_id: {'stop': bool}}
+sessions = {}  # {session_id: {'job_id': 接続中に扱っているジョブのID, 'stream': 結果を中継するタスク, 'cancel_on_disconnect': bool, 'framer': 結果の送信形式}}
+
+# /metrics で公開する現在値（取得時に計算する）
+metrics.gauge("transcribe_sessions_active", "Connected WebSocket sessions", lambda: len(sessions))
+metrics.gauge("transcribe_queue_depth", "Jobs waiting for a worker", lambda: scheduler.queued)
+metrics.gauge("transcribe_jobs_running", "Jobs holding a worker", lambda: scheduler.running)
+metrics.gauge("transcribe_jobs", "Jobs kept by the job manager by status",
+              lambda: {(("status", status),): count for status, count in job_manager.stats()["statuses"].items()})
+metrics.gauge("transcribe_models", "Loaded model instances by state",
+              lambda: {(("state", state),): sum(m[state] for m in model_pool.stats()["models"]) for state in ("idle", "busy")})
+metrics.gauge("transcribe_result_cache_hit_ratio", "Hit ratio of the result cache", lambda: result_cache.stats()["hit_rate"])
+metrics.gauge("transcribe_live_sessions_active", "Live transcription sessions", lambda: live_stats()["active"])
+
+# サーバー起動時にモデルの読み込みをバックグラウンドで始める（起動を待たずに接続を受け付け、初回リクエストの待ち時間を削減）
+@app.on_event("startup")
+async def start_warmup():
+    warmup.start()
+
+# コーディネーターに送るこのサーバーの状態（負荷と読み込み済みのモデル）
+def worker_status():
+    loaded = {(m["name"], m["device"], m["compute_type"]) for m in model_pool.stats()["models"] if m["idle"] or m["busy"]}
+    return {
+        "url": WORKER_URL,
+        "max_workers": scheduler.max_workers,
+        "running": scheduler.running,
+        "queued": scheduler.queued,
+        "max_queue": scheduler.max_queue,
+        "sessions": len(sessions),
+        "models": ["/".join(key) for key in sorted(loaded)],
+        # 精度重視で使うモデルを読み込み済みのモデル種別
+        "warm_models": [label for label, name in model_catalog.labels.items() if model_catalog.key(name) in loaded],
+        "encodings": list(ENCODINGS),
+        "ready": warmup.ready,
+    }
+
+# コーディネーターが設定されている場合は、状態を定期的に送ってワーカーとして登録する
+heartbeat_task = None
+
+@app.on_event("startup")
+async def start_heartbeats():
+    global heartbeat_task
+    if COORDINATOR_URL:
+        heartbeat_task = asyncio.create_task(send_heartbeats(worker_status))
+
+# プロセスが応答できるかを返すエンドポイント（モデルの読み込み中も 200 を返す）
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "warmup": warmup.status, "uptime_seconds": round(time.time() - warmup.started, 3)}
+
+# ジョブを処理できる状態かを返すエンドポイント（読み込み中・失敗時は 503）
+# 読み込みの進み具合に加えて、読み込み済みのモデル・待機中のジョブ数・メモリ使用量を返す
+@app.get("/readyz")
+async def readyz():
+    loaded = [m for m in model_pool.stats()["models"] if m["idle"] or m["busy"]]
+    content = {
+        **warmup.summary(),
+        "models": loaded,
+        "queue": {"running": scheduler.running, "queued": scheduler.queued, "max_workers": scheduler.max_workers},
+        "memory": memory_usage(),
+    }
+    return JSONResponse(content, status_code=200 if warmup.ready else 503)
+
+# モデルプールの統計情報（読み込み回数・ヒット・ミス）を返すエンドポイント
+@app.get("/models")
+async def model_stats():
+    return model_pool.stats()
+
+# 音声ストアの使用量を返すエンドポイント
+@app.get("/spool")
+async def spool_stats():
+    return await asyncio.to_thread(blob_store.stats)
+
+# 文字起こし結果キャッシュのヒット率を返すエンドポイント
+@app.get("/cache")
+async def cache_stats():
+    return await asyncio.to_thread(result_cache.stats)
+
+# マイクロバッチ処理の統計情報（バッチサイズの分布など）を返すエンドポイント
+@app.get("/batching")
+async def batch_stats():
+    return batching_stats()
+
+# スケジューラの状態（実行中・待機中のジョブ数）を返すエンドポイント
+@app.get("/queue")
+async def queue_stats():
+    return {**scheduler.stats(), **job_manager.stats()}
+
+# ライブ文字起こしの統計情報（確定までの遅延など）を返すエンドポイント
+@app.get("/live")
+async def live_session_stats():
+    return live_stats()
+
+# Prometheus形式のメトリクスを返すエンドポイント
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+# 直近のジョブの処理段階ごとの所要時間を返すエンドポイント
+@app.get("/timings")
+async def job_timings():
+    return list(recent_timings)
+
+# ジョブの状態と、from_segment 番目以降のメッセージを返すエンドポイント
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, from_segment: int = 0):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.touch()  # 問い合わせがある間は放棄されたジョブとして扱わない
+    messages = [m for m in job.messages if m.get("type") != "segment" or m["index"] >= from_segment]
+    return {**job.summary(), "messages": messages}
+
+# ジョブの結果を書き出したファイル（srt / vtt / json）をダウンロードするエンドポイント
+# Range ヘッダーによる部分取得・ダウンロードの再開に対応する（ファイルはジョブの保持期間を過ぎても残る）
+@app.get("/jobs/{job_id}/transcript.{fmt}")
+async def download_transcript(job_id: str, fmt: str):
+    path = export_path(job_id, fmt)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Unknown export format")
+    if not os.path.exists(path):
+        job = job_manager.get(job_id)
+        if job is not None and not job.is_finished:
+            raise HTTPException(status_code=409, detail="Transcription is still running")
+        if job is not None and job.status != "done":
+            raise HTTPException(status_code=404, detail=f"Transcription did not finish ({job.status})")
+        raise HTTPException(status_code=404, detail="Transcript not found")
+    return FileResponse(path, media_type=MEDIA_TYPES[fmt], filename=f"{job_id}.{fmt}")
+
+# ジョブを停止するエンドポイント
+@app.delete("/jobs/{job_id}")
+async def stop_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.cancel("stop")
+    return job.summary()
 
 # セッション終了時のクリーンアップ処理を行う関数
+# ジョブは接続とは独立して動き続けるので、再接続すれば結果を受け取れる
+# （cancel_on_disconnect を指定したジョブは切断時に中止し、それ以外も再接続がなければ jobs.ABANDON_TIMEOUT 後に中止する）
 async def cleanup_session(session_id: int):
     logging.info('Client disconnected')
-    if session_id in sessions:
-        sessions.pop(session_id)  # セッションを削除
+    session = sessions.pop(session_id, None)  # セッションを削除
+    if session is None:
+        return
+    if session['stream'] is not None:
+        session['stream'].cancel()
+    session['framer'].close()
+    job = job_manager.get(session['job_id'])
+    if job is not None and session['cancel_on_disconnect']:
+        job.cancel("disconnect")
 
 # WebSocketエンドポイント
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()  # WebSocket接続を受け入れる
     session_id = id(websocket)  # 一意のセッションIDを生成
-    sessions[session_id] = {'stop': False}  # 新しいセッションを初期化
+    # 新しいセッションを初期化（hello を受け取るまでは従来の形式で結果を送る）
+    sessions[session_id] = {'job_id': None, 'stream': None, 'cancel_on_disconnect': False,
+                            'framer': Framer(lambda frame: send_frame_if_connected(websocket, frame))}
     logging.info('Client connected')
 
     try:
-        while True:
+        while websocket.client_state == WebSocketState.CONNECTED and websocket.application_state == WebSocketState.CONNECTED:
             # クライアントからのJSONメッセージを待機
+            # 結果の中継は別タスクで行うため、文字起こし中も停止リクエストなどを受け付けられる
             data = await websocket.receive_json()
-            if data.get("type") == "transcribe":
-                # 文字起こしリクエストの処理
+            if data.get("type") == "hello":
+                # 結果の送信形式（エンコード方式・セグメントをまとめる間隔）の指定
+                await handle_hello(websocket, data, session_id)
+            elif data.get("type") in ("transcribe", "upload"):
+                # 文字起こしリクエストの処理（uploadはバイナリフレームによる分割アップロード）
                 await handle_transcribe(websocket, data, session_id)
+            elif data.get("type") == "attach":
+                # 実行中・実行済みのジョブに再接続して結果を途中から受信する
+                await handle_attach(websocket, data, session_id)
+            elif data.get("type") == "probe":
+                # 音声が保存済みか・どこまで受信済みかの問い合わせ
+                await handle_probe(websocket, data)
             elif data.get("type") == "stop":
                 # 停止リクエストの処理
                 await handle_stop(websocket, session_id)
@@ -58,11 +244,66 @@ async def websocket_endpoint(websocket: WebSocket):
         # セッション終了時に必ずクリーンアップ処理を実行
         await cleanup_session(session_id)
 
+# ライブ文字起こし用のWebSocketエンドポイント
+# 最初に {"type": "start", "sample_rate": 16000} を受け取り、以降はバイナリフレームのPCM（s16le モノラル）を受信する
+# start に encoding を指定すると、hello と同じ形式で結果を送る
+# {"type": "stop"} を受け取るか切断されたら、残りの音声を確定して終了する
+@app.websocket("/ws/live")
+async def live_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    logging.info('Live client connected')
+    audio_queue = asyncio.Queue()
+
+    # 受信は文字起こしと並行して行い、デコード中に届いた音声もすぐにキューへ入れる
+    async def receive_audio(sample_rate):
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes"):
+                    audio_queue.put_nowait(pcm_from_bytes(message["bytes"], sample_rate))
+                elif message.get("text") and json.loads(message["text"]).get("type") == "stop":
+                    break
+        finally:
+            audio_queue.put_nowait(None)
+
+    receiver = None
+    framer = Framer(lambda frame: send_frame_if_connected(websocket, frame))
+    try:
+        start = await websocket.receive_json()
+        if start.get("type") != "start":
+            await send_json_if_connected(websocket, {"type": "error", "error": "Expected a start message", "done": True})
+            return
+        if "encoding" in start:
+            encoding, batch_interval = negotiate(start)
+            framer = Framer(framer.write, encoding, batch_interval)
+        # モデルの読み込みが終わってから音声を受け付ける
+        if not await wait_until_ready(lambda message: send_json_if_connected(websocket, message)):
+            return
+        receiver = asyncio.create_task(receive_audio(int(start.get("sample_rate", 16000))))
+        await send_json_if_connected(websocket, {"type": "ready", "encoding": framer.encoding or "json", "done": False})
+        await live_transcribe(audio_queue, framer.send)
+    except WebSocketDisconnect:
+        logging.info('Live client disconnected')
+    except Exception as e:
+        logging.error(f"Live transcription error: {e}", exc_info=True)
+        await send_json_if_connected(websocket, {"type": "error", "error": str(e), "done": True})
+    finally:
+        framer.close()
+        if receiver is not None:
+            receiver.cancel()
+
 # 停止リクエストを処理する関数
 async def handle_stop(websocket: WebSocket, session_id: int):  
     logging.info(f"Stop requested for session {session_id}")  
-    if session_id in sessions:  
-        sessions[session_id]['stop'] = True  # 停止フラグをセット
+    session = sessions.get(session_id, {})
+    job = job_manager.get(session.get('job_id'))
+    if job is not None:  
+        job.cancel("stop")  # ジョブを中止（デコードは現在の窓で止まり、モデルはプールに返却される）
+        if session.get('stream') is not None:
+            # 中止したことを伝えるメッセージが中継されるまで待つ
+            await asyncio.wait([session['stream']], timeout=10)
         try:  
             # クライアントに停止確認を送信
             await websocket.send_json({'done': True, 'message': 'Transcription stopped'})  
@@ -72,61 +313,347 @@ async def handle_stop(websocket: WebSocket, session_id: int):
     else:  
         logging.info(f"No active transcription to stop for session {session_id}")
 
-# 文字起こしリクエストを処理する関数
-async def handle_transcribe(websocket: WebSocket, data: dict, session_id: int):
-    temp_file_path = None
+# 接続中の場合のみクライアントにJSONを送信する関数（送信できたかどうかを返す）
+async def send_json_if_connected(websocket: WebSocket, message: dict):
+    try:
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_json(message)
+            return True
+    except (WebSocketDisconnect, RuntimeError):
+        logging.info(f"Client disconnected while sending message")
+    return False
+
+# 接続中の場合のみクライアントにフレーム（テキストまたはバイナリ）を送信する関数（送信できたかどうかを返す）
+async def send_frame_if_connected(websocket: WebSocket, frame):
+    try:
+        if websocket.client_state == WebSocketState.CONNECTED:
+            if isinstance(frame, bytes):
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+            return True
+    except (WebSocketDisconnect, RuntimeError):
+        logging.info(f"Client disconnected while sending message")
+    return False
+
+# 結果の送信形式の指定を処理する関数
+# エンコード方式とセグメントをまとめる間隔を決めて、決まった内容を返す（制御用のメッセージは常にJSONで送る）
+# 結果の中継中は送信形式を変えられない（中継タスクが使っている送信先を閉じることになるため）
+async def handle_hello(websocket: WebSocket, data: dict, session_id: int):
+    session = sessions[session_id]
+    if session['stream'] is not None and not session['stream'].done():
+        await send_json_if_connected(websocket, {"type": "error", "error": "Cannot change the encoding while a job is streaming", "done": False})
+        return
+    encoding, batch_interval = negotiate(data)
+    # 前の送信先は溜まっているセグメントを送ってから閉じる（予約済みの送信タスクを残さない）
+    previous = session['framer']
+    await previous.flush()
+    previous.close()
+    session['framer'] = Framer(lambda frame: send_frame_if_connected(websocket, frame), encoding, batch_interval)
+    await send_json_if_connected(websocket, {"type": "hello", "encoding": encoding, "batch_interval": batch_interval,
+                                             "encodings": list(ENCODINGS), "done": False})
+
+# ジョブのメッセージをクライアントに中継する関数（切断されてもジョブは続行する）
+async def stream_job(framer, job, from_segment=0):
+    async for message in job.stream(from_segment):
+        if not await framer.send(message):
+            logging.info(f"Client detached from job {job.id}")
+            return
+
+# ジョブの結果の中継を別タスクで開始する関数（受信ループはその間も次のメッセージを待てる）
+def start_stream(websocket: WebSocket, session_id: int, job, from_segment=0):
+    session = sessions[session_id]
+    if session['stream'] is not None:
+        session['stream'].cancel()
+    session['job_id'] = job.id
+    framer = session['framer']
+
+    async def relay():
+        await stream_job(framer, job, from_segment)
+        # 処理完了をクライアントに通知（まとめて送る途中のセグメントがあれば先に送る）
+        await framer.send({"done": True})
+
+    session['stream'] = asyncio.create_task(relay())
+
+# 既存のジョブへの再接続を処理する関数
+async def handle_attach(websocket: WebSocket, data: dict, session_id: int):
+    job = job_manager.get(data.get('job_id'))
+    if job is None:
+        await send_json_if_connected(websocket, {"type": "error", "error": "Job not found", "done": True})
+        return
+    logging.info(f"Session {session_id} attached to job {job.id}")
+    sessions[session_id]['cancel_on_disconnect'] = bool(data.get('cancel_on_disconnect', False))
+    await send_json_if_connected(websocket, {"type": "job", **job.summary(), "done": False})
+    start_stream(websocket, session_id, job, int(data.get('from_segment', 0)))
+
+# クライアントが指定した優先度を 0〜MAX_PRIORITY の整数にする関数（数値でなければ 0）
+def job_priority(data: dict):
     try:
-        # クライアントから送信されたデータを取得
-        audio_base64 = data['audio']  # Base64エンコードされた音声データ
-        model = data['model']  # 使用するモデル
-        save_audio = data['save_audio']  # 音声を保存するかどうか
-        file_name = data['file_name']  # ファイル名
-        sessions[session_id]['stop'] = False  # 停止フラグを初期化
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return 0
+    return min(max(priority, 0), MAX_PRIORITY)
 
-        # Base64デコードして音声データを取得
-        audio_file = base64.b64decode(audio_base64)
+# 音声の長さと待機中のジョブ数、指定された tier からジョブで使うモデルとデコード方針を選び、クライアントに通知する関数
+# デコード方針は quality（未指定なら tier）で決め、language を指定した場合は言語判定を行わない
+# 戻り値: (モデル名, 文字起こしの設定)。指定されたモデル種別が不明な場合はエラーを送って (None, None) を返す
+async def select_model(job, data: dict, duration):
+    label = data['model']
+    if label not in model_catalog.labels:
+        await job.emit({"type": "error", "error": f"Unknown model: {label}", "done": True})
+        return None, None
+    tier = data.get('tier', DEFAULT_TIER)
+    if tier not in TIERS:
+        tier = DEFAULT_TIER
+    queued = scheduler.queued
+    model_name, reason = model_catalog.choose(label, tier, duration, queued, scheduler.max_workers, data.get('language'))
+    base = WORD_OPTIONS if data.get('word_timestamps') else DECODE_OPTIONS
+    policy, policy_reason, options = plan_decode(base, data.get('quality', tier), data.get('language'), queued,
+                                                 scheduler.max_workers, job.timer)
+    job.timer.record(model_name=model_name, tier=tier)
+    logging.info(f"Job {job.id} uses {model_name} ({reason}) with {policy} decoding ({policy_reason})")
+    await job.emit({"type": "model", "model": model_name, "tier": tier, "reason": reason,
+                    "decode_policy": policy, "beam_size": options.get("beam_size"), "done": False})
+    return model_name, options
 
-        # 一時ファイルを作成して音声データを保存
-        temp_dir = tempfile.gettempdir()  # 一時ディレクトリを取得
-        temp_file_path = os.path.join(temp_dir, os.path.basename(file_name))
-        with open(temp_file_path, 'wb') as f:
-            f.write(audio_file)
+# 起動直後のモデルの読み込みが終わるまでジョブを待たせる関数（待つ間は読み込みの進み具合を通知する）
+# 読み込みが READY_TIMEOUT 秒を過ぎても終わらない場合はエラーを送って False を返す
+async def wait_until_ready(emit, timer=None):
+    if warmup.done:
+        return True
+    async def notify_progress(progress):
+        await emit({"type": "loading", "progress": round(progress * 100), "done": False})
 
-        logging.info(f"Saved audio file temporarily")
+    await notify_progress(warmup.progress)
+    started = time.monotonic()
+    ready = await warmup.wait(notify=notify_progress)
+    if timer is not None:
+        timer.add("warmup_wait", time.monotonic() - started)
+    if not ready:
+        await emit({"type": "error", "error": "Server is still loading models, try again later", "done": True})
+    return ready
 
+# ジョブとして実行する文字起こし処理
+async def run_job(job, data: dict, audio_hash: str, client_id):
+    # 文字起こしが終わるまで音声ファイルを削除対象から外す
+    timer = job.timer
+    with blob_store.pin(audio_hash) as audio_path:
         # フィードバック用に音声を保存するオプションが有効な場合
-        if save_audio:
+        if data['save_audio']:
             destination_path = "path_to_save"  # 保存先のパス
-            with open(destination_path, 'wb') as f_dst:
-                f_dst.write(audio_file)
+            with timer.stage("save_audio"):
+                shutil.copyfile(audio_path, destination_path)
             logging.info(f"Saved audio file for feedback")
 
-        # 文字起こし処理の実行（汎用モデルの場合）
-        if model == "汎用モデル":
-            await transcribe(temp_file_path, websocket, session_id, lambda: sessions[session_id]['stop'])
+        # 音声を16kHz PCMにデコードする（所要時間を計測）
+        # ジョブが中止された場合は書きかけのPCMファイルを削除して終了する
+        pcm_cancelled = threading.Event()
+        def decode_pcm():
+            with timer.stage("audio_decode"):
+                return ensure_pcm(audio_hash, audio_path, pcm_cancelled)
+
+        # 待機中は順番をクライアントに通知する
+        async def notify_position(position):
+            await job.emit({"type": "queued", "position": position, "done": False})
+
+        parallel = data.get('parallel', False)
+        duration = await asyncio.to_thread(audio_duration, audio_path)
+        model_name, options = await select_model(job, data, duration)
+        if model_name is None:
+            return
+        model_key = model_catalog.key(model_name)
+
+        # 通常の結果の完了（done を含むメッセージ）を送ったら、それ以降の下書きは送らない
+        finished = False
+        async def emit(message):
+            nonlocal finished
+            if message.get("done"):
+                finished = True
+            return await job.emit(message)
+
+        async def emit_draft(message):
+            return False if finished else await job.emit(message)
+
+        # 二段階モードでは実行枠を待たずに、速いモデルで作った下書きを先に送る
+        # 待機中のジョブが多いときは下書きを作らない（下書き用のスレッドとモデルを本番に回す）
+        draft_task = None
+        if data.get('two_pass') and scheduler.queued > DRAFT_MAX_QUEUED:
+            logging.info(f"Skipping draft for job {job.id}: {scheduler.queued} jobs queued")
+        elif (data.get('two_pass') and model_catalog.draft and model_catalog.draft != model_name
+              and model_catalog.supports(model_catalog.draft, data.get('language'))):
+            draft_key = model_catalog.key(model_catalog.draft)
+            draft_task = asyncio.create_task(transcribe_draft(audio_path, emit_draft, lambda: job.stop or finished, audio_hash, draft_key,
+                                                              options["language"]))
+
+        # 音声のデコード（16kHz PCMへの変換）は実行枠を待つ間に並行して進める
+        # キャッシュ済みの結果がある場合はデコード不要
+        pcm_task = None
+        cached = await asyncio.to_thread(result_cache.contains, make_cache_key(audio_hash, parallel, model_key, options))
+        if PCM_CACHE_ENABLED and not cached:
+            pcm_task = asyncio.create_task(asyncio.to_thread(decode_pcm))
+        try:
+            # モデルの読み込み中に届いたジョブは読み込みを待つ（音声のデコードはその間も進める。キャッシュ済みなら待たない）
+            if not cached and not await wait_until_ready(emit, timer):
+                return
+            # 実行枠が空くまで待機してから文字起こしを行う
+            queued_at = time.monotonic()
+            async with scheduler.slot(client_id, job_priority(data), notify_position):
+                timer.add("queue_wait", time.monotonic() - queued_at)
+                # 待機中にデコードが終わらなかった分だけ待つ
+                with timer.stage("audio_decode_wait"):
+                    audio = await pcm_task if pcm_task else audio_path
+                # 並列処理でも、このジョブの実行枠に見合う数のモデルしか借りない
+                await transcribe(audio, emit, lambda: job.stop, audio_hash, parallel, timer, model_key, options,
+                                 workers=worker_share(scheduler.max_workers))
+        except QueueFullError as e:
+            # 受付上限を超えた場合はジョブを拒否する
+            logging.info(f"Rejected job {job.id}: queue is full")
+            await emit({"type": "error", "error": str(e), "done": True})
+        finally:
+            finished = True
+            if pcm_task and not pcm_task.done():
+                pcm_cancelled.set()
+                pcm_task.cancel()
+            if draft_task is not None:
+                # 下書きは次のセグメントで止まる（モデルはプールに返却される）
+                await asyncio.gather(draft_task, return_exceptions=True)
+
+# アップロード中に開始したジョブ（pipelined）の文字起こし処理
+# WAV・FLACは受信済みの部分から文字起こしを始め、アップロードの完了前からセグメントを送る
+# 受信途中からデコードできない形式の場合は、アップロードの完了を待って通常のジョブとして処理する
+async def run_pipelined_job(job, data: dict, audio_hash: str, client_id, upload: GrowingUpload):
+    timer = job.timer
+    streamable, duration = await asyncio.to_thread(upload.probe)
+    if not streamable:
+        logging.info(f"Job {job.id}: audio is not streamable, waiting for the upload to finish")
+        await asyncio.to_thread(upload.wait, upload.size)
+        await run_job(job, data, audio_hash, client_id)
+        return
+    timer.record(pipelined=True)
+
+    async def notify_position(position):
+        await job.emit({"type": "queued", "position": position, "done": False})
+
+    # 実行枠はチャンクごとに取り直し、次のチャンクの音声が届くのを待つ間は他のジョブに譲る
+    # （受信の遅いクライアントがワーカーを占有しないようにする。デコード用スレッドから呼ばれる）
+    loop = asyncio.get_running_loop()
+    priority = job_priority(data)
+    @contextmanager
+    def admit(cancelled):
+        queued_at = time.monotonic()
+        with scheduler.thread_slot(loop, client_id, priority, notify_position, cancelled) as granted:
+            timer.add("queue_wait", time.monotonic() - queued_at)
+            yield granted
+
+    model_name, options = await select_model(job, data, duration)
+    if model_name is None or not await wait_until_ready(job.emit, timer):
+        return
+    try:
+        with scheduler.admission():
+            await transcribe(upload, job.emit, lambda: job.stop, audio_hash, timer=timer, model_key=model_catalog.key(model_name),
+                             options=options, admit=admit)
+    except QueueFullError as e:
+        logging.info(f"Rejected job {job.id}: queue is full")
+        await job.emit({"type": "error", "error": str(e), "done": True})
+
+# 音声の保存状況の問い合わせを処理する関数（アップロードの省略・再開に利用）
+async def handle_probe(websocket: WebSocket, data: dict):
+    try:
+        result = blob_store.probe(data.get('sha256'))
+    except ValueError as e:
+        await send_json_if_connected(websocket, {"type": "error", "error": str(e), "done": True})
+        return
+    await send_json_if_connected(websocket, {"type": "probe_result", "sha256": data['sha256'], **result, "done": False})
+
+# 文字起こしを接続とは独立したジョブとして開始し、ジョブIDをクライアントに通知する関数
+# ジョブの結果はクライアントに中継し（完了の通知も中継タスクが送る）、ファイルにも書き出す
+async def start_job(websocket: WebSocket, data: dict, session_id: int, audio_hash: str, timer, run):
+    job = job_manager.create(run)
+    job.timer = timer
+    # 結果はセグメントが届くたびに字幕・JSONファイルにも書き出す（保持期間を過ぎたファイルはここで削除する）
+    purge_exports()
+    job.export = TranscriptExport(job.id)
+    timer.job_id = job.id
+    timer.record(audio_hash=audio_hash, model=data['model'], parallel=data.get('parallel', False))
+    sessions[session_id]['cancel_on_disconnect'] = bool(data.get('cancel_on_disconnect', False))
+    await send_json_if_connected(websocket, {"type": "job", "job_id": job.id, "done": False})
+    start_stream(websocket, session_id, job)
+    return job
+
+# 受信しながら文字起こしを行うアップロード（pipelined）を処理する関数
+# ジョブを先に開始し、受信済みのバイト数をジョブ側の読み込みに知らせながらバイナリフレームを受信する
+# チェックサムの検証が終わるまでジョブは最後のセグメントと完了を送らず、受信に失敗した場合はジョブを中止する
+async def handle_pipelined_upload(websocket: WebSocket, data: dict, session_id: int, timer):
+    audio_hash = blob_store.validate(data.get('sha256'))
+    upload = GrowingUpload(blob_store.partial_path(audio_hash), blob_store.blob_path(audio_hash), int(data['size']))
+    client_id = websocket.client.host if websocket.client else session_id
+    job = await start_job(websocket, data, session_id, audio_hash, timer,
+                          lambda job: run_pipelined_job(job, data, audio_hash, client_id, upload))
+    try:
+        with timer.stage("upload"):
+            await receive_chunked_upload(websocket, data, upload.extend)
+    except BaseException as e:
+        # エラーは呼び出し元が通知するので、ジョブの結果（中止の通知）は中継しない
+        session = sessions.get(session_id)
+        if session is not None and session['stream'] is not None:
+            session['stream'].cancel()
+            session['stream'] = None
+        upload.fail(e if isinstance(e, Exception) else UploadError("Upload interrupted"))
+        job.cancel("upload")
+        raise
+    upload.finish()
+    logging.info(f"Audio file stored as {audio_hash[:12]} while transcribing")
+
+# アップロードを受信しながら文字起こしするかどうか（保存済みの音声は通常どおり受信を省略する）
+def wants_pipelined(data: dict):
+    if data.get("type") != "upload" or not data.get("pipelined") or not PIPELINE_ENABLED or data.get('save_audio'):
+        return False
+    try:
+        return not blob_store.probe(data.get('sha256'))["exists"]
+    except ValueError:
+        return False  # ハッシュの誤りは通常のアップロード処理で通知する
+
+# 文字起こしリクエストを処理する関数
+async def handle_transcribe(websocket: WebSocket, data: dict, session_id: int):
+    timer = JobTimer()
+    try:
+        if wants_pipelined(data):
+            # 受信しながら文字起こしを始める
+            await handle_pipelined_upload(websocket, data, session_id, timer)
+            return
+        if data.get("type") == "upload":
+            # 後続のバイナリフレームをストアへ直接書き込む（保存済み・受信途中の音声は再送不要）
+            with timer.stage("upload"):
+                audio_hash = await receive_chunked_upload(websocket, data)
+        else:
+            # Base64デコードして音声データを取得し、ストアに保存（従来のJSON一括送信）
+            with timer.stage("base64_decode"):
+                audio_file = base64.b64decode(data.pop('audio'))
+            with timer.stage("spool_write"):
+                audio_hash = await asyncio.to_thread(blob_store.put_bytes, audio_file)
+            del audio_file
+        logging.info(f"Audio file stored as {audio_hash[:12]}")
+
+        # 文字起こしは接続とは独立したジョブとして実行する
+        client_id = websocket.client.host if websocket.client else session_id
+        await start_job(websocket, data, session_id, audio_hash, timer, lambda job: run_job(job, data, audio_hash, client_id))
+        return
+
+    except UploadError as e:
+        # アップロード内容に問題があった場合（チェックサム不一致など）
+        logging.info(f"Upload failed for session {session_id}: {e}")
+        await send_json_if_connected(websocket, {"type": "error", "error": str(e), "done": True})
 
-    except asyncio.CancelledError:
-        logging.info(f"Transcription cancelled for session {session_id}")
     except WebSocketDisconnect:
-        logging.info(f"WebSocket disconnected during transcription for session {session_id}")
+        # アップロード途中の切断（受信済みの部分は再開用に残る）
+        logging.info(f"WebSocket disconnected during upload for session {session_id}")
+        raise
     except Exception as e:
         logging.error(f"Error in handle_transcribe: {e}", exc_info=True)
-        try:
-            if websocket.client_state == WebSocketState.CONNECTED:
-                await websocket.send_json({"error": str(e), "done": True})
-        except:
-            pass
-    finally:
-        # 一時ファイルの削除
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-            logging.info(f"Temporary file removed")
-        try:
-            # 処理完了をクライアントに通知
-            if websocket.client_state == WebSocketState.CONNECTED:
-                await websocket.send_json({"done": True})
-        except:
-            logging.info(f"Client disconnected before sending final message")
+        await send_json_if_connected(websocket, {"error": str(e), "done": True})
+
+    # ジョブを開始できなかったことをクライアントに通知
+    await send_json_if_connected(websocket, {"done": True})
 
 # サーバー起動のためのエントリーポイント
 if __name__ == '__main__':
@@ -135,6 +662,6 @@ if __name__ == '__main__':
         app,
         host="0.0.0.0",  # すべてのネットワークインターフェースでリッスン
         port=5001,  # ポート番号
-        ws_max_size=5 * 1024 * 1024 * 1024,  # WebSocketメッセージの最大サイズ（5GB）
+        ws_max_size=5 * 1024 * 1024 * 1024,  # WebSocketメッセージの最大サイズ（5GB、従来のBase64一括送信用）
         timeout_keep_alive=500,  # キープアライブタイムアウト
     )
\ No newline at end of file
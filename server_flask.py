@@ -1,41 +1,99 @@
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 import os
+import json
+import shutil
 import logging
+import tempfile
 logging.basicConfig(level=logging.DEBUG)
 app = Flask(__name__)
-from transcribe_flask import transcribe
+from transcribe_flask import transcribe, transcribe_messages
+from spool import SPOOL_DIR, file_sha256
+
+# アップロードされた音声を一時保存するディレクトリ
+UPLOAD_DIR = os.path.join(SPOOL_DIR, "flask_uploads")
+
+# ストリーミング応答の形式（NDJSON: 1行1メッセージ / SSE: Server-Sent Events）
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+# 応答の形式を決める関数（stream フォームパラメータ、または Accept ヘッダーで指定）
+def requested_stream_format():
+    stream = request.form.get('stream', '').lower()
+    if stream in STREAM_FORMATS:
+        return stream
+    accept = request.headers.get('Accept', '')
+    for name, mimetype in STREAM_FORMATS.items():
+        if mimetype in accept:
+            return name
+    return None
+
+# メッセージをストリーミング応答の1件分に変換する関数
+def format_message(message, stream_format):
+    line = json.dumps(message, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {message.get('type', 'message')}\ndata: {line}\n\n"
+    return line + "\n"
 
 # 文字起こしAPI（POSTリクエスト用）のエンドポイント
 @app.route('/transcribe_server', methods=['POST'])
 def transcribe_server():
+    file_name = None
     try:
         # リクエストからデータを取得
         audio_file = request.files['audio']  # 音声ファイル
         model = request.form['model']  # 使用するモデル
         save_audio = request.form['save_audio']  # 音声保存フラグ
-        file_name = request.form['file_name']  # ファイル名
-        
-        # 音声ファイルを一時的に保存
-        audio_file.save(file_name)
-        
+        stream_format = requested_stream_format()
+        quality = request.form.get('quality')  # 品質の指定（fast・balanced・accurate。未指定なら balanced）
+        language = request.form.get('language')  # 言語の指定（未指定なら既定の言語、auto なら自動判定）
+
+        # 音声ファイルを重複しない名前で一時的に保存（クライアントのファイル名は使わない）
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        fd, file_name = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=os.path.splitext(request.form.get('file_name', ''))[1])
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(audio_file.stream, f, 1024 * 1024)
+
         # 学習用に音声を保存する場合の処理
         if save_audio == "True":  
-            with open(file_name, 'rb') as f_src:  # 元ファイルを読み込み
-                destination_path = "path_tp_save"  # 保存先のパス
-                with open(destination_path, 'wb') as f_dst:  # 保存先ファイルに書き込み
-                    f_dst.write(f_src.read())
-        
+            destination_path = "path_tp_save"  # 保存先のパス
+            shutil.copyfile(file_name, destination_path)
+
         # 汎用モデルの場合の処理
-        if model == "汎用モデル":
-            result = transcribe(audio_file=file_name)  # 文字起こし実行
+        if model != "汎用モデル":
+            os.remove(file_name)
+            return "Unsupported model", 400
+        audio_hash = file_sha256(file_name).hexdigest()  # キャッシュ検索用の音声ハッシュ
+
+        if stream_format is None:
+            # 結果全体をまとめて返す（従来の形式）
+            try:
+                return transcribe(audio_file=file_name, audio_hash=audio_hash, quality=quality, language=language)  # 文字起こし実行
+            finally:
+                os.remove(file_name)  # 一時ファイルを削除
+
+        # セグメントがデコードされるたびに送信する
+        def generate(path):
+            try:
+                for message in transcribe_messages(path, audio_hash, quality, language):
+                    yield format_message(message, stream_format)
+            except Exception as e:
+                logging.error(f"Streaming transcription failed: {e}", exc_info=True)
+                yield format_message({"type": "error", "error": str(e), "done": True}, stream_format)
+            finally:
+                # 完了・切断のどちらでも、デコードが止まってから一時ファイルを削除
+                os.remove(path)
 
-        # 一時ファイルを削除
-        os.remove(file_name)
-        return result  # 結果を返す
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # プロキシにバッファさせない
+        return Response(stream_with_context(generate(file_name)), mimetype=STREAM_FORMATS[stream_format], headers=headers)
 
     except Exception as e:
+        if file_name and os.path.exists(file_name):
+            os.remove(file_name)
         return str(e), 500  # エラーが発生した場合は500エラーを返す
 
 # メインプログラム（直接実行された場合）
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)  # サーバーを起動（すべてのインターフェースでリッスン）
\ No newline at end of file
+    # リクエストごとのスレッドは結果の中継のみを行い、文字起こしは共有ワーカーで実行する
+    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)  # サーバーを起動（すべてのインターフェースでリッスン）
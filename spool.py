@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# 音声ファイルを保存するディレクトリ
+SPOOL_DIR = os.environ.get("TRANSCRIBE_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "transcribe_spool"))
+# 保存する音声ファイルの合計サイズの上限（超えたら古いものから削除）
+SPOOL_MAX_BYTES = int(os.environ.get("TRANSCRIBE_SPOOL_MAX_BYTES", str(20 * 1024 ** 3)))
+# 途中で止まったアップロードを保持する秒数
+PARTIAL_TTL = float(os.environ.get("TRANSCRIBE_SPOOL_PARTIAL_TTL", str(24 * 60 * 60)))
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# 保存済みのはずの音声が（容量超過で）削除されていたときに送出する例外
+class BlobMissingError(Exception):
+    pass
+
+# ファイルのSHA-256を計算する関数（チャンク単位で読み込む）
+def file_sha256(path, limit=None, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
+
+# 音声ファイルをSHA-256をキーとして一度だけ保存するストア
+# 完成したファイルは blobs/<先頭2文字>/<ハッシュ>、アップロード途中のファイルは partial/<ハッシュ>.part に置く
+class BlobStore:
+    def __init__(self, root=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, partial_ttl=PARTIAL_TTL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.partial_ttl = partial_ttl
+        self._lock = threading.Lock()
+        self._pinned = Counter()  # {ハッシュ: 利用中のジョブ数}（利用中のファイルは削除しない）
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+
+    # ハッシュ文字列の検証（パストラバーサル防止）
+    @staticmethod
+    def validate(sha256):
+        sha256 = (sha256 or "").lower()
+        if not _SHA256_RE.match(sha256):
+            raise ValueError("Invalid sha256")
+        return sha256
+
+    def blob_path(self, sha256):
+        sha256 = self.validate(sha256)
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def partial_path(self, sha256):
+        return os.path.join(self.root, "partial", self.validate(sha256) + ".part")
+
+    # 保存済みかどうかと、途中まで受信済みのバイト数を返す
+    def probe(self, sha256):
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(blob_path):
+            size = os.path.getsize(blob_path)
+            return {"exists": True, "offset": size, "size": size}
+        partial_path = self.partial_path(sha256)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        return {"exists": False, "offset": offset}
+
+    # 途中ファイルを指定位置から書き込むために開く（それ以降の内容は破棄）
+    def open_partial(self, sha256, offset):
+        partial_path = self.partial_path(sha256)
+        current = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if offset > current:
+            raise ValueError(f"Cannot resume at {offset}, only {current} bytes received")
+        f = open(partial_path, 'r+b' if current else 'wb')
+        f.truncate(offset)
+        f.seek(offset)
+        return f
+
+    # 受信済みの先頭部分のハッシュ状態を復元する（再開時にチェックサムを続きから計算するため）
+    def partial_digest(self, sha256, offset):
+        if offset == 0:
+            return hashlib.sha256()
+        return file_sha256(self.partial_path(sha256), limit=offset)
+
+    # 受信が完了した途中ファイルを本保存する
+    def commit(self, sha256):
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(self.partial_path(sha256), blob_path)
+        logging.info(f"Stored audio blob {sha256[:12]}")
+        # 保存したばかりのファイルは削除しない
+        with self.pin(sha256):
+            self.evict()
+        return blob_path
+
+    # メモリ上の音声データを保存する（従来のBase64一括送信用）
+    def put_bytes(self, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.blob_path(sha256)):
+            with open(self.partial_path(sha256), 'wb') as f:
+                f.write(data)
+            self.commit(sha256)
+        return sha256
+
+    # 利用中はファイルを削除対象から外す
+    # 既に削除されていた場合は BlobMissingError を送出する（クライアントは音声を送り直す）
+    @contextmanager
+    def pin(self, sha256):
+        blob_path = self.blob_path(sha256)
+        with self._lock:
+            # 削除は同じロックの中で利用中かを確かめてから行うので、ここで存在すれば利用中は削除されない
+            if not os.path.exists(blob_path):
+                raise BlobMissingError("Audio is no longer stored on the server, please upload it again")
+            self._pinned[sha256] += 1
+        try:
+            # 最終利用時刻を更新（LRU削除用）
+            os.utime(blob_path)
+            yield blob_path
+        finally:
+            with self._lock:
+                self._pinned[sha256] -= 1
+                if self._pinned[sha256] <= 0:
+                    del self._pinned[sha256]
+
+    # 合計サイズが上限を超えた分を最終利用時刻の古い順に削除する
+    def evict(self):
+        now = time.time()
+        # 長時間放置された途中ファイルを削除
+        partial_dir = os.path.join(self.root, "partial")
+        for name in os.listdir(partial_dir):
+            path = os.path.join(partial_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.partial_ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        blobs = []
+        blob_dir = os.path.join(self.root, "blobs")
+        for prefix in os.listdir(blob_dir):
+            for name in os.listdir(os.path.join(blob_dir, prefix)):
+                path = os.path.join(blob_dir, prefix, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, name, path))
+        total = sum(size for _, size, _, _ in blobs)
+        for _, size, name, path in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            with self._lock:
+                if self._pinned[name]:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            logging.info(f"Evicted audio blob {name[:12]}")
+
+    def stats(self):
+        total = 0
+        count = 0
+        blob_dir = os.path.join(self.root, "blobs")
+        for prefix in os.listdir(blob_dir):
+            for name in os.listdir(os.path.join(blob_dir, prefix)):
+                try:
+                    total += os.path.getsize(os.path.join(blob_dir, prefix, name))
+                    count += 1
+                except FileNotFoundError:
+                    pass
+        return {"blobs": count, "bytes": total, "max_bytes": self.max_bytes}
+
+# プロセス全体で共有するストア
+blob_store = BlobStore()
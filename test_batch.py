@@ -0,0 +1,50 @@
+import os
+import asyncio
+from types import SimpleNamespace
+from benchmark import FakeWhisperModel, write_synthetic_audio, FAKE_SEGMENT_SECONDS
+from model_pool import model_pool
+from batch import run_batch, Checkpoint, STATE_FILE
+
+def _args(source, output):
+    return SimpleNamespace(source=str(source), output=str(output), workers=2, model="fake", device="cpu", compute_type="int8",
+                           formats=("srt", "json"), word_timestamps=False)
+
+# 処理済みのファイルは再実行時に飛ばし、内容が変わったファイルだけを文字起こしし直すこと
+def test_resume_skips_finished_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeWhisperModel, "segment_latency", 0.0)
+    monkeypatch.setattr(model_pool, "factory", FakeWhisperModel)
+    monkeypatch.setattr(model_pool, "pool_size", 2)  # コマンドと同じく、ワーカーごとに1つのモデルを使う
+    source = tmp_path / "audio"
+    output = tmp_path / "out"
+    os.makedirs(source / "sub")
+    write_synthetic_audio(str(source / "a.wav"), 2 * FAKE_SEGMENT_SECONDS, seed=101)
+    write_synthetic_audio(str(source / "sub" / "b.wav"), FAKE_SEGMENT_SECONDS, seed=102)
+
+    report = asyncio.run(run_batch(_args(source, output)))
+    assert (report["files"], report["skipped"], report["transcribed"], report["errors"]) == (2, 0, 2, 0)
+    assert report["segments"] == 3
+    assert os.path.exists(output / "a.srt") and os.path.exists(output / "sub" / "b.json")
+
+    report = asyncio.run(run_batch(_args(source, output)))
+    assert (report["skipped"], report["transcribed"]) == (2, 0)
+
+    # 書き換えたファイルだけを処理する
+    write_synthetic_audio(str(source / "a.wav"), FAKE_SEGMENT_SECONDS, seed=103)
+    os.utime(source / "a.wav", (0, 1))
+    report = asyncio.run(run_batch(_args(source, output)))
+    assert (report["skipped"], report["transcribed"], report["segments"]) == (1, 1, 1)
+
+# 書き込み途中で止まった行は読み飛ばし、続きの記録を壊さないこと
+def test_checkpoint_ignores_truncated_line(tmp_path):
+    path = str(tmp_path / STATE_FILE)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"path": "a.wav", "status": "done", "size": 1, "mtime": 2}\n{"path": "b.wav", "sta')
+    checkpoint = Checkpoint(path)
+    checkpoint.record({"path": "c.wav", "status": "done", "size": 1, "mtime": 2})
+    checkpoint.close()
+
+    reloaded = Checkpoint(path)
+    reloaded.close()
+    assert set(reloaded.entries) == {"a.wav", "c.wav"}
+    assert reloaded.is_done("a.wav", SimpleNamespace(st_size=1, st_mtime=2))
+    assert not reloaded.is_done("a.wav", SimpleNamespace(st_size=1, st_mtime=3))
@@ -0,0 +1,31 @@
+import pytest
+from decode_policy import choose_policy, decode_options, plan_decode, POLICIES
+
+# 品質の指定と1ワーカーあたりの待機数から方針を選ぶこと
+@pytest.mark.parametrize("quality, queued, expected", [
+    ("fast", 0, "greedy"),
+    ("balanced", 0, "standard"),
+    ("balanced", 2, "reduced"),
+    ("balanced", 6, "greedy"),
+    ("accurate", 0, "accurate"),
+    ("accurate", 2, "standard"),
+    ("accurate", 6, "reduced"),
+])
+def test_choose_policy(quality, queued, expected):
+    assert choose_policy(quality, queued, 2, mode="adaptive")[0] == expected
+
+def test_fixed_mode_always_standard():
+    assert choose_policy("fast", 100, 1, mode="fixed") == ("standard", "fixed")
+
+# 方針の設定で基本の設定を上書きし、auto の場合は言語を判定させること
+def test_decode_options():
+    base = {"beam_size": 5, "language": "ja", "vad_filter": True}
+    options = decode_options(base, "greedy", "auto")
+    assert options["beam_size"] == POLICIES["greedy"]["beam_size"] and options["vad_filter"]
+    assert options["language"] is None
+    assert decode_options(base, "standard", "en")["language"] == "en"
+
+# 不明な品質の指定は balanced として扱うこと
+def test_plan_decode_unknown_quality():
+    policy, reason, _ = plan_decode({"beam_size": 5}, "best", "ja", 0, 1)
+    assert (policy, reason) == ("standard", "idle")
@@ -0,0 +1,78 @@
+import json
+import asyncio
+import pytest
+from framing import Framer, negotiate, ENCODINGS, MAX_BATCH_INTERVAL, BATCH_INTERVAL
+
+def _segment(index):
+    return {"type": "segment", "start": index, "end": index + 1, "text": f"s{index}", "progress": index, "done": False}
+
+# 対応していない形式・不正な間隔は既定値に、長すぎる間隔は上限にすること
+def test_negotiate():
+    assert negotiate({"encoding": "xml"}) == ("json", BATCH_INTERVAL)
+    assert negotiate({"encoding": "json", "batch_interval": "x"}) == ("json", BATCH_INTERVAL)
+    assert negotiate({"batch_interval": 10}) == ("json", MAX_BATCH_INTERVAL)
+    assert negotiate({"batch_interval": -1}) == ("json", 0.0)
+
+# 間隔内に続けて届いたセグメントは1フレームにまとめ、他のメッセージはその後に送ること
+def test_batches_segments_in_order():
+    frames = []
+
+    async def write(frame):
+        frames.append(json.loads(frame))
+        return True
+
+    async def main():
+        framer = Framer(write, "json", batch_interval=10)
+        for index in range(3):
+            assert await framer.send(_segment(index))
+        await framer.send({"type": "final", "done": True})
+        framer.close()
+    asyncio.run(main())
+
+    # 最初のセグメントはすぐに送り、残りは final の直前にまとめて送る
+    assert [frame["type"] for frame in frames] == ["segments", "segments", "final"]
+    assert [segment["text"] for segment in frames[1]["segments"]] == ["s1", "s2"]
+    assert frames[1]["progress"] == 2 and "type" not in frames[1]["segments"][0]
+
+# encoding を指定しない場合は従来どおり1メッセージずつ time_line 付きで送ること
+def test_legacy_messages():
+    frames = []
+
+    async def write(frame):
+        frames.append(json.loads(frame))
+        return True
+
+    async def main():
+        framer = Framer(write)
+        await framer.send(_segment(0))
+        await framer.send(_segment(1))
+    asyncio.run(main())
+    assert [frame["type"] for frame in frames] == ["segment", "segment"]
+    assert frames[1]["data"] == {"time_line": "[0分1秒 -> 0分2秒] s1", "text": "s1"}
+
+# 送信に失敗したら以降のメッセージは送らないこと
+def test_stops_after_failed_write():
+    frames = []
+
+    async def write(frame):
+        frames.append(frame)
+        return False
+
+    async def main():
+        framer = Framer(write, "json")
+        assert not await framer.send(_segment(0))
+        assert not await framer.send(_segment(1))
+    asyncio.run(main())
+    assert len(frames) == 1
+
+@pytest.mark.skipif("msgpack" not in ENCODINGS, reason="msgpack is not installed")
+def test_msgpack_frames():
+    import msgpack
+    frames = []
+
+    async def write(frame):
+        frames.append(msgpack.unpackb(frame, raw=False))
+        return True
+
+    asyncio.run(Framer(write, "msgpack").send(_segment(0)))
+    assert frames[0]["segments"][0]["text"] == "s0"
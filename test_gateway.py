@@ -0,0 +1,45 @@
+import pytest
+import pydantic
+from fastapi.testclient import TestClient
+import gateway
+from fleet import WorkerRegistry
+
+STATUS = {"url": "ws://worker-1:5001/ws", "running": 0, "queued": 0, "max_workers": 1,
+          "warm_models": ["汎用モデル"], "ready": True, "sessions": 0}
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(gateway, "registry", WorkerRegistry())
+    monkeypatch.setattr(gateway, "heartbeat_token", "secret")
+    return TestClient(gateway.app)
+
+# トークンが一致しないワーカーは登録しないこと
+def test_heartbeat_requires_token(client):
+    assert client.post("/workers/heartbeat", json=STATUS).status_code == 401
+    assert client.post("/workers/heartbeat", json=STATUS, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert gateway.registry.choose("汎用モデル") is None
+
+# 振り分けに使う項目が欠けた状態は 422 で拒否し、振り分けを壊さないこと
+def test_malformed_heartbeat_is_rejected(client):
+    headers = {"Authorization": "Bearer secret"}
+    for broken in ({k: v for k, v in STATUS.items() if k != "queued"}, {**STATUS, "url": "http://evil"}, {**STATUS, "running": -1}):
+        assert client.post("/workers/heartbeat", json=broken, headers=headers).status_code == 422
+    assert client.post("/workers/heartbeat", json=STATUS, headers=headers).status_code == 200
+    assert gateway.registry.choose("汎用モデル") == STATUS["url"]
+    assert gateway.registry.stats()["workers"][0]["sessions"] == 0  # 表示用の項目は残る
+
+# トークンを設定していないゲートウェイはワーカーを受け付けないこと
+def test_heartbeat_refused_without_configured_token(client, monkeypatch):
+    monkeypatch.setattr(gateway, "heartbeat_token", "")
+    assert client.post("/workers/heartbeat", json=STATUS, headers={"Authorization": "Bearer "}).status_code == 403
+
+# 空きと読み込み済みのモデルで振り分け先を選び、不正な状態は記録しないこと
+def test_registry_prefers_warm_idle_workers():
+    registry = WorkerRegistry()
+    registry.heartbeat({**STATUS, "url": "ws://busy:5001/ws", "running": 1})
+    registry.heartbeat({**STATUS, "url": "ws://cold:5001/ws", "warm_models": []})
+    registry.heartbeat(STATUS)
+    assert registry.choose("汎用モデル") == STATUS["url"]
+    with pytest.raises(pydantic.ValidationError):
+        registry.heartbeat({"url": "ws://broken:5001/ws"})
+    assert len(registry.stats()["workers"]) == 3
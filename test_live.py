@@ -0,0 +1,20 @@
+import numpy as np
+from benchmark import FakeWhisperModel, write_synthetic_audio
+from model_pool import model_pool
+from audio_ingest import stream_pcm
+from live import LiveTranscriber, MAX_BUFFER_SECONDS, SAMPLING_RATE
+
+# 単語が得られず何も確定できない場合でも、バッファが最大長を超えて伸び続けないこと
+def test_buffer_is_bounded_without_commits(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeWhisperModel, "segment_latency", 0.0)
+    monkeypatch.setattr(model_pool, "factory", FakeWhisperModel)  # 偽モデルは単語のタイムスタンプを返さない
+    path = write_synthetic_audio(str(tmp_path / "live.wav"), 45)
+    audio = np.concatenate(list(stream_pcm(path)))
+
+    transcriber = LiveTranscriber()
+    for position in range(0, len(audio), 2 * SAMPLING_RATE):
+        transcriber.insert_audio(audio[position:position + 2 * SAMPLING_RATE])
+        transcriber.process()
+        assert len(transcriber.buffer) / SAMPLING_RATE <= MAX_BUFFER_SECONDS
+    assert transcriber.committed_text == ""
+    assert transcriber.buffer_offset > 0
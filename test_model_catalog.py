@@ -0,0 +1,43 @@
+import pytest
+from model_catalog import ModelCatalog, DEFAULT_CATALOG, model_languages
+
+CONFIG = {
+    "models": {
+        "large": {"name": "large-v3", "device": "cpu", "compute_type": "int8", "speed": 1},
+        "distil": {"name": "distil-large-v3", "device": "cpu", "compute_type": "int8", "speed": 10},
+        "small": {"name": "small", "device": "cpu", "compute_type": "int8", "speed": 5},
+    },
+    "labels": {"汎用モデル": "large"},
+    "fast": ["distil", "small"],
+    "draft": "distil",
+}
+
+# 英語専用のモデルは名前から判断し、languages を指定すればそれに従うこと
+def test_model_languages():
+    assert model_languages({"name": "distil-large-v3"}) == ("en",)
+    assert model_languages({"name": "small.en"}) == ("en",)
+    assert model_languages({"name": "large-v3-turbo"}) is None
+    assert model_languages({"name": "/models/tuned", "languages": ["ja"]}) == ("ja",)
+
+# 既定の言語に対応していない速いモデル・下書きのモデルは使わないこと
+def test_unsupported_fast_and_draft_models_are_dropped():
+    catalog = ModelCatalog(CONFIG, language="ja")
+    assert catalog.fast == ["small"]
+    assert catalog.draft is None
+    assert catalog.choose("汎用モデル", "fast", 60, 0, 1) == ("small", "fast tier")
+    # 英語のジョブでは英語専用のモデルも使える
+    english = ModelCatalog(CONFIG, language="en")
+    assert english.choose("汎用モデル", "fast", 60, 0, 1, language="en") == ("distil", "fast tier")
+    assert english.choose("汎用モデル", "fast", 60, 0, 1, language="ja") == ("small", "fast tier")
+
+# 精度重視のモデルが既定の言語に対応していなければ設定の誤りとして扱うこと
+def test_label_model_must_support_language():
+    config = {**CONFIG, "labels": {"英語モデル": "distil"}}
+    with pytest.raises(ValueError):
+        ModelCatalog(config, language="ja")
+
+# 既定のモデル一覧は日本語のジョブで使えるモデルだけを速いモデルにしていること
+def test_default_catalog_fast_models_support_japanese():
+    catalog = ModelCatalog(DEFAULT_CATALOG, language="ja")
+    assert catalog.fast == DEFAULT_CATALOG["fast"]
+    assert catalog.draft == DEFAULT_CATALOG["draft"]
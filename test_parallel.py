@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+import parallel
+from benchmark import FakeWhisperModel, write_synthetic_audio, FAKE_SEGMENT_SECONDS
+from model_pool import model_pool
+from audio_ingest import stream_pcm
+from parallel import transcribe_parallel, worker_share, SAMPLING_RATE
+
+# 偽モデルの同時実行数を数える
+class CountingModel(FakeWhisperModel):
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def transcribe(self, audio, **options):
+        segments, info = super().transcribe(audio, **options)
+
+        def counted():
+            with CountingModel.lock:
+                CountingModel.running += 1
+                CountingModel.peak = max(CountingModel.peak, CountingModel.running)
+            try:
+                yield from segments
+            finally:
+                with CountingModel.lock:
+                    CountingModel.running -= 1
+        return counted(), info
+
+# 合成音声は VAD で発話と判定されないため、チャンクは目安の長さで機械的に区切る
+def _fixed_chunks(audio, chunk_seconds):
+    step = int(chunk_seconds * SAMPLING_RATE)
+    return [(start, min(len(audio), start + step)) for start in range(0, len(audio), step)]
+
+def _audio(tmp_path, seconds, monkeypatch):
+    monkeypatch.setattr(parallel, "plan_chunks", _fixed_chunks)
+    path = write_synthetic_audio(str(tmp_path / "long.wav"), seconds)
+    return np.concatenate(list(stream_pcm(path)))
+
+# 1ジョブの取り分は、モデルプールを実行枠の数で等分した数
+def test_worker_share(monkeypatch):
+    monkeypatch.setattr(model_pool, "pool_size", 4)
+    monkeypatch.setattr(parallel, "PARALLEL_WORKERS", 0)
+    assert worker_share(4) == 1
+    assert worker_share(2) == 2
+    monkeypatch.setattr(parallel, "PARALLEL_WORKERS", 1)
+    assert worker_share(1) == 1
+
+# セグメントは時刻順に流れ、同時に使うモデルは workers 個まで
+def test_segments_in_order_within_worker_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeWhisperModel, "segment_latency", 0.02)
+    monkeypatch.setattr(model_pool, "factory", CountingModel)
+    monkeypatch.setattr(model_pool, "pool_size", 4)
+    monkeypatch.setattr(CountingModel, "peak", 0)  # 他のテストで読み込んだモデルを使わないよう、別の名前のモデルを借りる
+    audio = _audio(tmp_path, 60, monkeypatch)
+
+    segments, info = transcribe_parallel(audio, {}, workers=2, model_key=("counting",), chunk_seconds=10)
+    starts = [segment.start for segment in segments]
+    assert starts == sorted(starts)
+    assert len(starts) == 60 / FAKE_SEGMENT_SECONDS and info.duration == len(audio) / SAMPLING_RATE
+    assert CountingModel.peak == 2
+
+# セグメントを読み始める前や途中で閉じた場合も、残りのチャンクを止めてモデルを返す
+def test_close_returns_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_pool, "factory", FakeWhisperModel)
+    monkeypatch.setattr(model_pool, "pool_size", 1)
+    audio = _audio(tmp_path, 30, monkeypatch)
+
+    for read in (0, 1):
+        segments, _ = transcribe_parallel(audio, {}, workers=1, model_key=("closing",), chunk_seconds=10)
+        for _ in range(read):
+            next(segments)
+        segments.close()
+        assert not [thread for thread in threading.enumerate() if thread.name.startswith("parallel-chunk")]
+        # 返却されていなければ借りられずに待ち続ける
+        key, model = model_pool.acquire("closing")
+        model_pool.release(key, model)
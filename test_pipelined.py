@@ -0,0 +1,38 @@
+import os
+import asyncio
+from benchmark import FakeWhisperModel, write_synthetic_audio
+from model_pool import model_pool
+from scheduler import JobScheduler
+from pipelined import GrowingUpload, transcribe_pipelined
+
+# 受信中の音声を待つ間は実行枠を返し、ワーカーが1つでも他のジョブが先に実行できること
+def test_slot_is_released_while_waiting_for_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeWhisperModel, "segment_latency", 0.0)
+    monkeypatch.setattr(model_pool, "factory", FakeWhisperModel)
+    path = write_synthetic_audio(str(tmp_path / "upload.wav"), 30)
+    size = os.path.getsize(path)
+
+    async def main():
+        scheduler = JobScheduler(max_workers=1)
+        loop = asyncio.get_running_loop()
+        upload = GrowingUpload(path, path, size)
+        upload.extend(size // 2)  # 半分だけ届いた状態
+
+        def admit(cancelled):
+            return scheduler.thread_slot(loop, "uploader", cancelled=cancelled)
+
+        def consume():
+            segments, _ = transcribe_pipelined(upload, {}, chunk_seconds=5, admit=admit)
+            return list(segments)
+
+        consumer = asyncio.create_task(asyncio.to_thread(consume))
+        await asyncio.sleep(1.0)  # 届いた分の文字起こしを終えて、残りを待っている
+        assert scheduler.running == 0
+        await asyncio.wait_for(scheduler.acquire("other"), timeout=0.5)
+        scheduler.release("other")
+
+        upload.finish()
+        segments = await consumer
+        assert segments[-1].end > 25
+        assert scheduler.running == 0 and scheduler.queued == 0
+    asyncio.run(main())
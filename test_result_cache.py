@@ -0,0 +1,31 @@
+from result_cache import ResultCache
+
+# 設定の順序が違っても同じキーになり、保存した結果をそのまま返すこと
+def test_put_and_get(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    key = ResultCache.make_key("hash", ("tiny", "cpu", "int8"), {"beam_size": 5, "language": "ja"})
+    assert key == ResultCache.make_key("hash", ("tiny", "cpu", "int8"), {"language": "ja", "beam_size": 5})
+    assert key != ResultCache.make_key("hash", ("tiny", "cpu", "int8"), {"language": "en", "beam_size": 5})
+    assert cache.get(key) is None
+
+    cache.put(key, {"language": "ja"}, [[0.0, 1.5, "こんにちは"]])
+    assert cache.contains(key)
+    assert cache.get(key) == {"info": {"language": "ja"}, "segments": [[0.0, 1.5, "こんにちは"]]}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+# 期限切れの結果は返さないこと
+def test_expired_results_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), ttl=-1)
+    cache.put("key", {}, [])
+    assert not cache.contains("key")
+    assert cache.get("key") is None
+
+# 件数の上限を超えたら、最後に使われたのが古いものから削除すること
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.put("a", {}, [])
+    cache.put("b", {}, [])
+    assert cache.get("a") is not None  # a を使ったので b の方が古くなる
+    cache.put("c", {}, [])
+    assert cache.contains("a") and cache.contains("c")
+    assert not cache.contains("b")
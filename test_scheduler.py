@@ -0,0 +1,79 @@
+import asyncio
+import threading
+from collections import Counter
+import pytest
+from scheduler import JobScheduler, QueueFullError
+
+# 待機中のジョブを取り消した直後（同じ周回）に実行枠が返却されても、枠を取り消したジョブに割り当てないこと
+def test_cancel_then_release_in_same_tick():
+    async def main():
+        scheduler = JobScheduler(max_workers=1)
+        await scheduler.acquire("a")
+        waiting_b = asyncio.create_task(scheduler.acquire("b"))
+        waiting_c = asyncio.create_task(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+        waiting_b.cancel()
+        scheduler.release("a")  # 取り消しが acquire に届く前に枠を返す
+        with pytest.raises(asyncio.CancelledError):
+            await waiting_b
+        await waiting_c
+        assert scheduler._running == Counter({"c": 1})
+        assert scheduler.queued == 0
+        scheduler.release("c")
+        assert scheduler.running == 0
+    asyncio.run(main())
+
+# 優先度が同じなら、実行中のジョブが少ないクライアントから順に割り当てること
+def test_round_robin_between_clients():
+    async def main():
+        scheduler = JobScheduler(max_workers=1)
+        await scheduler.acquire("a")
+        order = []
+
+        async def job(client_id):
+            await scheduler.acquire(client_id)
+            order.append(client_id)
+            scheduler.release(client_id)
+
+        tasks = [asyncio.create_task(job(client_id)) for client_id in ("a", "a", "b")]
+        await asyncio.sleep(0)
+        scheduler.release("a")
+        await asyncio.gather(*tasks)
+        assert order == ["b", "a", "a"]
+    asyncio.run(main())
+
+# 待機列が上限に達したら QueueFullError で拒否すること
+def test_rejects_when_queue_is_full():
+    async def main():
+        scheduler = JobScheduler(max_workers=1, max_queue=1)
+        await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire("c")
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.queued == 0 and scheduler.counters["rejected"] == 1
+    asyncio.run(main())
+
+# 別スレッドからの枠の確保を待つ間に取り消されたら、枠を確保せずに待機列からも外れること
+def test_thread_slot_cancelled_while_waiting():
+    async def main():
+        scheduler = JobScheduler(max_workers=1)
+        loop = asyncio.get_running_loop()
+        await scheduler.acquire("a")
+        cancelled = threading.Event()
+
+        def worker():
+            with scheduler.thread_slot(loop, "b", cancelled=cancelled) as granted:
+                return granted
+
+        waiting = asyncio.create_task(asyncio.to_thread(worker))
+        await asyncio.sleep(0.1)
+        assert scheduler.queued == 1
+        cancelled.set()
+        assert await waiting is False
+        assert scheduler.queued == 0
+        scheduler.release("a")
+        assert scheduler.running == 0
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import hashlib
+import os
+import pytest
+from spool import BlobStore, BlobMissingError
+
+def _sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+# 途中まで受信したファイルは、受信済みの位置とハッシュの状態を引き継いで再開できること
+def test_resume_partial_upload(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = os.urandom(1000)
+    sha256 = _sha(data)
+    with store.open_partial(sha256, 0) as f:
+        f.write(data[:400])
+    assert store.probe(sha256) == {"exists": False, "offset": 400}
+
+    digest = store.partial_digest(sha256, 400)
+    with store.open_partial(sha256, 400) as f:
+        f.write(data[400:])
+    digest.update(data[400:])
+    assert digest.hexdigest() == sha256
+    path = store.commit(sha256)
+    assert store.probe(sha256) == {"exists": True, "offset": 1000, "size": 1000}
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+# 上限を超えたら古いものから削除し、利用中のファイルは削除しないこと
+def test_evict_skips_pinned_blobs(tmp_path):
+    store = BlobStore(str(tmp_path), max_bytes=1500)
+    old = store.put_bytes(b"a" * 1000)
+    with store.pin(old):
+        store.put_bytes(b"b" * 1000)
+        assert store.probe(old)["exists"]
+    newest = store.put_bytes(b"c" * 1000)
+    assert not store.probe(old)["exists"]
+    assert store.probe(newest)["exists"]
+    with pytest.raises(BlobMissingError):
+        with store.pin(old):
+            pass
+
+# ハッシュ以外の文字列はパスとして使わないこと
+def test_rejects_invalid_hash(tmp_path):
+    store = BlobStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.blob_path("../" + "0" * 61)
+    assert store.validate("A" * 64) == "a" * 64
@@ -0,0 +1,58 @@
+import os
+import time
+import asyncio
+from benchmark import FakeWhisperModel, write_synthetic_audio, FAKE_SEGMENT_SECONDS
+from model_pool import model_pool
+from transcribe_fastapi import transcribe
+
+SEGMENTS = 6
+
+# 2つのジョブを同時に文字起こしし、[(ジョブ番号, 送信時刻), ...] と待機中に動いたタイマーの回数を返す非同期関数
+async def _run_two_jobs(paths):
+    sent = []
+    ticks = 0
+    running = True
+
+    async def ticker():
+        nonlocal ticks
+        while running:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    def sender(job):
+        async def send(message):
+            if message.get("type") == "segment":
+                sent.append((job, time.monotonic()))
+            return True
+        return send
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        await asyncio.gather(*(transcribe(path, sender(job), lambda: False) for job, path in enumerate(paths)))
+    finally:
+        running = False
+        await ticker_task
+    return sent, ticks
+
+# 2つのジョブのセグメントが交互に送られ（デコードが並行し）、その間もイベントループが止まらないこと
+def test_concurrent_jobs_interleave_without_blocking_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeWhisperModel, "segment_latency", 0.05)
+    monkeypatch.setattr(model_pool, "factory", FakeWhisperModel)
+    monkeypatch.setattr(model_pool, "pool_size", 2)  # 2つのジョブが同時にモデルを借りられる
+    paths = [write_synthetic_audio(str(tmp_path / f"job{job}.wav"), SEGMENTS * FAKE_SEGMENT_SECONDS, seed=job)
+             for job in range(2)]
+
+    start = time.monotonic()
+    sent, ticks = asyncio.run(_run_two_jobs(paths))
+    elapsed = time.monotonic() - start
+
+    jobs = [job for job, _ in sorted(sent, key=lambda item: item[1])]
+    assert jobs.count(0) == SEGMENTS and jobs.count(1) == SEGMENTS
+    # 片方のジョブが終わってからもう片方が始まるのではなく、送信の順番が何度も入れ替わる
+    switches = sum(a != b for a, b in zip(jobs, jobs[1:]))
+    assert switches >= SEGMENTS
+    # 最初のセグメントの送信時刻の差は、1セグメント分のデコード時間より短い
+    first = [min(t for job, t in sent if job == j) for j in range(2)]
+    assert abs(first[0] - first[1]) < FakeWhisperModel.segment_latency * 2
+    # デコード中も 10ms ごとのタイマーが動き続けている
+    assert ticks >= elapsed / 0.01 * 0.5
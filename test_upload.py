@@ -0,0 +1,75 @@
+import os
+import asyncio
+import hashlib
+import pytest
+import upload
+from spool import BlobStore
+from upload import receive_chunked_upload, UploadError
+from starlette.websockets import WebSocketDisconnect
+
+# 送信するフレームを順に返し、サーバーからのメッセージを記録するWebSocketの代わり
+class FakeWebSocket:
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    async def receive(self):
+        if not self.frames:
+            return {"type": "websocket.disconnect", "code": 1001}
+        return {"type": "websocket.receive", "bytes": self.frames.pop(0)}
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path))
+    monkeypatch.setattr(upload, "blob_store", store)
+    return store
+
+# チャンクごとに受信済みバイト数を返し、チェックサムが一致すれば本保存すること
+def test_chunked_upload(store):
+    data = os.urandom(2500)
+    sha256 = hashlib.sha256(data).hexdigest()
+    websocket = FakeWebSocket(_chunks(data, 1000))
+    progress = []
+    header = {"size": len(data), "sha256": sha256, "chunk_size": 1000}
+    assert asyncio.run(receive_chunked_upload(websocket, header, progress.append)) == sha256
+    assert [m["received"] for m in websocket.sent if m["type"] == "upload_ack"] == [1000, 2000, 2500]
+    assert progress == [1000, 2000, 2500]
+    assert store.probe(sha256)["exists"]
+
+    # 保存済みの音声は受信しない
+    again = FakeWebSocket([])
+    assert asyncio.run(receive_chunked_upload(again, header)) == sha256
+    assert again.sent == [{"type": "upload_ack", "received": len(data), "done": False}]
+
+# 切断されたアップロードは、受信済みの位置から再開できること
+def test_resume_after_disconnect(store):
+    data = os.urandom(2500)
+    sha256 = hashlib.sha256(data).hexdigest()
+    header = {"size": len(data), "sha256": sha256, "chunk_size": 1000}
+    with pytest.raises(WebSocketDisconnect):
+        asyncio.run(receive_chunked_upload(FakeWebSocket(_chunks(data[:1000], 1000)), header))
+    assert store.probe(sha256) == {"exists": False, "offset": 1000}
+
+    websocket = FakeWebSocket(_chunks(data[1000:], 1000))
+    assert asyncio.run(receive_chunked_upload(websocket, {**header, "offset": 1000})) == sha256
+    assert websocket.sent[0]["offset"] == 1000
+    with open(store.blob_path(sha256), "rb") as f:
+        assert f.read() == data
+
+# チェックサムが一致しない・宣言より大きい場合は拒否し、本保存しないこと
+def test_rejects_bad_uploads(store):
+    data = os.urandom(1500)
+    sha256 = hashlib.sha256(data).hexdigest()
+    with pytest.raises(UploadError, match="Checksum"):
+        asyncio.run(receive_chunked_upload(FakeWebSocket([data[:1499] + b"x"]), {"size": 1500, "sha256": sha256}))
+    assert store.probe(sha256) == {"exists": False, "offset": 0}
+    with pytest.raises(UploadError, match="exceeds"):
+        asyncio.run(receive_chunked_upload(FakeWebSocket([data]), {"size": 1000, "sha256": sha256}))
+    with pytest.raises(UploadError):
+        asyncio.run(receive_chunked_upload(FakeWebSocket([]), {"size": 10, "sha256": "../etc"}))
@@ -1,7 +1,15 @@
+import os
 import asyncio  
-from faster_whisper import WhisperModel  
-from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
-import websockets
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+from model_pool import model_pool, DEFAULT_MODEL
+from result_cache import result_cache
+from parallel import transcribe_parallel
+from pipelined import GrowingUpload, transcribe_pipelined
+from batching import BATCHING_ENABLED, get_batcher, is_batchable
+from metrics import JobTimer
 import logging
 
 # 秒数を「○分○秒」形式に変換する関数
@@ -10,116 +18,274 @@ def convert_seconds(seconds):
     remaining_seconds = seconds % 60  # 残りの秒数
     return f"{int(minutes)}分{int(remaining_seconds)}秒"  
 
-# WebSocketメッセージ送信のヘルパー関数
-async def send_websocket_message(websocket, message, session_id):
+# 文字起こしの設定（キャッシュのキーにも使う）
+DECODE_OPTIONS = {
+    "language": "ja",  # 日本語を指定
+    "beam_size": 5,    # ビームサイズ（精度向上のため）
+    "vad_filter": True, # 声の検出フィルターを有効化
+    "without_timestamps": True,  # タイムスタンプなし
+}
+
+# 二段階モードの下書き用の設定（速度を優先してビームサーチを行わない）
+DRAFT_OPTIONS = {**DECODE_OPTIONS, "beam_size": 1}
+# 同時に作成する下書きの上限（下書きはジョブの実行枠を使わないため、スレッドとモデルを待つ数をここで抑える）
+MAX_DRAFTS = max(1, int(os.environ.get("TRANSCRIBE_MAX_DRAFTS", "2")))
+# 待機中のジョブがこの数を超えている場合は下書きを作らない
+DRAFT_MAX_QUEUED = int(os.environ.get("TRANSCRIBE_DRAFT_MAX_QUEUED", "4"))
+_draft_slots = asyncio.Semaphore(MAX_DRAFTS)
+
+# 単語ごとのタイムスタンプを求める場合の設定（字幕・JSONの書き出し用）
+WORD_OPTIONS = {**DECODE_OPTIONS, "word_timestamps": True}
+
+# デコード用スレッドからイベントループ側のキューへ結果を渡す関数
+def _decode_worker(audio_file, loop, queue, should_stop, cancelled, timer, parallel=False, model_key=DEFAULT_MODEL, options=DECODE_OPTIONS,
+                   admit=None, workers=None):
+    def put(kind, value=None):
+        loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+
     try:
-        if websocket.client_state == WebSocketState.CONNECTED:
-            await websocket.send_json(message)
-            return True
-    except (WebSocketDisconnect, websockets.exceptions.ConnectionClosedOK, RuntimeError) as e:
-        logging.info(f"WebSocket connection issue for session {session_id}")
-        return False
+        if isinstance(audio_file, GrowingUpload):
+            # 受信中の音声は、届いた部分から発話の切れ目で区切って順に文字起こしする（モデルはチャンクごとに借りる）
+            _decode_segments(lambda: transcribe_pipelined(audio_file, options, model_key=model_key, cancelled=cancelled, admit=admit), put, should_stop, cancelled, timer)
+        elif parallel:
+            # 無音区間で分割したチャンクを複数のモデルで並列に文字起こしする（モデルはチャンクごとに借りる）
+            _decode_segments(lambda: transcribe_parallel(audio_file, options, workers, model_key, cancelled=cancelled), put, should_stop, cancelled, timer)
+        elif BATCHING_ENABLED and is_batchable(audio_file):
+            # 短い音声は同時に届いた他のジョブとまとめてバッチ推論する
+            _decode_segments(lambda: get_batcher(options, model_key).transcribe(audio_file, options, cancelled), put, should_stop, cancelled, timer)
+        else:
+            # 共有プールからモデルを借り、デコードが終わるまで保持する
+            with timer.stage("model_acquire"):
+                key, model = model_pool.acquire(*model_key)
+            try:
+                _decode_segments(lambda: model.transcribe(audio_file, **options), put, should_stop, cancelled, timer)
+            finally:
+                model_pool.release(key, model)
+    except Exception as e:
+        put("error", e)
+    finally:
+        put("end")
+
+# 文字起こしを開始し、得られたセグメントを順にキューへ渡す関数
+# transcribe() の呼び出し（音声のデコード・VAD・特徴量抽出）を prepare、セグメントの生成を decode として計測する
+def _decode_segments(start_transcribe, put, should_stop, cancelled, timer):
+    # モデルの空きを待つ間に中断された場合は推論を始めない
+    if cancelled.is_set() or should_stop():
+        put("stopped")
+        return
+    started = time.monotonic()
+    try:
+        with timer.stage("prepare"):
+            segments, info = start_transcribe()
+    except Exception as e:
+        put("transcribe_error", e)
+        return
+    put("info", info)
+
+    # segmentsは遅延評価のジェネレータなので、実際のデコードはここで行われる
+    decode_started = time.monotonic()
+    processed = 0.0  # デコード済みの音声の位置（秒）
+    try:
+        for segment in segments:
+            put("segment", segment)
+            processed = segment.end
+            # 停止要求・切断があれば次のセグメント（次の30秒の窓）をデコードせずに終了
+            if cancelled.is_set() or should_stop():
+                break
+        if cancelled.is_set() or should_stop():
+            # デコードしなかった音声の長さと、それにかかったはずの時間を記録する
+            timer.record_cancel(info.duration - processed, processed, time.monotonic() - started)
+            put("stopped")
+            return
+        timer.record_decode(info.duration, time.monotonic() - started)
+    finally:
+        # ジェネレータを閉じてデコードを打ち切る
+        close = getattr(segments, "close", None)
+        if close is not None:
+            close()
+        timer.add("decode", time.monotonic() - decode_started)
+
+# 結果キャッシュのキーを作成する関数
+def make_cache_key(audio_hash, parallel=False, model_key=DEFAULT_MODEL, options=DECODE_OPTIONS):
+    return result_cache.make_key(audio_hash, model_key, {**options, "parallel": parallel})
+
+# キャッシュ済みの結果をデコード結果と同じ形でキューに流す関数
+def _replay_cached(cached, queue):
+    info = cached["info"]
+    queue.put_nowait(("info", SimpleNamespace(**info)))
+    # 単語ごとのタイムスタンプがある場合は4番目の要素に [開始秒, 終了秒, 単語] のリストが入っている
+    for start, end, text, *words in cached["segments"]:
+        words = [SimpleNamespace(start=w[0], end=w[1], word=w[2]) for w in words[0]] if words else None
+        queue.put_nowait(("segment", SimpleNamespace(start=start, end=end, text=text, words=words)))
+    queue.put_nowait(("end", None))
 
 # 音声ファイルを文字起こしする非同期関数
-async def transcribe(audio_file, websocket: WebSocket, session_id: int, should_stop):  
-    model = WhisperModel("large-v3", device="cuda", compute_type="float16")
+# audio_file には音声ファイルのパス、16kHzモノラルのfloat32配列（デコード済みPCM）、または受信中の音声（pipelined.GrowingUpload）を渡す
+# 結果は send(message) で送信する（送信できなかった場合は False を返すこと）
+# audio_hash を渡すと、同じ音声・同じ設定の結果をキャッシュから返す
+# parallel=True の場合は長時間音声をチャンクに分けて並列に処理する（workers は同時に使うモデルの数の上限）
+# timer（metrics.JobTimer）を渡すと、処理段階ごとの所要時間をジョブの計測記録に残す
+# model_key（名前, デバイス, 計算精度）と options で使うモデルとデコード設定を指定できる
+# admit は受信中の音声をチャンクごとに文字起こしする際の実行枠（pipelined.transcribe_pipelined を参照）
+async def transcribe(audio_file, send, should_stop, audio_hash=None, parallel=False, timer=None,
+                     model_key=DEFAULT_MODEL, options=DECODE_OPTIONS, admit=None, workers=None):  
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    timer = timer or JobTimer()
+    send = _timed_send(send, timer)
+
+    cache_key = None
+    if audio_hash:
+        # 受信中に区切って処理した結果は区切り位置が異なるため、別のキーで保存する
+        mode = "pipelined" if isinstance(audio_file, GrowingUpload) else parallel
+        cache_key = make_cache_key(audio_hash, mode, model_key, options)
+        with timer.stage("cache_lookup"):
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+        timer.record(cache_hit=cached is not None)
+        if cached is not None:
+            # キャッシュがあればデコードせずに同じメッセージを再送する
+            logging.info(f"Replaying cached transcription")
+            _replay_cached(cached, queue)
+            await _send_results(queue, send, should_stop)
+            timer.add("send", send.seconds)
+            return
 
+    cancelled = threading.Event()  # 送信側からデコードスレッドへの中断通知
+
+    # デコードは別スレッドで行い、イベントループは送信のみを担当する
+    worker = loop.run_in_executor(None, _decode_worker, audio_file, loop, queue, should_stop, cancelled, timer, parallel,
+                                  model_key, options, admit, workers)
     try:
-        # to_threadでメインスレッドをブロックしないよう実行
-        segments, info = await asyncio.to_thread(  
-            model.transcribe,  
-            audio_file,  
-            language="ja",  # 日本語を指定
-            beam_size=5,    # ビームサイズ（精度向上のため）
-            vad_filter=True, # 声の検出フィルターを有効化
-            without_timestamps=True,  # タイムスタンプなし
-        )  
-    except Exception as e:
-        logging.error(f"Error during model.transcribe: {e}")
+        result = await _send_results(queue, send, should_stop)
+    finally:
+        # デコードスレッドの終了を待つ（モデルはスレッド側でプールに返却される）
+        cancelled.set()
+        await asyncio.shield(worker)
+        timer.add("send", send.seconds)
+
+    # 最後まで文字起こしできた結果のみキャッシュに保存
+    if cache_key and result is not None:
+        await asyncio.to_thread(result_cache.put, cache_key, *result)
+
+# 速いモデルで下書きを作り、セグメントを {"type": "draft", ...} として送る非同期関数（二段階モード用）
+# クライアントは後から届く通常のセグメントで、同じ区間の下書きを置き換える
+# 下書きの失敗はジョブの失敗として扱わない（language は本番の文字起こしと同じ言語の指定）
+# 同時に作成する下書きは MAX_DRAFTS までで、空きを待つ間はスレッドを使わない（待つ間に本番が終われば作らない）
+async def transcribe_draft(audio_file, send, should_stop, audio_hash=None, model_key=DEFAULT_MODEL, language=DRAFT_OPTIONS["language"]):
+    async def send_draft(message):
+        if message.get("type") == "segment":
+            return await send({**message, "type": "draft"})
+        return True  # 下書きの info や完了通知は送らない
+
+    async with _draft_slots:
+        if should_stop():
+            return
+        try:
+            await transcribe(audio_file, send_draft, should_stop, audio_hash, model_key=model_key, options={**DRAFT_OPTIONS, "language": language})
+        except Exception as e:
+            logging.error(f"Draft transcription failed: {e}")
+            return
+    if not should_stop():
+        await send({"type": "draft_done", "done": False})
+
+# 送信にかかった時間を合計する send のラッパー（メッセージごとではなくジョブ全体で1回記録する）
+def _timed_send(send, timer):
+    async def timed(message):
+        start = time.monotonic()
+        try:
+            return await send(message)
+        finally:
+            timed.seconds += time.monotonic() - start
+    timed.seconds = 0.0
+    return timed
+
+# 完了メッセージを作成する関数
+# クライアントは受信したセグメント数と、テキストを順に連結した文字列のSHA-256で受信漏れを確認できる
+def final_message(segment_count, digest):
+    return {
+        "type": "final",
+        "data": {
+            "segment_count": segment_count,
+            "sha256": digest.hexdigest(),
+        },
+        "done": True,
+    }
+
+# キューに流れてきたデコード結果をクライアントに送信する関数
+async def _send_results(queue, send, should_stop):
+    kind, value = await queue.get()
+    if kind == "transcribe_error":
+        logging.error(f"Error during model.transcribe: {value}")
         # エラーが発生した場合もクライアントに通知
-        await send_websocket_message(
-            websocket, 
-            {"type": "error", "message": "Transcription failed during processing.", "done": True},
-            session_id
-        )
+        await send({"type": "error", "message": "Transcription failed during processing.", "done": True})
         return
+    if kind == "error":
+        raise value
+    if kind != "info":
+        return
+    info = value
 
     # 音声ファイルの長さを取得
     audio_length = info.duration
 
     # 文字起こし情報をクライアントに送信
-    message_sent = await send_websocket_message(
-        websocket,
-        {  
-            "type": "info",  
-            "language": info.language,  
-            "language_probability": info.language_probability,  
-            "length": convert_seconds(audio_length),  
-            "done": False  
-        },
-        session_id
-    )
+    message_sent = await send({  
+        "type": "info",  
+        "language": info.language,  
+        "language_probability": info.language_probability,  
+        "length": convert_seconds(audio_length),  
+        "done": False  
+    })
     
     if not message_sent:
         return  # 接続が切れていたら終了
 
-    # 文字起こし結果を格納する変数
-    final_text = ""  
+    # 文字起こし結果を格納する変数（全文は送信済みなので、最後には件数とダイジェストだけを送る）
+    digest = hashlib.sha256()  # 全文（セグメントのテキストを連結したもの）のSHA-256
+    segments = []  # キャッシュ保存用の [開始秒, 終了秒, テキスト(, 単語)]
     
     # 各セグメント（文章単位の音声）を処理
-    for segment in segments:  
+    while True:
+        kind, segment = await queue.get()
+        if kind == "error":
+            raise segment
+        if kind == "end":
+            break
         # 停止要求があった場合は処理を中断
-        if should_stop():  
+        if kind == "stopped" or should_stop():  
             logging.info(f"Transcription stopped by request")
-            await send_websocket_message(
-                websocket,
-                {"type": "stopped", "done": True},
-                session_id
-            )
+            await send({"type": "stopped", "done": True})
             return
 
         # 文字起こし結果を累積
-        final_text += segment.text  
+        digest.update(segment.text.encode("utf-8"))
+        words = getattr(segment, "words", None)
+        words = [[word.start, word.end, word.word] for word in words] if words else None
+        segments.append([segment.start, segment.end, segment.text, words] if words else [segment.start, segment.end, segment.text])
 
-        # タイムライン形式のテキスト（開始時間→終了時間 + テキスト）
-        time_line = f"[{convert_seconds(segment.start)} -> {convert_seconds(segment.end)}] {segment.text}"  
-        
         # 進捗率の計算
         progress = 0
         if audio_length > 0:
             progress = int(segment.end / audio_length * 100)
 
-        # セグメント結果をクライアントに送信
-        message_sent = await send_websocket_message(
-            websocket,
-            {  
-                "type": "segment",  
-                "data": {  
-                    "time_line": time_line,  
-                    "text": segment.text     
-                },  
-                "progress": progress,  
-                "done": False  
-            },
-            session_id
-        )
+        # セグメント結果をクライアントに送信（時刻は秒数のまま送り、表示用の整形は送信側・クライアント側で行う）
+        message = {
+            "type": "segment",  
+            "start": segment.start,  
+            "end": segment.end,  
+            "text": segment.text,  
+            "progress": progress,  
+            "done": False  
+        }
+        if words:
+            message["words"] = words  # [[開始秒, 終了秒, 単語], ...]
+        message_sent = await send(message)
         
         if not message_sent:
             return  # 接続が切れていたら終了
 
-        # 非同期処理の機会を与える
-        await asyncio.sleep(0)
-
-    # 最終的な文字起こし結果をクライアントに送信
-    await send_websocket_message(
-        websocket,
-        {  
-            "type": "final",  
-            "data": {  
-                "result": final_text  
-            },  
-            "done": True 
-        },
-        session_id
-    )
-    logging.info("Transcription completed successfully")
\ No newline at end of file
+    # 完了をクライアントに送信（全文はセグメントとして送信済みなので、受信漏れの確認用の情報のみ）
+    await send(final_message(len(segments), digest))
+    logging.info("Transcription completed successfully")
+    info = {"language": info.language, "language_probability": info.language_probability, "duration": audio_length}
+    return info, segments
\ No newline at end of file
@@ -1,5 +1,35 @@
+import time
+import queue
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import jsonify
-from faster_whisper import WhisperModel
+from model_pool import model_pool, DEFAULT_MODEL
+from result_cache import result_cache
+from scheduler import default_worker_count
+from decode_policy import plan_decode
+from metrics import JobTimer
+
+# 文字起こしの設定（キャッシュのキーにも使う）
+DECODE_OPTIONS = {
+    "language": "ja",  # 日本語を指定
+    "beam_size": 5,  # ビームサーチの幅（精度向上のため）
+    "vad_filter": True,  # 音声区間検出フィルターを有効化
+    "without_timestamps": True,  # タイムスタンプなしの出力を無効化
+    "prompt_reset_on_temperature": 0,  # プロンプトリセットの温度閾値
+    # "initial_prompt": ""  # 初期プロンプト（今回は未使用）
+}
+
+# 同時に文字起こしを行うワーカー数
+WORKERS = default_worker_count()
+# 文字起こしを実行する共有ワーカー（リクエスト用のスレッドはデコードを待たずに結果を中継する）
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="transcribe")
+# ワーカー数分のモデルを同時に貸し出せるようにする
+model_pool.pool_size = max(model_pool.pool_size, WORKERS)
+# 受け付けて終わっていない文字起こしの数（ワーカー数を超えた分が待機中。デコード方針の選択に使う）
+_active = 0
+_active_lock = threading.Lock()
 
 # 秒を「〇分〇秒」の形式に変換する関数
 def convert_seconds(seconds):
@@ -7,39 +37,134 @@ def convert_seconds(seconds):
     remaining_seconds = seconds % 60  # 残りの秒を計算
     return f"{int(minutes)}分{int(remaining_seconds)}秒"
 
-# 音声ファイルを文字起こしする関数
-def transcribe(audio_file):
-    # Whisperモデル（large-v3）をGPUで初期化
-    model = WhisperModel("large-v3", device="cuda", compute_type="float16")
-    
-    # 音声ファイルの文字起こしを実行
-    segments, info = model.transcribe(audio_file,
-                                      language = "ja",  # 日本語を指定
-                                      beam_size=5,  # ビームサーチの幅（精度向上のため）
-                                      vad_filter=True,  # 音声区間検出フィルターを有効化
-                                      without_timestamps=True,  # タイムスタンプなしの出力を無効化
-                                      prompt_reset_on_temperature=0,  # プロンプトリセットの温度閾値
-                                      # initial_prompt=""  # 初期プロンプト（今回は未使用）
-                                      )
-
-    # 結果を格納する変数を初期化
-    full_text=""  # 全文テキスト
-    time_line=""  # タイムスタンプ付きテキスト
-    
-    # 各セグメント（文章）ごとに処理
-    for segment in segments:
-        # タイムスタンプ付きのテキストを生成（開始時間 -> 終了時間の形式）
-        time_line+="[%s -> %s] %s" % (convert_seconds(segment.start), convert_seconds(segment.end), segment.text)+"  \n"
-        # 全文テキストに追加
-        full_text+=segment.text+"\n"
+# ワーカーで文字起こしを行い、結果を put(種類, 値) で渡す関数
+def _worker(audio_file, audio_hash, put, cancelled, options, timer):
+    global _active
+    status = "error"
+    try:
+        cache_key = None
+        if audio_hash:
+            cache_key = result_cache.make_key(audio_hash, DEFAULT_MODEL, options)
+            cached = result_cache.get(cache_key)
+            timer.record(cache_hit=cached is not None)
+            if cached is not None:
+                put("info", cached["info"])
+                for segment in cached["segments"]:
+                    put("segment", segment)
+                status = "done"
+                return
+
+        # 共有プールからWhisperモデル（large-v3）を借りる
+        with model_pool.model() as model:
+            # 音声ファイルの文字起こしを実行
+            started = time.monotonic()
+            segments, info = model.transcribe(audio_file, **options)
+            info = {"language": info.language, "language_probability": info.language_probability, "duration": info.duration}
+            put("info", info)
+            # 各セグメント（文章）の [開始秒, 終了秒, テキスト]
+            results = []
+            for segment in segments:
+                results.append([segment.start, segment.end, segment.text])
+                put("segment", results[-1])
+                # クライアントが切断した場合は次のセグメントをデコードしない
+                if cancelled.is_set():
+                    segments.close()
+                    status = "stopped"
+                    return
+            timer.record_decode(info["duration"], time.monotonic() - started)
+
+        status = "done"
+        if cache_key:
+            result_cache.put(cache_key, info, results)
+    except Exception as e:
+        put("error", e)
+    finally:
+        with _active_lock:
+            _active -= 1
+        # 選んだデコード方針と実時間比をジョブごとの計測記録として出力する
+        timer.finish(status)
+        put("end")
+
+# 音声ファイルを文字起こしし、("info", 情報) と ("segment", [開始秒, 終了秒, テキスト]) を順に返すジェネレータ
+# audio_hash を渡すと、同じ音声・同じ設定の結果をキャッシュから返す
+# quality（fast・balanced・accurate）と待機中の文字起こしの数からデコード方針を選び、language を指定した場合は言語判定を行わない
+# 途中で閉じられた場合はデコードを打ち切り、ワーカーがモデルを返却するまで待つ
+def transcribe_events(audio_file, audio_hash=None, quality=None, language=None):
+    global _active
+    results = queue.Queue()
+    cancelled = threading.Event()
+    timer = JobTimer()
+    with _active_lock:
+        queued = max(0, _active - WORKERS)
+        _active += 1
+    policy, reason, options = plan_decode(DECODE_OPTIONS, quality, language, queued, WORKERS, timer)
+    logging.info(f"Using {policy} decoding ({reason})")
+    future = _executor.submit(_worker, audio_file, audio_hash, lambda kind, value=None: results.put((kind, value)), cancelled, options, timer)
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield kind, value
+    finally:
+        cancelled.set()
+        future.result()
+
+# 音声ファイルを文字起こしして、結果全体をJSONで返す関数
+def transcribe(audio_file, audio_hash=None, quality=None, language=None):
+    info = None
+    segments = []
+    for kind, value in transcribe_events(audio_file, audio_hash, quality, language):
+        if kind == "info":
+            info = value
+        else:
+            segments.append(value)
+    return _build_result(info, segments)
+
+# セグメントからレスポンスを作成する関数
+def _build_result(info, segments):
+    # タイムスタンプ付きテキストと全文テキストは、行のリストを最後に連結して作る
+    time_line = "".join("[%s -> %s] %s" % (convert_seconds(start), convert_seconds(end), text) + "  \n" for start, end, text in segments)
+    full_text = "".join(text + "\n" for _, _, text in segments)
 
     # 結果をJSON形式で返すためのデータ作成
     result = {
-        "language": info.language,  # 検出された言語
-        "language_probability": info.language_probability,  # 言語検出の確信度
+        "language": info["language"],  # 検出された言語
+        "language_probability": info["language_probability"],  # 言語検出の確信度
         "time_line":time_line,  # タイムスタンプ付きテキスト
         "full_text":full_text  # 全文テキスト
     }
 
     # JSON形式で結果を返す
     return jsonify(result)
+
+# 文字起こしの結果をFastAPI版と同じ形式のメッセージとして順に返すジェネレータ（ストリーミング応答用）
+def transcribe_messages(audio_file, audio_hash=None, quality=None, language=None):
+    duration = 0
+    count = 0
+    digest = hashlib.sha256()  # 全文（セグメントのテキストを連結したもの）のSHA-256
+    for kind, value in transcribe_events(audio_file, audio_hash, quality, language):
+        if kind == "info":
+            duration = value["duration"]
+            yield {
+                "type": "info",
+                "language": value["language"],
+                "language_probability": value["language_probability"],
+                "length": convert_seconds(duration),
+                "done": False,
+            }
+            continue
+        start, end, text = value
+        count += 1
+        digest.update(text.encode("utf-8"))
+        yield {
+            "type": "segment",
+            "data": {"time_line": f"[{convert_seconds(start)} -> {convert_seconds(end)}] {text}", "text": text},
+            "progress": int(end / duration * 100) if duration > 0 else 0,
+            "done": False,
+        }
+    # 全文はセグメントとして送信済みなので、最後には件数とダイジェストだけを送る
+    yield {"type": "final", "data": {"segment_count": count, "sha256": digest.hexdigest()}, "done": True}
+    logging.info("Transcription completed successfully")
@@ -0,0 +1,93 @@
+import os
+import asyncio
+import logging
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from spool import blob_store
+
+# バイナリフレーム1つあたりの標準サイズ（クライアントはこのサイズで分割して送信する）
+CHUNK_SIZE = 1024 * 1024
+# 受け付けるチャンクサイズの上限
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+# アップロード内容に問題があったときに送出する例外
+class UploadError(Exception):
+    pass
+
+# 受信中の音声のハッシュ
+_uploading = set()
+
+# チャンクをファイルに書き込み、ハッシュに加える（受信中の文字起こしが読めるようにすぐ書き出す）
+def _write_chunk(f, digest, chunk):
+    f.write(chunk)
+    f.flush()
+    digest.update(chunk)
+
+# ヘッダーに続くバイナリフレームを受信し、コンテンツアドレス型のストアへ直接書き込む関数
+# 受信中にメモリに保持するのはチャンク1つ分のみ。受信済みの音声のハッシュを返す
+# header['offset'] を指定すると、途中まで受信済みのアップロードをその位置から再開する
+# progress(受信済みバイト数) を渡すと、チャンクをファイルに書き込むたびに呼び出す（受信中の文字起こし用）
+async def receive_chunked_upload(websocket: WebSocket, header: dict, progress=None):
+    size = int(header['size'])  # ファイル全体のバイト数
+    offset = int(header.get('offset', 0))  # 再開位置
+    chunk_size = int(header.get('chunk_size', CHUNK_SIZE))
+    if size < 0 or not 0 <= offset <= size or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise UploadError("Invalid upload header")
+    try:
+        sha256 = blob_store.validate(header.get('sha256'))
+    except ValueError as e:
+        raise UploadError(str(e))
+
+    # 既に同じ音声を保存済みなら受信せずにそのまま使う
+    if blob_store.probe(sha256)["exists"]:
+        logging.info(f"Audio {sha256[:12]} already stored, skipping upload")
+        await websocket.send_json({"type": "upload_ack", "received": size, "done": False})
+        return sha256
+
+    # 同じ音声の同時アップロードは受け付けない
+    if sha256 in _uploading:
+        raise UploadError("Upload of this audio is already in progress")
+    _uploading.add(sha256)
+    try:
+        return await _receive_frames(websocket, sha256, size, offset, chunk_size, progress)
+    finally:
+        _uploading.discard(sha256)
+
+async def _receive_frames(websocket: WebSocket, sha256, size, offset, chunk_size, progress=None):
+    try:
+        digest = await asyncio.to_thread(blob_store.partial_digest, sha256, offset)
+        f = blob_store.open_partial(sha256, offset)
+    except (ValueError, FileNotFoundError) as e:
+        raise UploadError(str(e))
+
+    received = offset
+    if progress is not None and offset:
+        progress(offset)
+    with f:
+        # 受信準備ができたことをクライアントに通知
+        await websocket.send_json({"type": "upload_ready", "chunk_size": chunk_size, "offset": offset, "done": False})
+        while received < size:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                # 受信済みの部分は残しておき、次回の再開に使う
+                raise WebSocketDisconnect(message.get("code", 1000))
+            chunk = message.get("bytes")
+            if chunk is None:
+                # アップロード中にテキストメッセージ（停止要求など）が来た場合は中断
+                raise UploadError("Upload interrupted")
+            if len(chunk) > chunk_size or received + len(chunk) > size:
+                raise UploadError("Upload exceeds declared size")
+            # 最大16MiBの書き込みとハッシュ計算でイベントループを止めないよう、別スレッドで行う
+            await asyncio.to_thread(_write_chunk, f, digest, chunk)
+            received += len(chunk)
+            if progress is not None:
+                progress(received)
+            # 受信済みバイト数をクライアントに通知（進捗表示・再開位置の確認用）
+            await websocket.send_json({"type": "upload_ack", "received": received, "done": False})
+
+    # チェックサムの検証（一致しなければ途中ファイルを破棄）
+    if digest.hexdigest() != sha256:
+        os.remove(blob_store.partial_path(sha256))
+        raise UploadError("Checksum mismatch")
+    await asyncio.to_thread(blob_store.commit, sha256)
+    logging.info(f"Received chunked upload ({received - offset} of {size} bytes transferred)")
+    return sha256
@@ -0,0 +1,146 @@
+import os
+import time
+import asyncio
+import logging
+import numpy as np
+from model_pool import model_pool, DEFAULT_MODEL
+from model_catalog import model_catalog
+
+try:
+    import pynvml  # GPUのメモリ使用量の取得（任意の依存パッケージ）
+except ImportError:
+    pynvml = None
+
+# 起動時にモデルを読み込むか（0 なら最初のジョブで読み込む）
+PRELOAD_ENABLED = os.environ.get("TRANSCRIBE_PRELOAD", "1") == "1"
+# 起動時に読み込むモデル（モデル一覧の名前をカンマ区切りで指定。未設定ならデフォルトモデルのみ）
+PRELOAD_MODELS = tuple(name for name in os.environ.get("TRANSCRIBE_PRELOAD_MODELS", "").split(",") if name)
+# 読み込み中に届いたジョブを待たせる上限（秒）。これを超えたらジョブを拒否する
+READY_TIMEOUT = float(os.environ.get("TRANSCRIBE_READY_TIMEOUT", "600"))
+
+# faster_whisper（CTranslate2・トークナイザーなど）を読み込み、VADのモデルを一度動かしておく関数
+def _load_runtime():
+    import faster_whisper  # noqa: F401
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+    get_speech_timestamps(np.zeros(16000, dtype=np.float32), VadOptions())
+
+# サーバー起動後の準備（ランタイムとモデルの読み込み）をバックグラウンドで行い、その進み具合を管理するクラス
+# サーバーは準備を待たずに接続を受け付け、ジョブは wait() で準備が終わるまで待つ
+# 準備に失敗した場合も待っているジョブは先に進める（モデルはジョブごとに読み込まれ、失敗すればそのジョブのエラーになる）
+class Warmup:
+    def __init__(self):
+        self.status = "starting"  # starting → loading → ready / failed
+        self.started = time.time()
+        self.ready_seconds = None  # 起動から準備完了までの秒数
+        self.steps = []  # [{'name': 名前, 'state': pending/loading/done/failed, 'seconds': 所要時間, 'error': エラー}]
+        self._changed = asyncio.Event()  # 状態が変わるたびにセットして差し替える
+        self._task = None
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    # 準備が終わったか（失敗した場合を含む）
+    @property
+    def done(self):
+        return self.status in ("ready", "failed")
+
+    # 完了した手順の割合（0〜1）
+    @property
+    def progress(self):
+        if not self.steps:
+            return 1.0 if self.done else 0.0
+        return sum(step["state"] == "done" for step in self.steps) / len(self.steps)
+
+    # 準備を開始する（イベントループ上で呼ぶ）
+    # models はモデル一覧の名前（未指定なら PRELOAD_MODELS、それも空ならデフォルトモデル）
+    def start(self, enabled=PRELOAD_ENABLED, models=PRELOAD_MODELS):
+        if not enabled:
+            self._set_status("ready")
+            self.ready_seconds = 0.0
+            return
+        keys = [model_catalog.key(name) for name in models] or [DEFAULT_MODEL]
+        steps = [("runtime", _load_runtime)]
+        steps += [("/".join(key), lambda key=key: model_pool.preload(*key)) for key in keys]
+        self.steps = [{"name": name, "state": "pending", "seconds": None, "error": None} for name, _ in steps]
+        self._set_status("loading")
+        self._task = asyncio.create_task(self._run([fn for _, fn in steps]))
+
+    async def _run(self, functions):
+        for step, fn in zip(self.steps, functions):
+            step["state"] = "loading"
+            start = time.monotonic()
+            try:
+                await asyncio.to_thread(fn)
+            except Exception as e:
+                step.update(state="failed", seconds=round(time.monotonic() - start, 3), error=str(e))
+                logging.error(f"Warmup step {step['name']} failed: {e}")
+                self._set_status("failed")
+                return
+            step.update(state="done", seconds=round(time.monotonic() - start, 3))
+            logging.info(f"Warmup step {step['name']} finished in {step['seconds']:.1f}s")
+            self._notify()
+        self.ready_seconds = round(time.time() - self.started, 3)
+        logging.info(f"Server ready in {self.ready_seconds:.1f}s")
+        self._set_status("ready")
+
+    def _set_status(self, status):
+        self.status = status
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    # 準備が終わるまで待つ（終わったら True、timeout 秒を過ぎたら False）
+    # notify(進み具合) は手順が1つ終わるたびに呼ばれる
+    async def wait(self, timeout=READY_TIMEOUT, notify=None):
+        deadline = time.monotonic() + timeout
+        while not self.done:
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return False
+            if notify is not None and not self.done:
+                await notify(self.progress)
+        return True
+
+    def summary(self):
+        return {
+            "status": self.status,
+            "ready": self.ready,
+            "progress": round(self.progress, 3),
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "ready_seconds": self.ready_seconds,
+            "steps": self.steps,
+        }
+
+# プロセスとデバイスのメモリ使用量を返す関数（取得できない項目は含めない）
+def memory_usage():
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rss_bytes"] = int(line.split()[1]) * 1024
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith(("MemTotal:", "MemAvailable:")):
+                    name, value = line.split()[:2]
+                    usage["total_bytes" if name == "MemTotal:" else "available_bytes"] = int(value) * 1024
+    except OSError:
+        pass  # Linux 以外
+    if pynvml is not None and DEFAULT_MODEL[1] == "cuda":
+        try:
+            pynvml.nvmlInit()
+            usage["gpus"] = []
+            for index in range(pynvml.nvmlDeviceGetCount()):
+                info = pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(index))
+                usage["gpus"].append({"index": index, "used_bytes": info.used, "total_bytes": info.total})
+        except pynvml.NVMLError as e:
+            logging.debug(f"Could not read GPU memory: {e}")
+    return usage
+
+# プロセス全体で共有する準備状況
+warmup = Warmup()